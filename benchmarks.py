@@ -0,0 +1,580 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from kalman import KalmanFilter, UPDATE_METHODS
+import cleaner
+import filter
+import synthetic
+
+
+
+def car_model():
+    """
+    Build the 9 state constant-acceleration model used in kalman_filter.ipynb
+
+    Returns
+    -------
+    kf : KalmanFilter
+        The filter with Q = 0.1*I, R = 1000*I and dt = 0.1
+    x0 : ndarray of shape (9,)
+        The initial state
+    P0 : ndarray of shape (9,9)
+        The initial error covariance matrix
+    """
+    return kinematic_model(3)
+
+
+
+def kinematic_model(dims, dt=.1):
+    """
+    Build the constant-acceleration model of kalman_filter.ipynb for any number of axes.
+    The state holds the positions, velocities and accelerations of every axis
+    (n = 3*dims) and the positions and accelerations are observed (m = 2*dims).
+
+    Parameters
+    ----------
+    dims : int
+        The number of axes (3 gives car_model)
+    dt : float
+        The time step
+
+    Returns
+    -------
+    kf : KalmanFilter
+        The filter with Q = 0.1*I and R = 1000*I
+    x0 : ndarray of shape (n,)
+        The initial state
+    P0 : ndarray of shape (n,n)
+        The initial error covariance matrix
+    """
+    n = 3 * dims
+    Q = np.eye(n) * 0.1
+    R = np.eye(2 * dims) * 1000
+    F = np.eye(n)
+    for i in range(2 * dims):
+        F[i, i + dims] = dt
+
+    H = np.zeros((2 * dims, n))
+    for i in range(dims):
+        H[i, i] = 1
+        H[i + dims, i + 2 * dims] = 1
+
+    G = np.ones((n, n))
+    u = np.zeros(n)
+    return KalmanFilter(F, Q, H, R, G, u), np.zeros(n), 1e5 * Q
+
+
+
+def bench_update_methods(kf, x0, P0, z, methods=UPDATE_METHODS, sym_tol=1e-9):
+    """
+    Compare the update strategies of KalmanFilter.estimate on the same observations
+
+    Parameters
+    ----------
+    kf : KalmanFilter
+        The filter to benchmark
+    x0 : ndarray of shape (n,)
+        The initial state estimate
+    P0 : ndarray of shape (n,n)
+        The initial error covariance matrix
+    z : ndarray of shape (m,N)
+        Sequence of N observations
+    methods : iterable of str
+        The update strategies to compare
+    sym_tol : float
+        Largest |P - P^T| entry that is not counted as a symmetry violation
+
+    Returns
+    -------
+    dict
+        For each method: "steps_per_sec", "max_asymmetry", "symmetry_violations"
+        (steps with asymmetry above sym_tol), "pd_violations" (steps where P is
+        not positive definite) and "max_diff" (largest deviation from "inverse")
+    """
+    N = z.shape[1]
+    results = {}
+    reference = None
+
+    for method in methods:
+        # time the filter itself
+        start = time.perf_counter()
+        out = kf.estimate(x0, P0, z, method=method)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = kf.estimate(x0, P0, z) if method != "inverse" else out
+
+        # rerun the steps and check every covariance
+        consts = kf._step_constants(method)
+        xk = x0
+        pk = np.linalg.cholesky(P0) if method == "sqrt" else P0
+        max_asym = 0.
+        sym_violations = 0
+        pd_violations = 0
+        for i in range(1, N):
+            xk, pk = kf._filter_step(xk, pk, z[:, i], method, consts)
+            P = pk @ pk.T if method == "sqrt" else pk
+            asym = np.abs(P - P.T).max()
+            max_asym = max(max_asym, asym)
+            sym_violations += asym > sym_tol
+            try:
+                np.linalg.cholesky(P)
+            except np.linalg.LinAlgError:
+                pd_violations += 1
+
+        results[method] = {"steps_per_sec": (N - 1) / elapsed,
+                           "max_asymmetry": float(max_asym),
+                           "symmetry_violations": int(sym_violations),
+                           "pd_violations": int(pd_violations),
+                           "max_diff": float(np.abs(out - reference).max())}
+    return results
+
+
+
+def _load_once(parent, kwargs, queue):
+    """
+    Load and clean the dataset once and report the cost (runs in a fresh process)
+    """
+    start = time.perf_counter()
+    ddict = cleaner.clean_dict(cleaner.load_data(parent, **kwargs))
+    elapsed = time.perf_counter() - start
+    frame_bytes = 0
+    for t_type in ddict:
+        for csvf in ddict[t_type]:
+            if isinstance(ddict[t_type][csvf], dict):
+                frame_bytes += sum(int(df.memory_usage(deep=True).sum()) for df in ddict[t_type][csvf].values())
+
+    # ru_maxrss is in kilobytes on linux
+    queue.put({"wall_sec": elapsed,
+               "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+               "frame_mb": frame_bytes / 2**20})
+
+
+
+def bench_loaders(parent=".data", configs=None):
+    """
+    Compare load_data configurations on wall time and peak memory.
+    Every configuration runs in its own fresh process, so peak RSS is not
+    polluted by earlier runs or by the benchmark itself.
+
+    Parameters
+    ----------
+    parent : str
+        The dataset folder
+    configs : dict, optional
+        Maps a name to load_data keyword arguments. Defaults to the plain
+        loader against the compact loader with one worker thread per cpu.
+
+    Returns
+    -------
+    dict
+        For each configuration: "wall_sec" (load plus clean_dict), "peak_rss_mb"
+        and "frame_mb" (memory held by the cleaned frames), plus "saved_sec" and
+        "saved_rss_mb" relative to the first configuration
+    """
+    if configs is None:
+        configs = {"default": {}, "compact": {"compact": True, "workers": os.cpu_count()}}
+
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for name, kwargs in configs.items():
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_load_once, args=(parent, kwargs, queue))
+        proc.start()
+        results[name] = queue.get()
+        proc.join()
+
+    base = next(iter(results.values()))
+    for res in results.values():
+        res["saved_sec"] = base["wall_sec"] - res["wall_sec"]
+        res["saved_rss_mb"] = base["peak_rss_mb"] - res["peak_rss_mb"]
+    return results
+
+
+
+def _merge_asof_fold(dfs):
+    """
+    The pandas equivalent of combine_data(dfs, how="asof")
+    """
+    df = dfs[0]
+    for other in dfs[1:]:
+        df = pd.merge_asof(df, other, on="timestamp")
+    return df
+
+
+
+def bench_combine(dfs, configs=None, repeat=3):
+    """
+    Time combine_data join methods on the same frames
+
+    Parameters
+    ----------
+    dfs : list
+        The frames to join, the fastest stream first (e.g. mpu left, mpu right, gps)
+    configs : dict, optional
+        Maps a name to combine_data keyword arguments, or to a callable taking
+        the frames. Defaults to the legacy merge fold, the exact sorted join,
+        a pd.merge_asof fold for reference, as-of, nearest with a 0.5 s
+        tolerance, and interpolation of the slower streams.
+    repeat : int
+        The number of runs per configuration (the best is reported)
+
+    Returns
+    -------
+    dict
+        For each configuration: "sec", "rows" and "speedup" over the first configuration
+    """
+    if configs is None:
+        configs = {"merge": {},
+                   "exact": {"how": "exact"},
+                   "merge_asof": _merge_asof_fold,
+                   "asof": {"how": "asof"},
+                   "nearest": {"how": "nearest", "tolerance": 0.5},
+                   "interpolate": {"how": "asof", "interpolate": True}}
+
+    results = {}
+    for name, kwargs in configs.items():
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = kwargs(dfs) if callable(kwargs) else cleaner.combine_data(dfs, **kwargs)
+            best = min(best, time.perf_counter() - start)
+        rows = out[1].shape[1] if isinstance(out, tuple) else len(out)
+        results[name] = {"sec": best, "rows": rows}
+
+    base = next(iter(results.values()))["sec"]
+    for res in results.values():
+        res["speedup"] = base / res["sec"]
+    return results
+
+
+
+def pvs_frames(path):
+    """
+    Read and clean the mpu left, mpu right and gps files of one PVS folder for bench_combine
+    """
+    names = ["dataset_gps_mpu_left.csv", "dataset_gps_mpu_right.csv", "dataset_gps.csv"]
+    return [cleaner.clean_frame(cleaner.match_file_type(name), pd.read_csv(os.path.join(path, name))) for name in names]
+
+
+
+# bundled single drive used by the suite
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+
+def measure(fn, items, repeat=3, setup=None):
+    """
+    Time a function and trace its peak memory
+
+    Parameters
+    ----------
+    fn : callable
+        The code to measure. If setup is given, fn receives its result.
+    items : int
+        The amount of work done per call (rows, steps, ...), for the throughput
+    repeat : int
+        The number of timed calls (the best is kept)
+    setup : callable, optional
+        Called before every call, outside the timing (e.g. to copy inputs fn modifies)
+
+    Returns
+    -------
+    dict
+        "sec" (best wall time), "throughput" (items per second), "peak_mb"
+        (peak memory allocated during one call, from tracemalloc) and "items"
+    """
+    best = np.inf
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        fn(arg) if setup is not None else fn()
+        best = min(best, time.perf_counter() - start)
+
+    # one more call under tracemalloc, which slows it down, so it is not timed
+    arg = setup() if setup is not None else None
+    tracemalloc.start()
+    try:
+        fn(arg) if setup is not None else fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"sec": best, "throughput": items / best, "peak_mb": peak / 2**20, "items": int(items)}
+
+
+
+def scaled_dataset(parent, scale=1, data_dir=DATA_DIR):
+    """
+    Build a load_data folder with `scale` copies of the bundled drive (as symlinks)
+
+    Parameters
+    ----------
+    parent : str
+        The folder to create the PVS folders in
+    scale : int
+        The number of PVS folders
+    data_dir : str
+        The folder holding dataset_gps.csv and dataset_labels.csv
+
+    Returns
+    -------
+    str
+        parent
+    """
+    for i in range(scale):
+        folder = os.path.join(parent, f"PVS {i + 1}")
+        os.makedirs(folder, exist_ok=True)
+        for name in ("dataset_gps.csv", "dataset_labels.csv"):
+            target = os.path.join(folder, name)
+            if not os.path.exists(target):
+                os.symlink(os.path.join(data_dir, name), target)
+    return parent
+
+
+
+def _kalman_cases(tmp, scale, dims, lengths):
+    """
+    kalman.py across state dimensions and sequence lengths
+    """
+    rng = np.random.default_rng(0)
+    for d in dims:
+        kf, x0, P0 = kinematic_model(d)
+        for N in lengths:
+            N *= scale
+            z = np.cumsum(rng.normal(size=(2 * d, N)), axis=1)
+            # bound as defaults, so a case still runs its own model after the loop moves on
+            yield f"kalman.estimate[n={3 * d},N={N}]", {
+                "fn": lambda kf=kf, x0=x0, P0=P0, z=z: kf.estimate(x0, P0, z), "items": N}
+            yield f"kalman.predict[n={3 * d},N={N}]", {"fn": lambda kf=kf, x0=x0, N=N: kf.predict(x0, N), "items": N}
+            yield f"kalman.rewind[n={3 * d},N={N}]", {"fn": lambda kf=kf, x0=x0, N=N: kf.rewind(x0, N), "items": N}
+            yield f"kalman.evolve[n={3 * d},N={N}]", {
+                "fn": lambda kf=kf, x0=x0, N=N: kf.evolve(x0, N, rng=0), "items": N}
+
+
+
+def _data_cases(tmp, scale, dims, lengths):
+    """
+    filter.py and cleaner.py on copies of the bundled drive
+    """
+    parent = scaled_dataset(os.path.join(tmp, f"data-{scale}"), scale)
+    ddict = cleaner.clean_dict(cleaner.load_data(parent))
+    gps_rows = sum(len(df) for df in ddict["train"]["t_gps"].values())
+    label_rows = sum(len(df) for df in ddict["train"]["labels"].values())
+
+    yield f"cleaner.load_data[drives={scale}]", {"fn": lambda: cleaner.load_data(parent), "items": gps_rows + label_rows}
+    yield f"cleaner.clean_dict[drives={scale}]", {"fn": cleaner.clean_dict, "items": gps_rows + label_rows,
+                                                 "setup": lambda: cleaner.load_data(parent)}
+    yield f"filter.add_lat_long_meters[rows={gps_rows}]", {
+        "fn": lambda frames: [filter.add_lat_long_meters(df) for df in frames], "items": gps_rows,
+        "setup": lambda: [df.copy() for df in ddict["train"]["t_gps"].values()]}
+
+
+
+def _synthetic_cases(tmp, scale, dims, lengths):
+    """
+    The mpu hot paths on a synthetic drive (the bundled drive has no mpu files)
+    """
+    drive = os.path.join(tmp, f"drive-{scale}")
+    if not os.path.exists(drive):
+        synthetic.generate_drive(drive, duration=1440 * scale, seed=0)
+    frames = pvs_frames(drive)
+    signal = frames[0]["acc_x_dash"].to_numpy(dtype=float)
+    yield f"filter.smooth[N={len(signal)}]", {"fn": lambda: filter.smooth(signal), "items": len(signal)}
+    yield f"filter.add_smoothed_cols[rows={len(frames[0])}]", {
+        "fn": filter.add_smoothed_cols, "items": len(frames[0]),
+        "setup": lambda: {"train": {"gps_mpu_left": {"PVS 1": frames[0].copy()}}}}
+    for how in ("merge", "asof"):
+        yield f"cleaner.combine_data[how={how},rows={len(frames[0])}]", {
+            "fn": lambda how=how: cleaner.combine_data(frames, how=how), "items": len(frames[0])}
+
+
+
+# the groups of the suite: the benchmarks each one yields (name prefixes) and
+# the generator building them, which holds all of the group's setup
+SUITE_GROUPS = {
+    "kalman": (["kalman.estimate", "kalman.predict", "kalman.rewind", "kalman.evolve"], _kalman_cases),
+    "data": (["cleaner.load_data", "cleaner.clean_dict", "filter.add_lat_long_meters"], _data_cases),
+    "synthetic": (["filter.smooth", "filter.add_smoothed_cols", "cleaner.combine_data"], _synthetic_cases),
+}
+
+
+
+def suite_cases(tmp, scale=1, dims=(1, 3, 6), lengths=(1000, 10000), only=None):
+    """
+    The benchmarks of the suite, built lazily one at a time
+
+    Each group of SUITE_GROUPS only does its setup (loading the scaled dataset,
+    generating the synthetic drive) if one of its benchmarks can match only.
+
+    Parameters
+    ----------
+    tmp : str
+        A scratch folder for the scaled datasets
+    scale : int
+        Multiplies the data sizes: the number of copies of the bundled drive,
+        the length of the synthetic drive and the filter sequence lengths
+    dims : tuple
+        The numbers of axes of the kinematic models (n = 3*dims states)
+    lengths : tuple
+        The filter sequence lengths (before scaling)
+    only : str, optional
+        A group name, or a string the benchmark names must contain. A string
+        that only matches the bracketed sizes (e.g. "N=1000") cannot rule out
+        any group, so every group is set up.
+
+    Yields
+    ------
+    tuple (name, kwargs)
+        The benchmark name and the arguments of measure
+    """
+    if only is None or only in SUITE_GROUPS:
+        groups = [only] if only is not None else list(SUITE_GROUPS)
+        only = None
+    else:
+        groups = [group for group, (prefixes, _) in SUITE_GROUPS.items()
+                  if any(only in prefix or prefix in only for prefix in prefixes)]
+        groups = groups or list(SUITE_GROUPS)
+
+    for group in groups:
+        for name, kwargs in SUITE_GROUPS[group][1](tmp, scale, dims, lengths):
+            if only is None or only in name:
+                yield name, kwargs
+
+
+
+def run_suite(scale=1, repeat=3, only=None, verbose=False, **case_kwargs):
+    """
+    Run every benchmark of the suite
+
+    Parameters
+    ----------
+    scale : int
+        The data scale (see suite_cases)
+    repeat : int
+        The number of timed calls per benchmark
+    only : str, optional
+        Only run one group of SUITE_GROUPS, or the benchmarks whose name contains this
+    verbose : bool
+        Whether or not to print each result
+    case_kwargs : dict
+        Passed to suite_cases
+
+    Returns
+    -------
+    dict
+        Maps each benchmark name to its measure result
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, kwargs in suite_cases(tmp, scale=scale, only=only, **case_kwargs):
+            results[name] = measure(repeat=repeat, **kwargs)
+            if verbose:
+                res = results[name]
+                print(f"{name:55s} {res['sec'] * 1e3:10.2f} ms {res['throughput']:14.0f} /s {res['peak_mb']:9.1f} MB")
+    return results
+
+
+
+def save_baseline(results, path):
+    """
+    Store suite results as a JSON baseline, along with the environment they were measured in
+    """
+    meta = {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "machine": platform.machine(), "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+    with open(path, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+
+
+
+def compare(results, baseline, threshold=0.2, min_mb=1.0):
+    """
+    Flag regressions against a baseline
+
+    Parameters
+    ----------
+    results : dict
+        The output of run_suite
+    baseline : dict or str
+        A baseline dictionary or the path of a save_baseline file
+    threshold : float
+        The tolerated relative loss of throughput or growth of peak memory
+    min_mb : float
+        Memory growth below this many megabytes is never flagged
+
+    Returns
+    -------
+    list of dict
+        One entry per regression with the benchmark name, the metric, the
+        baseline and current values and the relative change
+    """
+    if isinstance(baseline, str):
+        with open(baseline) as f:
+            baseline = json.load(f)
+    baseline = baseline.get("results", baseline)
+
+    regressions = []
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if res["throughput"] < (1 - threshold) * base["throughput"]:
+            regressions.append({"name": name, "metric": "throughput", "baseline": base["throughput"],
+                                "current": res["throughput"], "change": res["throughput"] / base["throughput"] - 1})
+        if res["peak_mb"] > (1 + threshold) * base["peak_mb"] and res["peak_mb"] - base["peak_mb"] > min_mb:
+            regressions.append({"name": name, "metric": "peak_mb", "baseline": base["peak_mb"],
+                                "current": res["peak_mb"], "change": res["peak_mb"] / base["peak_mb"] - 1})
+    return regressions
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of kalman.py, filter.py and cleaner.py")
+    parser.add_argument("--suite", action="store_true", help="run the benchmark suite instead of the comparisons")
+    parser.add_argument("--scale", type=int, default=1, help="the data scale of the suite")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", help="only run one suite group (kalman, data or synthetic) or the benchmarks "
+                                       "whose name contains this")
+    parser.add_argument("--baseline", help="a JSON baseline to compare against (or to write with --save)")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="the tolerated relative regression")
+    args = parser.parse_args()
+
+    if args.suite:
+        results = run_suite(scale=args.scale, repeat=args.repeat, only=args.only, verbose=True)
+        if args.baseline and args.save:
+            save_baseline(results, args.baseline)
+            print("saved baseline to", args.baseline)
+        elif args.baseline:
+            regressions = compare(results, args.baseline, threshold=args.threshold)
+            for r in regressions:
+                print(f"REGRESSION {r['name']} {r['metric']}: {r['baseline']:.4g} -> {r['current']:.4g} ({r['change']:+.0%})")
+            if regressions:
+                sys.exit(1)
+            print("no regressions")
+        sys.exit(0)
+
+    kf, x0, P0 = car_model()
+    rng = np.random.default_rng(0)
+    z = np.cumsum(rng.normal(size=(6, 20000)), axis=1)
+
+    for method, res in bench_update_methods(kf, x0, P0, z).items():
+        print(method, res)
+
+    for name, res in bench_loaders().items():
+        print(name, res)
+
+    # a full length (24 minute) drive, since the bundled data has no mpu files
+    with tempfile.TemporaryDirectory() as tmp:
+        synthetic.generate_drive(tmp, duration=1440, seed=0)
+        for name, res in bench_combine(pvs_frames(tmp)).items():
+            print(name, res)
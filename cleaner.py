@@ -2,7 +2,33 @@
 from matplotlib import pyplot as plt
 import numpy as np
 import pandas as pd
+import json
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import instrument
+
+
+
+# columns that clean_gps and clean_acc drop
+GPS_DROP_COLS = ['ageofdgpsdata', "dgpsid", "activity", "annotation",     # bad columns
+                 'hdop', 'vdop', 'pdop', "satellites", "geoidheight"]      # useless columns
+ACC_DROP_COLS = ["temp_dash", "temp_above", "temp_below"]
+
+# columns that keep float64 in the compact loader (timestamps and coordinates need the precision)
+FLOAT64_COLS = ["timestamp", "timestamp_gps", "latitude", "longitude", "elapsed_time_seconds", "distance_meters"]
+
+# the file types load_data recognizes
+FILE_TYPES = ["t_gps", "gps_mpu_left", "gps_mpu_right", "labels"]
+
+
+
+def acc_drops(col):
+    """
+    Whether or not clean_acc drops the given column
+    """
+    return col in ACC_DROP_COLS or "mag" in col
 
 
 
@@ -31,6 +57,7 @@ def print_structure(csvs, level=0):
 
 
 
+@instrument.timed("clean_dict", rows=instrument.frame_rows)
 def clean_dict(ddict, verbose=False):
     """
     Clean the data in the dictionary by dropping bad rows and columns
@@ -54,12 +81,14 @@ def clean_dict(ddict, verbose=False):
             if dff is not None:
                 if "left" in csvf or "right" in csvf:
                     for folder in dff:
-                        dff[folder] = clean_acc(dff[folder])        # this is the only interesting line
+                        with instrument.span("clean_dict.folder", folder=folder, file_type=csvf, rows=len(dff[folder])):
+                            dff[folder] = clean_acc(dff[folder])        # this is the only interesting line
                         if verbose:
                             print("cleaned", t_type, csvf, folder)
                 elif "t_gps" in csvf:
                     for folder in dff:
-                        dff[folder] = clean_gps(dff[folder])        # this is the only other interesting line
+                        with instrument.span("clean_dict.folder", folder=folder, file_type=csvf, rows=len(dff[folder])):
+                            dff[folder] = clean_gps(dff[folder])        # this is the only other interesting line
                         if verbose:
                             print("cleaned", t_type, csvf, folder)
 
@@ -81,11 +110,8 @@ def clean_gps(df):
     pd.DataFrame
         The cleaned gps data
     """
-    bad_cols = ['ageofdgpsdata', "dgpsid", "activity", "annotation"]
-    useless_cols = ['hdop', 'vdop', 'pdop', "satellites", "geoidheight"]
-
     # drop bad columns and rows
-    for col in bad_cols + useless_cols:
+    for col in GPS_DROP_COLS:
         if col in df.columns:
             df = df.drop(columns=[col])
     
@@ -110,13 +136,8 @@ def clean_acc(dirty_df):
     pd.DataFrame
         The cleaned accelerometer data
     """
-    useless_cols = ["temp_dash", "temp_above", "temp_below"]
-    for col in useless_cols:
-        if col in dirty_df.columns:
-            dirty_df = dirty_df.drop(columns=[col])
-    
     for col in dirty_df.columns:
-        if "mag" in col:
+        if acc_drops(col):
             dirty_df = dirty_df.drop(columns=[col])
     
     # remove the word "suspect" from the columns
@@ -128,27 +149,228 @@ def clean_acc(dirty_df):
     return dirty_df
 
 
-def combine_data(dfs):
+JOIN_METHODS = ["merge", "exact", "asof", "nearest"]
+
+
+
+def _sorted_by(df, on):
+    """
+    Return the frame sorted by its time column (without copying if it already is)
+    """
+    if df[on].is_monotonic_increasing:
+        return df
+    return df.sort_values(on, kind="stable")
+
+
+def _match_times(base, times, how, tolerance=None):
     """
-    Combine the data into one dataframe by merging on the timestamp column
+    For every time in base find the row of the sorted array times to join with.
+
+    Returns an int array with -1 where there is no match
+    """
+    if len(times) == 0:
+        return np.full(len(base), -1)
+    if how == "exact":
+        idx = np.searchsorted(times, base, side="left")
+        idx[idx == len(times)] = len(times) - 1
+        idx[times[idx] != base] = -1
+        return idx
+
+    # as of: the last row at or before each time
+    idx = np.searchsorted(times, base, side="right") - 1
+    if how == "nearest":
+        nxt = np.minimum(idx + 1, len(times) - 1)
+        prev = np.maximum(idx, 0)
+        closer = (idx < 0) | (np.abs(times[nxt] - base) < np.abs(base - times[prev]))
+        idx = np.where(closer, nxt, prev)
+    if tolerance is not None:
+        idx[(idx >= 0) & (np.abs(base - times[np.maximum(idx, 0)]) > tolerance)] = -1
+    return idx
+
+
+def _interpolate_into(out, base, times, columns, tolerance=None):
+    """
+    Linearly interpolate each column (sampled at the sorted times) at every time in base, writing row k of out.
+    Times outside the sampled range, or further than tolerance from the nearest sample, give NaN
+    """
+    if len(times) < 2:
+        out[:] = np.nan
+        return
+    j = np.clip(np.searchsorted(times, base, side="right") - 1, 0, len(times) - 2)
+    span = times[j + 1] - times[j]
+    w = np.divide(base - times[j], span, out=np.zeros(len(base)), where=span != 0)
+    bad = (base < times[0]) | (base > times[-1])
+    if tolerance is not None:
+        bad |= np.minimum(np.abs(base - times[j]), np.abs(times[j + 1] - base)) > tolerance
+    for k, values in enumerate(columns):
+        lo = values[j]
+        out[k] = lo + (values[j + 1] - lo) * w
+        out[k, bad] = np.nan
+
+
+def combine_data(dfs, how="merge", tolerance=None, interpolate=False, on="timestamp", as_array=False):
+    """
+    Combine the data into one dataframe by joining on the timestamp column
+
+    how="merge" folds pd.merge over the list (exact timestamps only, and the
+    accumulated frame is hashed again at every step). The other methods are a
+    single sorted join of every frame against the timestamps of the first one:
+    "exact" keeps the rows where every frame has that exact timestamp (the same
+    rows as "merge" when timestamps are unique), while "asof" (the last row at or
+    before) and "nearest" keep every row of the first frame and fill the columns
+    of frames without a match (within tolerance) with NaN. This lets 1 Hz GPS
+    fixes line up with 100 Hz MPU rows. With interpolate=True the numeric columns
+    of the other frames are instead linearly interpolated at the first frame's
+    timestamps. The numeric columns of the result are float64 and share one
+    contiguous block.
+
+    Columns that appear in several frames keep their name for the first frame
+    and get a "_<i>" suffix for frame i.
 
     Parameters
     ----------
     dfs : list
-        A list of dataframes to combine
-    
+        A list of dataframes to combine, the fastest stream first
+    how : str
+        The join method (see JOIN_METHODS)
+    tolerance : float, optional
+        The largest time difference allowed for a match
+    interpolate : bool
+        Whether or not to interpolate the other frames instead of picking rows
+    on : str
+        The time column
+    as_array : bool
+        Whether or not to return the numeric columns as one contiguous float array
+
     Returns
     -------
-    pd.DataFrame
-        The combined dataframe
+    pd.DataFrame, or (list, ndarray) if as_array
+        The combined dataframe, or its numeric column names and a C-contiguous array of shape
+        (columns, rows), the (m,N) layout KalmanFilter.estimate expects
     """
-    df = dfs[0]
-    for i in range(1, len(dfs)):
-        # merge the dataframes on timestamp
-        df = pd.merge(df, dfs[i], on="timestamp")
+    if how not in JOIN_METHODS:
+        raise ValueError(f"Unknown join method: {how}")
+    if how == "merge":
+        df = dfs[0]
+        for i in range(1, len(dfs)):
+            # merge the dataframes on timestamp
+            df = pd.merge(df, dfs[i], on=on)
+        if as_array:
+            num = list(df.select_dtypes("number").columns)
+            return num, np.ascontiguousarray(df[num].to_numpy(dtype=float).T)
+        return df
+
+    dfs = [_sorted_by(df, on) for df in dfs]
+    base = dfs[0][on].to_numpy(dtype=float)
+
+    # match every other frame against the base timestamps in one pass each
+    matches = [None] * len(dfs)
+    rows = np.arange(len(base))
+    if how == "exact":
+        # smallest frames first, so every later search only looks up the surviving rows
+        for i in sorted(range(1, len(dfs)), key=lambda i: len(dfs[i])):
+            idx = _match_times(base[rows], dfs[i][on].to_numpy(dtype=float), "exact")
+            rows = rows[idx >= 0]
+            if not interpolate:
+                matches[i] = np.full(len(base), -1)
+                matches[i][rows] = idx[idx >= 0]
+    elif not interpolate:
+        for i in range(1, len(dfs)):
+            matches[i] = _match_times(base, dfs[i][on].to_numpy(dtype=float), how, tolerance)
+
+    # name the output columns; numeric columns go into one float block, others are picked row by row
+    names = []
+    seen = {on}
+    for i, df in enumerate(dfs):
+        cols = [col for col in df.columns if col != on or i == 0]
+        if as_array or (interpolate and i > 0):
+            cols = [col for col in cols if pd.api.types.is_numeric_dtype(df[col])]
+        names.append([(col, col if col not in seen or (i == 0 and col == on) else f"{col}_{i}",
+                       pd.api.types.is_numeric_dtype(df[col])) for col in cols])
+        seen.update(cols)
+
+    # fill the block straight from the sorted arrays, one contiguous row per column
+    numeric = [[col for col, _, num in n if num] for n in names]
+    block = np.empty((sum(len(cols) for cols in numeric), len(rows)))
+    c = 0
+    for i, df in enumerate(dfs):
+        _fill_block(block[c:c + len(numeric[i])], df, numeric[i], base[rows], rows, matches[i], on,
+                    interpolate and i > 0, tolerance)
+        c += len(numeric[i])
+    if as_array:
+        return [new for n in names for _, new, _ in n], block
+
+    df = pd.DataFrame(block.T, columns=[new for n in names for _, new, num in n if num], copy=False)
+    position = 0
+    for i, n in enumerate(names):
+        for col, new, num in n:
+            if not num:
+                values = dfs[i][col].to_numpy()
+                if i == 0:
+                    column = values[rows]
+                else:
+                    idx = matches[i][rows]
+                    column = values[np.maximum(idx, 0)].astype(object)
+                    column[idx < 0] = np.nan
+                df.insert(position, new, column)
+            position += 1
     return df
 
 
+def _fill_block(out, df, cols, base, rows, idx, on, interpolate, tolerance):
+    """
+    Write the given columns of one frame, aligned with the joined rows, into the rows of out
+    """
+    columns = [df[col].to_numpy(dtype=float) for col in cols]
+    if interpolate:
+        _interpolate_into(out, base, df[on].to_numpy(dtype=float), columns, tolerance)
+        return
+    if idx is None:
+        take = None if len(rows) == len(df) else rows
+    else:
+        idx = idx[rows]
+        take = np.maximum(idx, 0)
+        if len(take) and take[-1] - take[0] == len(take) - 1 and (np.diff(take) == 1).all():
+            # streams sampled together line up as one run of rows, so copy a slice instead of gathering
+            take = slice(take[0], take[-1] + 1)
+    for k, values in enumerate(columns):
+        if take is None:
+            out[k] = values
+        elif isinstance(take, slice):
+            out[k] = values[take]
+        else:
+            np.take(values, take, out=out[k])
+    if idx is not None and (idx < 0).any():
+        out[:, idx < 0] = np.nan
+
+
+
+def iter_csv_observations(path, columns, chunksize=10000, dropna=True):
+    """
+    Read observation columns from a csv file in fixed-size chunks
+
+    Parameters
+    ----------
+    path : str
+        The csv file to read
+    columns : list
+        The columns to read, in the order of the observation vector
+    chunksize : int
+        The number of rows per chunk
+    dropna : bool
+        Whether or not to drop rows with missing values (as the clean_* functions do)
+
+    Yields
+    ------
+    ndarray of shape (len(columns), c)
+        The next chunk of observations (each column is an observation)
+    """
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+        if dropna:
+            chunk = chunk.dropna()
+        yield chunk[columns].to_numpy(dtype=float).T
+
+
 
 def ohe_to_label(df_in, classes, df_out, class_name):
     """
@@ -165,18 +387,443 @@ def ohe_to_label(df_in, classes, df_out, class_name):
     -------
     pd.DataFrame - The output dataframe
     """
-    conditions = []
-    for r in classes:
-        # create a condition for each class
-        conditions.append(df_in[r] == 1)
-
-    # create a list of the classes
-    df_out[class_name] = np.select(conditions, classes)
+    # pick the first set class of every row in one argmax pass ("0" where none is set, as np.select did)
+    onehot = df_in[classes].to_numpy() == 1
+    labels = np.asarray(classes)[onehot.argmax(axis=1)]
+    df_out[class_name] = np.where(onehot.any(axis=1), labels, "0")
     return df_out
 
 
 
-def load_data(parent=".data", exclude_test=[], exclude_val=[], verbose=False):
+# the one hot label columns of dataset_labels.csv, by group
+LABEL_GROUPS = {"condition": ['paved_road', 'unpaved_road'],
+                "road": ['dirt_road', 'cobblestone_road', 'asphalt_road'],
+                "bumps": ['no_speed_bump', 'speed_bump_asphalt', 'speed_bump_cobblestone'],
+                "quality_left": ['good_road_left', 'regular_road_left', 'bad_road_left'],
+                "quality_right": ['good_road_right', 'regular_road_right', 'bad_road_right']}
+
+
+
+class LabelCodec(object):
+    def __init__(self, groups=LABEL_GROUPS):
+        """
+        Decode the one hot label columns into one small code per group, and
+        compress the codes into run length encoded segments.
+        A code is the index of the class within its group, or -1 if no class
+        of the group is set.
+
+        Parameters
+        ----------
+        groups : dict
+            Maps each group name to its list of one hot columns
+        """
+        self.groups = groups
+        self.names = list(groups)
+        self.columns = [col for classes in groups.values() for col in classes]
+
+        # padded (group, slot) -> column map; empty slots read an all zero column
+        width = max(len(classes) for classes in groups.values())
+        self._slots = np.full((len(groups), width), len(self.columns))
+        for g, classes in enumerate(groups.values()):
+            self._slots[g, :len(classes)] = [self.columns.index(col) for col in classes]
+
+        # where every class lives
+        self.lookup = {col: (name, i) for name, classes in groups.items() for i, col in enumerate(classes)}
+
+
+    def codes(self, df):
+        """
+        Decode every group at once
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            The one hot label columns (any integer dtype, uint8 is cheapest)
+
+        Returns
+        -------
+        ndarray of shape (rows, groups), dtype int8
+            The class code of each group for each row
+        """
+        onehot = np.zeros((len(df), len(self.columns) + 1), dtype=np.uint8)
+        onehot[:, :-1] = df[self.columns].to_numpy()
+        padded = onehot[:, self._slots]                  # (rows, groups, width)
+        codes = padded.argmax(axis=2).astype(np.int8)
+        codes[padded.max(axis=2) == 0] = -1
+        return codes
+
+
+    def encode(self, df):
+        """
+        Replace the one hot columns with one categorical column per group
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            The one hot label columns
+
+        Returns
+        -------
+        pd.DataFrame
+            One categorical column per group, stored as int8 codes (missing labels are NaN)
+        """
+        codes = self.codes(df)
+        return pd.DataFrame({name: pd.Categorical.from_codes(codes[:, g], self.groups[name])
+                             for g, name in enumerate(self.names)}, index=df.index)
+
+
+    def decode(self, codes):
+        """
+        Turn codes back into the one hot label columns
+
+        Parameters
+        ----------
+        codes : ndarray of shape (rows, groups)
+            The class codes
+
+        Returns
+        -------
+        pd.DataFrame
+            The one hot columns as uint8
+        """
+        onehot = np.zeros((len(codes), len(self.columns) + 1), dtype=np.uint8)
+        rows = np.arange(len(codes))
+        for g in range(len(self.names)):
+            cols = np.where(codes[:, g] >= 0, self._slots[g][codes[:, g]], len(self.columns))
+            onehot[rows, cols] = 1
+        return pd.DataFrame(onehot[:, :-1], columns=self.columns)
+
+
+    def segments(self, codes):
+        """
+        Run length encode the codes of every group
+
+        Parameters
+        ----------
+        codes : ndarray of shape (rows, groups)
+            The class codes
+
+        Returns
+        -------
+        dict
+            Maps each group to a tuple (starts, values): the first row and the code of every run.
+            The total number of rows is stored under "rows".
+        """
+        segs = {"rows": len(codes)}
+        for g, name in enumerate(self.names):
+            column = codes[:, g]
+            # a run starts wherever the code changes (and at row 0)
+            change = np.ones(len(column), dtype=bool)
+            change[1:] = column[1:] != column[:-1]
+            starts = np.flatnonzero(change)
+            segs[name] = (starts, column[starts])
+        return segs
+
+
+    def expand(self, segs):
+        """
+        Undo segments
+
+        Parameters
+        ----------
+        segs : dict
+            The output of segments
+
+        Returns
+        -------
+        ndarray of shape (rows, groups), dtype int8
+            The class codes
+        """
+        codes = np.empty((segs["rows"], len(self.names)), dtype=np.int8)
+        for g, name in enumerate(self.names):
+            starts, values = segs[name]
+            codes[:, g] = np.repeat(values, np.diff(np.append(starts, segs["rows"])))
+        return codes
+
+
+    def ranges(self, segs, label):
+        """
+        Find the rows with a given class in O(segments)
+
+        Parameters
+        ----------
+        segs : dict
+            The output of segments
+        label : str
+            A one hot column name, e.g. "bad_road_left"
+
+        Returns
+        -------
+        ndarray of shape (k,2)
+            The [start, end) row range of every run of that class
+        """
+        name, code = self.lookup[label]
+        starts, values = segs[name]
+        ends = np.append(starts[1:], segs["rows"])
+        hit = values == code
+        return np.stack([starts[hit], ends[hit]], axis=1)
+
+
+    def indices(self, segs, label):
+        """
+        All the row indices with a given class (see ranges)
+        """
+        r = self.ranges(segs, label)
+        if len(r) == 0:
+            return np.zeros(0, dtype=int)
+        lengths = r[:, 1] - r[:, 0]
+        # each run counts up from its start
+        return np.repeat(r[:, 0] - np.cumsum(np.append(0, lengths[:-1])), lengths) + np.arange(lengths.sum())
+
+
+
+# bump whenever the cleaning or the cache layout changes, to invalidate old entries
+CACHE_VERSION = 1
+
+
+
+def clean_frame(file_type, df):
+    """
+    Clean one dataframe the way clean_dict does for its file type
+
+    Parameters
+    ----------
+    file_type : str
+        The file type key, e.g. "t_gps" or "gps_mpu_left"
+    df : pd.DataFrame
+        The raw data
+
+    Returns
+    -------
+    pd.DataFrame
+        The cleaned data (labels are returned unchanged)
+    """
+    if "left" in file_type or "right" in file_type:
+        return clean_acc(df)
+    elif "t_gps" in file_type:
+        return clean_gps(df)
+    return df
+
+
+
+def _cache_key(path, params):
+    """
+    Build the cache key of a source file from its size, mtime and the loading parameters
+    """
+    stat = os.stat(path)
+    return {"source": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "params": params, "version": CACHE_VERSION}
+
+
+
+def write_columnar(entry, key, df, fmt="npy"):
+    """
+    Write df to a columnar cache entry directory. Every column goes to its own
+    .npy file (or the frame to one parquet file), together with the index and a
+    meta.json holding the key. The entry is written to a temporary directory
+    first and renamed into place, so an interrupted write never leaves a
+    valid-looking entry.
+
+    Parameters
+    ----------
+    entry : str
+        The entry directory
+    key :
+        Anything JSON serializable identifying the content (see read_columnar)
+    df : pd.DataFrame
+        The frame to store
+    fmt : str
+        "npy" (one memory mappable file per column) or "parquet"
+    """
+    tmp = entry + ".tmp"
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    meta = {"key": key, "format": fmt, "columns": [str(c) for c in df.columns]}
+    if fmt == "parquet":
+        df.to_parquet(os.path.join(tmp, "data.parquet"))
+    else:
+        np.save(os.path.join(tmp, "index.npy"), df.index.to_numpy())
+        for i, col in enumerate(df.columns):
+            values = df[col].to_numpy()
+            if values.dtype == object:
+                # plain strings can be stored fixed width and memory mapped
+                if all(isinstance(v, str) for v in values):
+                    values = values.astype(str)
+            np.save(os.path.join(tmp, f"col_{i}.npy"), values, allow_pickle=values.dtype == object)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    if os.path.isdir(entry):
+        shutil.rmtree(entry)
+    os.replace(tmp, entry)
+
+
+
+def read_columnar(entry, key, mmap=True):
+    """
+    Read a columnar cache entry (see write_columnar)
+
+    Parameters
+    ----------
+    entry : str
+        The entry directory
+    key :
+        The key the entry must have been written with
+    mmap : bool
+        Whether or not to memory map the columns (copy-on-write)
+
+    Returns
+    -------
+    pd.DataFrame or None
+        The frame, or None if the entry is missing or its key does not match
+    """
+    try:
+        with open(os.path.join(entry, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta["key"] != key:
+        return None
+
+    if meta["format"] == "parquet":
+        return pd.read_parquet(os.path.join(entry, "data.parquet"), memory_map=mmap)
+
+    # copy-on-write maps: writes to the frame stay in memory and never reach the entry.
+    # np.asarray keeps the map but drops the np.memmap subclass, so the frame
+    # holds plain arrays like a parsed one.
+    mode = "c" if mmap else None
+    index = np.asarray(np.load(os.path.join(entry, "index.npy"), mmap_mode=mode))
+    cols = {}
+    for i, col in enumerate(meta["columns"]):
+        path = os.path.join(entry, f"col_{i}.npy")
+        try:
+            cols[col] = np.asarray(np.load(path, mmap_mode=mode))
+        except ValueError:
+            # object columns cannot be memory mapped
+            cols[col] = np.load(path, allow_pickle=True)
+    return pd.DataFrame(cols, index=pd.Index(index), columns=meta["columns"], copy=False)
+
+
+
+def read_csv_cached(path, file_type, folder, cache_dir=None, clean=False, mmap=True, fmt="npy", **read_kwargs):
+    """
+    Read (and optionally clean) one PVS csv file through the columnar cache.
+
+    The cache holds one entry per folder, file type and source file under cache_dir. An entry is
+    reused only if the source file's size and modification time and all of the
+    loading parameters match; otherwise the csv is parsed again and the entry is
+    rewritten. With cache_dir=None the csv is always parsed.
+
+    Parameters
+    ----------
+    path : str
+        The csv file
+    file_type : str
+        The file type key, e.g. "t_gps"
+    folder : str
+        The PVS folder the file belongs to
+    cache_dir : str, optional
+        The cache directory
+    clean : bool
+        Whether or not to clean the data with clean_frame before caching it
+    mmap : bool
+        Whether or not to memory map cached columns. The maps are copy-on-write,
+        so the frame can be modified like a parsed one; pages are only read
+        when touched and writes never change the cache entry.
+    fmt : str
+        "npy" for one .npy file per column, or "parquet" (needs pyarrow)
+    read_kwargs :
+        Passed to pd.read_csv and included in the cache key
+
+    Returns
+    -------
+    pd.DataFrame
+        The loaded data
+    """
+    if cache_dir is None:
+        data = pd.read_csv(path, **read_kwargs)
+        return clean_frame(file_type, data) if clean else data
+
+    params = {"clean": clean, "fmt": fmt, "read_kwargs": repr(sorted(read_kwargs.items()))}
+    key = _cache_key(path, params)
+    entry = os.path.join(cache_dir, folder, file_type + "-" + os.path.splitext(os.path.basename(path))[0])
+    data = read_columnar(entry, key, mmap=mmap)
+    if data is None:
+        data = pd.read_csv(path, **read_kwargs)
+        if clean:
+            data = clean_frame(file_type, data)
+        write_columnar(entry, key, data, fmt=fmt)
+        data = read_columnar(entry, key, mmap=mmap)
+    return data
+
+
+
+def match_file_type(name):
+    """
+    Decide which file type a csv file holds
+
+    Names ending in "<file_type>.csv" are matched exactly (so dataset_gps_mpu_left.csv is
+    gps_mpu_left and not t_gps); otherwise the first file type contained in the name is used.
+
+    Parameters
+    ----------
+    name : str
+        The file name
+
+    Returns
+    -------
+    str or None
+        The file type, or None if the file is not part of the dataset
+    """
+    for file_type in FILE_TYPES:
+        if name.endswith(file_type + ".csv"):
+            return file_type
+    for file_type in FILE_TYPES:
+        if file_type in name:
+            return file_type
+    return None
+
+
+
+def compact_read_kwargs(path, file_type):
+    """
+    Build pd.read_csv arguments that skip the columns cleaning would drop and use compact dtypes:
+    uint8 for the one-hot labels, float64 for FLOAT64_COLS and float32 for every other numeric channel.
+
+    Parameters
+    ----------
+    path : str
+        The csv file (only its first rows are read)
+    file_type : str
+        The file type key
+
+    Returns
+    -------
+    dict
+        Keyword arguments for pd.read_csv (explicit lists, so they are stable cache keys)
+    """
+    # a short sample gives the header and tells numeric columns from text ones
+    sample = pd.read_csv(path, nrows=100)
+    header = list(sample.columns)
+    if file_type == "labels":
+        return {"dtype": {col: np.uint8 for col in header}}
+
+    if file_type == "t_gps":
+        usecols = [col for col in header if col not in GPS_DROP_COLS]
+    else:
+        usecols = [col for col in header if not acc_drops(col)]
+
+    dtype = {col: (np.float64 if col in FLOAT64_COLS else np.float32)
+             for col in usecols if pd.api.types.is_numeric_dtype(sample[col])}
+    return {"usecols": usecols, "dtype": dtype}
+
+
+
+@instrument.timed("load_data", rows=instrument.frame_rows)
+def load_data(parent=".data", exclude_test=[], exclude_val=[], verbose=False, cache_dir=None, clean=False, mmap=True,
+              compact=False, workers=None):
     """
     Load all data from the given parent directory. The data is expected to be in the following format:
     parent
@@ -210,22 +857,28 @@ def load_data(parent=".data", exclude_test=[], exclude_val=[], verbose=False):
 
     The function will also exclude any folders that are in the exclude_test or exclude_val lists. 
     If verbose is set to True, the function will print out which files are being loaded into which data set.
+    If cache_dir is given, every file is read through the columnar cache (see read_csv_cached), so only
+    the first load of a file parses the csv.
+    With compact=True the columns that cleaning drops are never parsed and the remaining columns get
+    compact dtypes (see compact_read_kwargs). With workers > 1 the files are read by a thread pool.
 
     Parameters:
     parent (str): The parent directory of the data
     exclude_test (list): A list of folders to exclude from the test data
     exclude_val (list): A list of folders to exclude from the validation data
     verbose (bool): Whether or not to print out verbose information
+    cache_dir (str): The columnar cache directory, or None to always parse the csv files
+    clean (bool): Whether or not to clean every file as clean_dict would (and cache the cleaned data)
+    mmap (bool): Whether or not to memory map cached columns
+    compact (bool): Whether or not to prune dropped columns and use float32/uint8 dtypes
+    workers (int): The number of threads reading files, or None to read them one at a time
 
     Returns:
     dict: A dictionary of dataframes in the format described above
     """
     # initialize data dictionary variables
-    csvs = {"t_gps": None,
-            "gps_mpu_left": None,
-            "gps_mpu_right": None,
-            "labels": None,
-            "folders": None}
+    csvs = {file_type: None for file_type in FILE_TYPES}
+    csvs["folders"] = None
     folders = os.listdir(parent)
     data_dict = {"train": csvs.copy(), "val": csvs.copy(), "test": csvs.copy()}
 
@@ -234,37 +887,50 @@ def load_data(parent=".data", exclude_test=[], exclude_val=[], verbose=False):
     data_dict["test"]["folders"] = exclude_test
     data_dict["train"]["folders"] = [f for f in folders if f not in exclude_test and f not in exclude_val]
 
-    # iterate through all folders
+    # decide which files to load and where they go
+    tasks = []
     for dir in folders:
         if 'PVS' in dir:
             path = os.path.join(parent, dir)
-            curr_csv = os.listdir(path)
-
-            # decide which chain and which type of information
-            for name in curr_csv:
-                for file_type in csvs.keys():
-                    if file_type in name:
-
-                        # load data
-                        data = pd.read_csv(os.path.join(path, name))
-
-                        # decide which train grouping
-                        t_type = "train"
-                        if dir in exclude_test:
-                            t_type = "test"
-                        elif dir in exclude_val:
-                            t_type = "val"                        
-
-                        # add to data in appropriate location
-                        if data_dict[t_type][file_type] == None:
-                            data_dict[t_type][file_type] = {dir: data}
-                        elif dir in data_dict[t_type][file_type].keys():
-                            continue
-                        else:
-                            data_dict[t_type][file_type][dir] = data
-                        
-                        # print out verbose information
-                        if verbose:
-                            print(f"Loaded {name} from {dir} into {t_type} data")
+
+            # decide which train grouping
+            t_type = "train"
+            if dir in exclude_test:
+                t_type = "test"
+            elif dir in exclude_val:
+                t_type = "val"
+
+            # decide which type of information each file holds (the first file of a type wins)
+            seen = set()
+            for name in os.listdir(path):
+                file_type = match_file_type(name)
+                if file_type is not None and file_type not in seen:
+                    seen.add(file_type)
+                    tasks.append((t_type, file_type, dir, os.path.join(path, name)))
+
+    def read(task):
+        t_type, file_type, dir, file_path = task
+        with instrument.span("load_data.read", folder=dir, file_type=file_type) as s:
+            kwargs = compact_read_kwargs(file_path, file_type) if compact else {}
+            df = read_csv_cached(file_path, file_type, dir, cache_dir=cache_dir, clean=clean, mmap=mmap, **kwargs)
+            s.set(rows=len(df))
+        return df
+
+    # load data, concurrently if asked to
+    if workers is not None and workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            frames = list(pool.map(read, tasks))
+    else:
+        frames = map(read, tasks)
+
+    # add to data in appropriate location
+    for (t_type, file_type, dir, file_path), data in zip(tasks, frames):
+        if data_dict[t_type][file_type] is None:
+            data_dict[t_type][file_type] = {}
+        data_dict[t_type][file_type][dir] = data
+
+        # print out verbose information
+        if verbose:
+            print(f"Loaded {os.path.basename(file_path)} from {dir} into {t_type} data")
 
     return data_dict
\ No newline at end of file
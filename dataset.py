@@ -0,0 +1,437 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import cleaner
+import filter
+import instrument
+
+
+# the splits of load_data, in the order their folders are stored
+SPLITS = ["train", "val", "test"]
+
+
+
+class Stream(object):
+    def __init__(self, folders, offsets, columns, data, wide_columns=(), wide=None, text=None):
+        """
+        One file type of every folder, stored as contiguous arrays instead of one
+        DataFrame per folder. Folder i owns the rows offsets[i]:offsets[i+1].
+
+        Numeric channels live in one (C,N) block, one contiguous row per column,
+        so the channels of a folder are a view data[:, start:stop] and adjacent
+        columns form an (m,n) observation matrix without copying. Columns that
+        need the precision (cleaner.FLOAT64_COLS) are kept in a float64 block
+        and text columns as object arrays.
+
+        Parameters
+        ----------
+        folders : list of str
+            The PVS folders, in storage order
+        offsets : ndarray of shape (len(folders)+1,)
+            The first row of every folder, followed by the total number of rows
+        columns : list of str
+            The columns of data
+        data : ndarray of shape (len(columns),N)
+            The numeric channels (float32 or float64)
+        wide_columns : list of str
+            The columns of wide
+        wide : ndarray of shape (len(wide_columns),N), optional
+            The float64 channels
+        text : dict, optional
+            Maps a column name to an object ndarray of shape (N,)
+        """
+        self.folders = list(folders)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.columns = list(columns)
+        self.data = data
+        self.wide_columns = list(wide_columns)
+        self.wide = np.zeros((0, self.offsets[-1])) if wide is None else wide
+        self.text = text or {}
+
+
+    @classmethod
+    def from_frames(cls, frames, dtype=np.float32):
+        """
+        Pack one DataFrame per folder into a Stream
+
+        Parameters
+        ----------
+        frames : dict
+            Maps each folder to its DataFrame (in storage order)
+        dtype : numpy dtype
+            The dtype of the numeric channels other than cleaner.FLOAT64_COLS
+            (unless every channel is an integer, like the one-hot labels)
+
+        Returns
+        -------
+        Stream
+        """
+        folders = list(frames)
+        offsets = np.zeros(len(folders) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(frames[f]) for f in folders])
+
+        # the union of the columns, in the order they are first seen
+        columns, wide_columns, text_columns = [], [], []
+        for df in frames.values():
+            for col in df.columns:
+                if col in columns or col in wide_columns or col in text_columns:
+                    continue
+                if not pd.api.types.is_numeric_dtype(df[col]):
+                    text_columns.append(col)
+                elif col in cleaner.FLOAT64_COLS:
+                    wide_columns.append(col)
+                else:
+                    columns.append(col)
+
+        # integer channels (the one-hot labels) keep their own dtype
+        kinds = [df[col].dtype for df in frames.values() for col in df.columns if col in columns]
+        if kinds and all(pd.api.types.is_integer_dtype(k) for k in kinds):
+            dtype = np.result_type(*kinds)
+
+        # fill column by column so every write is contiguous
+        data = np.full((len(columns), offsets[-1]), 0 if np.issubdtype(dtype, np.integer) else np.nan, dtype=dtype)
+        wide = np.full((len(wide_columns), offsets[-1]), np.nan)
+        text = {col: np.full(offsets[-1], None, dtype=object) for col in text_columns}
+        for i, f in enumerate(folders):
+            rows = slice(offsets[i], offsets[i + 1])
+            for block, names in ((data, columns), (wide, wide_columns)):
+                for j, col in enumerate(names):
+                    if col in frames[f].columns:
+                        block[j, rows] = frames[f][col].to_numpy()
+            for col in text_columns:
+                if col in frames[f].columns:
+                    text[col][rows] = frames[f][col].to_numpy(dtype=object)
+        return cls(folders, offsets, columns, data, wide_columns, wide, text)
+
+
+    @classmethod
+    def concat(cls, streams):
+        """
+        Join Streams of disjoint folders (with the same columns) into one
+        """
+        first = streams[0]
+        offsets = np.concatenate([[0], np.cumsum([len(s) for s in streams])])
+        folder_offsets = np.concatenate([[0]] + [s.offsets[1:] + start for s, start in zip(streams, offsets[:-1])])
+        return cls([f for s in streams for f in s.folders], folder_offsets, first.columns,
+                   np.concatenate([s.data for s in streams], axis=1), first.wide_columns,
+                   np.concatenate([s.wide for s in streams], axis=1),
+                   {col: np.concatenate([s.text[col] for s in streams]) for col in first.text})
+
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+
+    @property
+    def nbytes(self):
+        """
+        The memory held by the arrays
+        """
+        return self.data.nbytes + self.wide.nbytes + sum(a.nbytes for a in self.text.values()) + self.offsets.nbytes
+
+
+    def rows(self, folder):
+        """
+        The slice of rows of a folder
+        """
+        i = self.folders.index(folder)
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+
+    def column(self, name, folder=None):
+        """
+        One column (of one folder, or of every folder), as a view
+        """
+        rows = slice(None) if folder is None else self.rows(folder)
+        if name in self.text:
+            return self.text[name][rows]
+        if name in self.wide_columns:
+            return self.wide[self.wide_columns.index(name), rows]
+        return self.data[self.columns.index(name), rows]
+
+
+    def observations(self, columns, folder=None):
+        """
+        An (m,n) observation matrix, as KalmanFilter.estimate expects
+
+        It is a view of the data block (no copy) whenever the columns are
+        adjacent and in block order, e.g. the columns added by one add_columns
+        call; otherwise the rows are gathered into a new array.
+
+        Parameters
+        ----------
+        columns : list of str
+            The observed columns, in observation vector order
+        folder : str, optional
+            The folder (every folder if not given)
+
+        Returns
+        -------
+        ndarray of shape (len(columns),n)
+        """
+        rows = slice(None) if folder is None else self.rows(folder)
+        for names, block in ((self.columns, self.data), (self.wide_columns, self.wide)):
+            if all(col in names for col in columns):
+                idx = [names.index(col) for col in columns]
+                if idx == list(range(idx[0], idx[0] + len(idx))):
+                    return block[idx[0]:idx[-1] + 1, rows]
+                return block[idx, rows]
+        return np.stack([self.column(col, folder) for col in columns])
+
+
+    def frame(self, folder=None):
+        """
+        A DataFrame over the arrays (the columns are views where pandas allows it)
+        """
+        rows = slice(None) if folder is None else self.rows(folder)
+        cols = {}
+        for names, block in ((self.columns, self.data), (self.wide_columns, self.wide)):
+            for j, col in enumerate(names):
+                cols[col] = block[j, rows]
+        for col, values in self.text.items():
+            cols[col] = values[rows]
+        return pd.DataFrame(cols, copy=False)
+
+
+    def select(self, folders):
+        """
+        The Stream of some of the folders. When they are stored next to each
+        other, in order, the result is a view of this Stream's arrays.
+        """
+        idx = [self.folders.index(f) for f in folders]
+        if not idx:
+            return Stream([], [0], self.columns, self.data[:, :0], self.wide_columns, self.wide[:, :0],
+                          {col: values[:0] for col, values in self.text.items()})
+        if idx == list(range(idx[0], idx[0] + len(idx))):
+            start, stop = self.offsets[idx[0]], self.offsets[idx[-1] + 1]
+            return Stream(folders, self.offsets[idx[0]:idx[-1] + 2] - start, self.columns, self.data[:, start:stop],
+                          self.wide_columns, self.wide[:, start:stop],
+                          {col: values[start:stop] for col, values in self.text.items()})
+        return Stream.concat([self.select([f]) for f in folders])
+
+
+    def add_columns(self, names, values):
+        """
+        Append columns to the data block (the block is reallocated, so views of it taken before stay on the old one)
+
+        Parameters
+        ----------
+        names : list of str
+            The new column names
+        values : ndarray of shape (len(names),N)
+            Their values, cast to the block dtype
+        """
+        for name in names:
+            if name in self.columns:
+                raise ValueError(f"Column {name} already exists")
+        self.data = np.concatenate([self.data, np.asarray(values, dtype=self.data.dtype).reshape(len(names), -1)])
+        self.columns = self.columns + list(names)
+
+
+
+class Dataset(object):
+    def __init__(self, streams, splits):
+        """
+        The whole dataset: a Stream per file type and the folders of every split.
+        The folders are stored split by split, so a split is a view of the arrays
+        (see split).
+
+        Parameters
+        ----------
+        streams : dict
+            Maps each file type to its Stream
+        splits : dict
+            Maps "train", "val" and "test" to their folders
+        """
+        self.streams = streams
+        self.splits = {name: list(splits.get(name, [])) for name in SPLITS}
+
+
+    @staticmethod
+    def _order(folders, exclude_test, exclude_val):
+        """
+        Assign folders to splits like load_data and sort them split by split
+        """
+        splits = {"train": [], "val": [], "test": []}
+        for f in sorted(folders):
+            if f in exclude_test:
+                splits["test"].append(f)
+            elif f in exclude_val:
+                splits["val"].append(f)
+            else:
+                splits["train"].append(f)
+        return splits
+
+
+    @classmethod
+    def from_dict(cls, ddict, dtype=np.float32):
+        """
+        Pack a load_data dictionary (cleaned or not) into a Dataset
+
+        Parameters
+        ----------
+        ddict : dict
+            The dictionary of cleaner.load_data
+        dtype : numpy dtype
+            The dtype of the numeric channels (see Stream.from_frames)
+
+        Returns
+        -------
+        Dataset
+        """
+        splits = {name: sorted({f for files in ddict[name].values() if isinstance(files, dict) for f in files})
+                  for name in SPLITS}
+        streams = {}
+        for file_type in cleaner.FILE_TYPES:
+            frames = {}
+            for name in SPLITS:
+                files = ddict[name].get(file_type)
+                for f in splits[name]:
+                    if files is not None and f in files:
+                        frames[f] = files[f]
+            if frames:
+                streams[file_type] = Stream.from_frames(frames, dtype=dtype)
+        return cls(streams, splits)
+
+
+    @classmethod
+    @instrument.timed("Dataset.load", rows=lambda ds: sum(len(s) for s in ds.streams.values()))
+    def load(cls, parent=".data", exclude_test=[], exclude_val=[], dtype=np.float32, clean=True, cache_dir=None,
+             verbose=False):
+        """
+        Load every PVS folder straight into a Dataset
+
+        Files are read one at a time with the compact loader (see
+        cleaner.compact_read_kwargs), cleaned and packed, so only one DataFrame
+        is alive at a time rather than the whole nested dictionary.
+
+        Parameters
+        ----------
+        parent : str
+            The dataset folder
+        exclude_test, exclude_val : list
+            The test and validation folders, as in load_data
+        dtype : numpy dtype
+            The dtype of the numeric channels
+        clean : bool
+            Whether or not to clean every file as clean_dict would
+        cache_dir : str, optional
+            The columnar cache of read_csv_cached
+        verbose : bool
+            Whether or not to print every file loaded
+
+        Returns
+        -------
+        Dataset
+        """
+        folders = [f for f in os.listdir(parent) if 'PVS' in f]
+        splits = cls._order(folders, exclude_test, exclude_val)
+        # decide which file holds each type in every folder (the first file of a type wins)
+        files = {}
+        for name in SPLITS:
+            for f in splits[name]:
+                path = os.path.join(parent, f)
+                for file_name in sorted(os.listdir(path)):
+                    file_type = cleaner.match_file_type(file_name)
+                    if file_type is not None:
+                        files.setdefault(file_type, {}).setdefault(f, (name, os.path.join(path, file_name)))
+
+        # pack one file type at a time, so the pieces of only one stream are alive next to the packed ones
+        streams = {}
+        for file_type in cleaner.FILE_TYPES:
+            pieces = []
+            for f, (name, file_path) in files.get(file_type, {}).items():
+                with instrument.span("Dataset.load.read", folder=f, file_type=file_type) as s:
+                    kwargs = cleaner.compact_read_kwargs(file_path, file_type)
+                    df = cleaner.read_csv_cached(file_path, file_type, f, cache_dir=cache_dir, clean=clean, **kwargs)
+                    pieces.append(Stream.from_frames({f: df}, dtype=dtype))
+                    s.set(rows=len(df))
+                if verbose:
+                    print(f"Loaded {os.path.basename(file_path)} from {f} into {name} data")
+            if pieces:
+                streams[file_type] = Stream.concat(pieces)
+        return cls(streams, splits)
+
+
+    def __getitem__(self, file_type):
+        return self.streams[file_type]
+
+
+    @property
+    def nbytes(self):
+        """
+        The memory held by the arrays of every stream
+        """
+        return sum(s.nbytes for s in self.streams.values())
+
+
+    def split(self, name):
+        """
+        The Dataset of one split ("train", "val" or "test"), as views of this one's arrays
+        """
+        folders = self.splits[name]
+        streams = {t: s.select([f for f in folders if f in s.folders]) for t, s in self.streams.items()}
+        return Dataset(streams, {name: folders})
+
+
+    def to_dict(self):
+        """
+        The nested dictionary of load_data, for code that still expects it.
+        The frames are built over the arrays (see Stream.frame).
+        """
+        ddict = {}
+        for name in SPLITS:
+            ddict[name] = {t: None for t in cleaner.FILE_TYPES}
+            for t, stream in self.streams.items():
+                folders = [f for f in self.splits[name] if f in stream.folders]
+                if folders:
+                    ddict[name][t] = {f: stream.frame(f) for f in folders}
+            ddict[name]["folders"] = list(self.splits[name])
+        return ddict
+
+
+    def add_smoothed_cols(self, window=100, windows=None):
+        """
+        Add the <col>_smooth (and <col>_smooth_<w>) channels of every accelerometer
+        column, like filter.add_smoothed_cols, smoothing each folder separately
+        """
+        extra = list(windows or [])
+        for t, stream in self.streams.items():
+            cols = [col for col in stream.columns if "acc_" in col and "_smooth" not in col]
+            if not cols:
+                continue
+            names = [col + "_smooth" for col in cols] + [col + f"_smooth_{w}" for w in extra for col in cols]
+            values = np.empty((len(names), len(stream)), dtype=stream.data.dtype)
+            for f in stream.folders:
+                rows = stream.rows(f)
+                with instrument.span("Dataset.add_smoothed_cols.folder", folder=f, file_type=t,
+                                     rows=rows.stop - rows.start):
+                    # smooth_bank wants (n,C); the transposed view avoids a copy
+                    bank = filter.smooth_bank(stream.observations(cols, f).T, [window] + extra)
+                    for k, w in enumerate([window] + extra):
+                        values[k * len(cols):(k + 1) * len(cols), rows] = bank[w][:rows.stop - rows.start].T
+            stream.add_columns(names, values)
+        return self
+
+
+    def add_lat_long_meters(self, method="vincenty", signed=False):
+        """
+        Add the lat_m and long_m channels, the offsets in meters from each folder's
+        first row (see filter.project_lat_long). Unlike filter.add_lat_long_meters
+        the last row of a folder is kept, since dropping rows would move the offsets.
+        """
+        for t, stream in self.streams.items():
+            if "latitude" not in stream.wide_columns:
+                continue
+            values = np.empty((2, len(stream)), dtype=stream.data.dtype)
+            for f in stream.folders:
+                rows = stream.rows(f)
+                with instrument.span("Dataset.add_lat_long_meters.folder", folder=f, file_type=t,
+                                     rows=rows.stop - rows.start):
+                    if rows.stop > rows.start:
+                        values[:, rows] = filter.project_lat_long(stream.column("latitude", f), stream.column("longitude", f),
+                                                                  method=method, signed=signed)
+            stream.add_columns(["lat_m", "long_m"], values)
+        return self
@@ -2,30 +2,196 @@ import numpy as np
 import pandas as pd
 from geopy.distance import geodesic
 
+import instrument
+
+def _padded_cumsum(data, pad_width):
+    """
+    Edge-pad data along axis 0 and return the cumulative sums of the column-centered result
+    (with a leading row of zeros) and the column means that were removed.
+    Centering keeps the running sums small so the O(N) smoother matches direct convolution closely.
+    """
+    pad = [(pad_width, pad_width)] + [(0, 0)] * (data.ndim - 1)
+    padded = np.pad(data, pad, mode='edge')
+    mean = padded.mean(axis=0)
+    csum = np.zeros((len(padded) + 1,) + padded.shape[1:])
+    np.cumsum(padded - mean, axis=0, out=csum[1:])
+    return csum, mean
+
+
+def _window_means(csum, mean, length, window, offset=0):
+    """
+    Compute np.convolve(x, np.ones(window)/window, mode='same') along axis 0 from running sums.
+    x is the slice of `length` rows starting at row `offset` of the array that csum and mean were built from.
+    """
+    i = np.arange(length)
+    hi = np.minimum(i + (window - 1) // 2, length - 1) + 1 + offset
+    lo = np.maximum(i + (window - 1) // 2 - window + 1, 0) + offset
+    counts = (hi - lo).reshape((-1,) + (1,) * (csum.ndim - 1))
+    return (csum[hi] - csum[lo] + counts * mean) / window
+
+
 def smooth(data, window=100, start_index=0):
     """
     Compute the moving average of a 1D array using a given window size.
+    The output matches the original edge-padded np.convolve implementation, but is
+    computed from cumulative sums in O(N) instead of O(N * window). 2D arrays are
+    smoothed along axis 0 (one column per channel) in a single pass.
 
     Parameters
     ----------
-    data : 1D array
+    data : 1D or 2D array
         The input data.
     window : int
         The size of the moving average window.
-    
+    start_index : int
+        The number of zeros to prepend to the output.
+
     Returns
     -------
-    1D array
+    1D or 2D array
         The smoothed data.
     """
-    pad_width = window // 2  # Number of values to pad on each side
-    padded_data = np.pad(data, (pad_width, pad_width), mode='edge')  # Pad using edge values
-    a = np.convolve(padded_data, np.ones(window)/window, mode='same')  # Use 'same' mode for convolution
-    return np.pad(a, (start_index, 0), 'constant', constant_values=(0, 0))
+    return smooth_bank(data, [window], start_index=start_index)[window]
+
+
+def smooth_bank(data, windows, start_index=0):
+    """
+    Compute smooth(data, window) for several window sizes from a single cumulative sum.
+
+    Parameters
+    ----------
+    data : 1D or 2D array
+        The input data.
+    windows : list of int
+        The window sizes.
+    start_index : int
+        The number of zeros to prepend to each output.
+
+    Returns
+    -------
+    dict
+        Maps each window size to its smoothed data.
+    """
+    data = np.asarray(data, dtype=float)
+    out = {}
+    if len(data) == 0 or np.isnan(data).any():
+        # missing values would spread through the running sums, so convolve directly
+        cols = data.reshape(len(data), -1).T
+        for w in windows:
+            pad_width = w // 2
+            a = np.stack([np.convolve(np.pad(c, (pad_width, pad_width), mode='edge'), np.ones(w)/w, mode='same')
+                          for c in cols], axis=-1)
+            out[w] = a.reshape(a.shape[:1] + data.shape[1:])
+    else:
+        # pad once for the widest window; narrower windows use an inner slice
+        max_pad = max(windows) // 2
+        csum, mean = _padded_cumsum(data, max_pad)
+        for w in windows:
+            pad_width = w // 2
+            out[w] = _window_means(csum, mean, len(data) + 2 * pad_width, w, offset=max_pad - pad_width)
+
+    pad = [(start_index, 0)] + [(0, 0)] * (data.ndim - 1)
+    return {w: np.pad(a, pad, 'constant', constant_values=0) for w, a in out.items()}
+
+
+class StreamingSmoother(object):
+    def __init__(self, window=100):
+        """
+        Causal moving average that can be fed one chunk at a time.
+        Each output is the mean of the last `window` inputs (or of all inputs so far
+        at the start of the stream). The last window-1 inputs are carried between
+        chunks, so the result does not depend on how the stream is chunked.
+
+        Parameters
+        ----------
+        window : int
+            The size of the moving average window.
+        """
+        self.window = window
+        self.tail = None
+        self.ref = None
+        self.seen = 0
+
+
+    def update(self, chunk):
+        """
+        Smooth the next chunk of the stream.
+
+        Parameters
+        ----------
+        chunk : 1D or 2D array
+            The next samples (rows are samples, columns are channels).
+
+        Returns
+        -------
+        1D or 2D array
+            The smoothed samples, the same shape as chunk.
+        """
+        chunk = np.asarray(chunk, dtype=float)
+        if len(chunk) == 0:
+            return chunk
+        if self.tail is None:
+            self.tail = chunk[:0]
+            self.ref = chunk.mean(axis=0)
+
+        # running sums over the carried tail and the new chunk
+        x = np.concatenate([self.tail, chunk])
+        csum = np.zeros((len(x) + 1,) + x.shape[1:])
+        np.cumsum(x - self.ref, axis=0, out=csum[1:])
+        hi = np.arange(len(self.tail), len(x)) + 1
+        lo = np.maximum(hi - self.window, 0)
+        counts = np.minimum(self.seen + np.arange(1, len(chunk) + 1), self.window)
+        counts = counts.reshape((-1,) + (1,) * (x.ndim - 1))
+        out = (csum[hi] - csum[lo]) / counts + self.ref
+
+        # carry the last window-1 samples
+        self.tail = x[max(len(x) - (self.window - 1), 0):]
+        self.seen += len(chunk)
+        return out
+
+
+
+def copy_dict(ddict):
+    """
+    Copy a data dictionary together with every DataFrame in it, so the copy can be modified freely
+
+    Parameters
+    ----------
+    ddict : dict
+        The data dictionary (see cleaner.load_data)
+
+    Returns
+    -------
+    dict
+        The copy
+    """
+    out = {}
+    for t_type in ddict:
+        out[t_type] = {}
+        for csvf, files in ddict[t_type].items():
+            if isinstance(files, dict):
+                out[t_type][csvf] = {dir: df.copy() for dir, df in files.items()}
+            elif isinstance(files, list):
+                out[t_type][csvf] = list(files)
+            else:
+                out[t_type][csvf] = files
+    return out
+
 
+def _smooth_frame(df, cols, window, extra):
+    """
+    Add the <col>_smooth (and <col>_smooth_<w>) columns to df
+    """
+    # smooth every accelerometer column for every window in one pass
+    bank = smooth_bank(df[cols].to_numpy(dtype=float), [window] + extra)
+    df[[col + "_smooth" for col in cols]] = bank[window][:len(df)]
+    for w in extra:
+        df[[col + f"_smooth_{w}" for col in cols]] = bank[w][:len(df)]
+    return df
 
 
-def add_smoothed_cols(ddict, window=100, verbose=False, inPlace=True):
+@instrument.timed("add_smoothed_cols", rows=instrument.frame_rows)
+def add_smoothed_cols(ddict, window=100, verbose=False, inPlace=True, windows=None, cache=None):
     """
     Create a new column for each accelerometer column in the data dictionary with the smoothed data.
 
@@ -38,7 +204,14 @@ def add_smoothed_cols(ddict, window=100, verbose=False, inPlace=True):
     verbose : bool
         Whether or not to print out the columns that are being added.
     inPlace : bool
-        Whether or not to modify the dictionary in place.
+        Whether or not to modify the dictionary in place. Otherwise the dictionary
+        and its DataFrames are copied first (see copy_dict).
+    windows : list of int, optional
+        Extra window sizes, computed in the same pass and added as <col>_smooth_<w>.
+    cache : stage_cache.StageCache, optional
+        Memoize the smoothed frames. Each folder is only smoothed if its data or
+        the windows changed, and the dictionary gets new (writable) frames
+        rather than modified ones.
 
     Returns
     -------
@@ -46,35 +219,246 @@ def add_smoothed_cols(ddict, window=100, verbose=False, inPlace=True):
         The modified data dictionary.
     """
     if not inPlace:
-        ddict = ddict.copy()
+        ddict = copy_dict(ddict)
+    extra = list(windows or [])
     for t_type in ddict:
-        for csvf in ddict[t_type]:
-            try:
-                for dir in ddict[t_type][csvf]:
-                    for col in ddict[t_type][csvf][dir].columns:
-                        if "acc_" in col:
-                            d = ddict[t_type][csvf][dir][col]
-                            ddict[t_type][csvf][dir][col + "_smooth"] = smooth(d, window=window)[:len(d)]
-                            if verbose:
-                                print("Added", col + "_smooth")
-            except TypeError:
+        for csvf, files in ddict[t_type].items():
+            # skip the folder lists and missing file types
+            if not isinstance(files, dict):
                 continue
+            for dir in files:
+                df = files[dir]
+                cols = [col for col in df.columns if "acc_" in col]
+                if not cols:
+                    continue
+
+                with instrument.span("add_smoothed_cols.folder", folder=dir, file_type=csvf, rows=len(df)):
+                    if cache is None:
+                        _smooth_frame(df, cols, window, extra)
+                    else:
+                        files[dir] = cache.run("add_smoothed_cols",
+                                               lambda: _smooth_frame(df.copy(), cols, window, extra), df,
+                                               {"window": window, "windows": extra})
+                if verbose:
+                    for col in cols:
+                        print("Added", col + "_smooth")
     return ddict
 
 
-def add_lat_long_meters(df):
-    # convert the coordinates to meters 
-    x_diffs = [geodesic((df['latitude'].iloc[0], df['longitude'].iloc[i]), (df['latitude'].iloc[i], df['longitude'].iloc[i])).meters for i in range(len(df)-1)]
-    x_diffs.append(None)
 
-    y_diffs = [geodesic((df['latitude'].iloc[i], df['longitude'].iloc[0]), (df['latitude'].iloc[i], df['longitude'].iloc[i])).meters for i in range(len(df)-1)]
-    y_diffs.append(None)
+# WGS84 ellipsoid (the one geopy's geodesic uses)
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+MEAN_RADIUS = 6371008.8
+
+# accuracy tiers for project_lat_long, from most to least accurate
+PROJECTION_METHODS = ["geodesic", "vincenty", "ellipsoid", "equirect"]
+
+
+def vincenty_distance(lat1, lon1, lat2, lon2, tol=1e-12, max_iter=200):
+    """
+    Compute the WGS84 geodesic distance between arrays of points with Vincenty's inverse formula.
+    Every pair is solved at once; the iteration stops when all pairs have converged.
+
+    Parameters
+    ----------
+    lat1, lon1, lat2, lon2 : array_like
+        The coordinates of the two points in degrees (broadcastable)
+    tol : float
+        Convergence tolerance on the auxiliary longitude in radians
+    max_iter : int
+        The maximum number of iterations
+
+    Returns
+    -------
+    ndarray
+        The distances in meters
+    """
+    a, b, f = WGS84_A, WGS84_B, WGS84_F
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2)))
+    L = lon2 - lon1
+    U1 = np.arctan((1 - f) * np.tan(lat1))
+    U2 = np.arctan((1 - f) * np.tan(lat2))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L
+    for _ in range(max_iter):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.hypot(cosU2 * sin_lam, cosU1 * sinU2 - sinU1 * cosU2 * cos_lam)
+        cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+
+        # coincident points and equatorial lines need guarded divisions
+        safe_sin = np.where(sin_sigma == 0, 1, sin_sigma)
+        sin_alpha = np.where(sin_sigma == 0, 0, cosU1 * cosU2 * sin_lam / safe_sin)
+        cos2_alpha = 1 - sin_alpha ** 2
+        safe_cos2 = np.where(cos2_alpha == 0, 1, cos2_alpha)
+        cos_2sm = np.where(cos2_alpha == 0, 0, cos_sigma - 2 * sinU1 * sinU2 / safe_cos2)
+
+        C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+        lam_prev = lam
+        lam = L + (1 - C) * f * sin_alpha * (sigma + C * sin_sigma * (cos_2sm + C * cos_sigma * (-1 + 2 * cos_2sm ** 2)))
+        if np.all(np.abs(lam - lam_prev) < tol):
+            break
+
+    u2 = cos2_alpha * (a ** 2 - b ** 2) / b ** 2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    d_sigma = B * sin_sigma * (cos_2sm + B / 4 * (cos_sigma * (-1 + 2 * cos_2sm ** 2)
+                               - B / 6 * cos_2sm * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sm ** 2)))
+    return b * A * (sigma - d_sigma)
+
+
+def meridian_arc(lat):
+    """
+    Compute the WGS84 meridian arc length from the equator to the given latitudes
+
+    Parameters
+    ----------
+    lat : array_like
+        The latitudes in degrees
+
+    Returns
+    -------
+    ndarray
+        The signed arc lengths in meters
+    """
+    phi = np.radians(np.asarray(lat, dtype=float))
+    n = WGS84_F / (2 - WGS84_F)
+    # Helmert's series in the third flattening, accurate to well under a millimeter
+    A = WGS84_A / (1 + n) * (1 + n ** 2 / 4 + n ** 4 / 64)
+    return A * (phi - (3 * n / 2 - 9 * n ** 3 / 16) * np.sin(2 * phi)
+                + (15 * n ** 2 / 16 - 15 * n ** 4 / 32) * np.sin(4 * phi)
+                - 35 * n ** 3 / 48 * np.sin(6 * phi)
+                + 315 * n ** 4 / 512 * np.sin(8 * phi))
+
+
+def project_lat_long(lat, lon, origin=None, method="vincenty", signed=False):
+    """
+    Convert coordinates to offsets in meters from an origin.
+    lat_m[i] is the distance from (lat0, lon[i]) to (lat[i], lon[i]) and long_m[i] the
+    distance from (lat[i], lon0) to (lat[i], lon[i]), as in add_lat_long_meters.
+
+    The accuracy tiers (see PROJECTION_METHODS) are
+    "geodesic": geopy's geodesic one row at a time (the reference, slow),
+    "vincenty": Vincenty's inverse formula over whole arrays (within a millimeter of geodesic),
+    "ellipsoid": exact WGS84 meridian arcs and parallel arcs (the east offset overestimates
+    the geodesic by about L^3 / (24 R^2) for an offset of L meters, under 1 mm at 10 km), and
+    "equirect": a sphere of mean radius (meters of error per kilometer of offset).
+    Use projection_error to measure the error of a tier on real data.
+
+    Parameters
+    ----------
+    lat, lon : array_like
+        The latitudes and longitudes in degrees
+    origin : tuple, optional
+        The (lat0, lon0) origin. Defaults to the first point.
+    method : str
+        The accuracy tier
+    signed : bool
+        Whether or not to give the offsets the sign of lat - lat0 and lon - lon0
+        (north and east positive). The default returns distances, like geodesic.
+
+    Returns
+    -------
+    lat_m, long_m : ndarray
+        The north-south and east-west offsets in meters
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    lat0, lon0 = (lat[0], lon[0]) if origin is None else origin
+
+    if method == "geodesic":
+        lat_m = np.array([geodesic((lat0, lon[i]), (lat[i], lon[i])).meters for i in range(len(lat))])
+        long_m = np.array([geodesic((lat[i], lon0), (lat[i], lon[i])).meters for i in range(len(lat))])
+    elif method == "vincenty":
+        lat_m = vincenty_distance(lat0, lon, lat, lon)
+        long_m = vincenty_distance(lat, lon0, lat, lon)
+    elif method == "ellipsoid":
+        phi = np.radians(lat)
+        e2 = WGS84_F * (2 - WGS84_F)
+        prime_vertical = WGS84_A / np.sqrt(1 - e2 * np.sin(phi) ** 2)
+        lat_m = np.abs(meridian_arc(lat) - meridian_arc(lat0))
+        long_m = prime_vertical * np.cos(phi) * np.abs(np.radians(lon - lon0))
+    elif method == "equirect":
+        lat_m = MEAN_RADIUS * np.abs(np.radians(lat - lat0))
+        long_m = MEAN_RADIUS * np.cos(np.radians(lat)) * np.abs(np.radians(lon - lon0))
+    else:
+        raise ValueError(f"Unknown projection method: {method}")
+
+    if signed:
+        lat_m = lat_m * np.sign(lat - lat0)
+        long_m = long_m * np.sign(lon - lon0)
+    return lat_m, long_m
+
+
+def projection_error(lat, lon, method, sample=1000, origin=None, seed=0):
+    """
+    Measure the error of a projection tier against geopy's geodesic on a random sample of points
+
+    Parameters
+    ----------
+    lat, lon : array_like
+        The latitudes and longitudes in degrees
+    method : str
+        The accuracy tier to check
+    sample : int
+        The number of points to compare (all points if there are fewer)
+    origin : tuple, optional
+        The (lat0, lon0) origin. Defaults to the first point.
+    seed : int
+        Seed for choosing the sample
+
+    Returns
+    -------
+    float
+        The largest absolute error in meters over both offsets
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    origin = (lat[0], lon[0]) if origin is None else origin
+    idx = np.random.default_rng(seed).choice(len(lat), size=min(sample, len(lat)), replace=False)
+    exact = project_lat_long(lat[idx], lon[idx], origin=origin, method="geodesic")
+    approx = project_lat_long(lat[idx], lon[idx], origin=origin, method=method)
+    return max(np.abs(exact[0] - approx[0]).max(), np.abs(exact[1] - approx[1]).max())
+
+
+def add_lat_long_meters(df, method="vincenty", signed=False):
+    """
+    Add lat_m and long_m columns with the offsets in meters from the first row.
+    As before, the last row is dropped together with any rows containing missing data.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The data with latitude and longitude columns, modified in place
+    method : str
+        The accuracy tier (see project_lat_long)
+    signed : bool
+        Whether or not to sign the offsets (see project_lat_long)
+    """
+    lat_m, long_m = project_lat_long(df['latitude'].to_numpy(), df['longitude'].to_numpy(),
+                                     method=method, signed=signed)
+    lat_m[-1:] = np.nan
+    long_m[-1:] = np.nan
 
-    df['lat_m'] = x_diffs
-    df['long_m'] = y_diffs
+    df['lat_m'] = lat_m
+    df['long_m'] = long_m
     df.dropna(inplace=True)
 
-def lat_long_meters(ddict, verbose=False, inPlace=True):
+
+def _projected(df, method):
+    """
+    add_lat_long_meters returning the frame, for StageCache.run
+    """
+    add_lat_long_meters(df, method=method)
+    return df
+
+
+@instrument.timed("lat_long_meters", rows=instrument.frame_rows)
+def lat_long_meters(ddict, verbose=False, inPlace=True, method="vincenty", cache=None):
     """
     Create a new column for each lat/long column in the data dictionary with the difference data.
 
@@ -85,30 +469,40 @@ def lat_long_meters(ddict, verbose=False, inPlace=True):
     verbose : bool
         Whether or not to print out the columns that are being added.
     inPlace : bool
-        Whether or not to modify the dictionary in place.
+        Whether or not to modify the dictionary in place. Otherwise the dictionary
+        and its DataFrames are copied first (see copy_dict).
+    method : str
+        The projection accuracy tier (see project_lat_long). "geodesic" is the
+        original per-row computation, which takes about 5 mins for the dataset.
+    cache : stage_cache.StageCache, optional
+        Memoize the projected frames, keyed by each folder's data and the method.
+        The dictionary gets new (writable) frames rather than modified ones.
 
     Returns
     -------
     dict
         The modified data dictionary.
     """
-    # takes about 5 mins! 
     if not inPlace:
-        ddict = ddict.copy()
+        ddict = copy_dict(ddict)
     names = ["latitude", "longitude"]
     for t_type in ddict:
-        for csvf in ddict[t_type]:
-            try:
-                for dir in ddict[t_type][csvf]:
-                    if 'latitude' in ddict[t_type][csvf][dir].columns:
-                        d = ddict[t_type][csvf][dir]
-                        add_lat_long_meters(d)
-                        
-                        if verbose:
-                            print("Added Lat/Long meters to", csvf + " " + dir)
-                        
-            except TypeError:
+        for csvf, files in ddict[t_type].items():
+            # skip the folder lists and missing file types
+            if not isinstance(files, dict):
                 continue
+            for dir in files:
+                if 'latitude' in files[dir].columns:
+                    d = files[dir]
+                    with instrument.span("lat_long_meters.folder", folder=dir, file_type=csvf, rows=len(d)):
+                        if cache is None:
+                            add_lat_long_meters(d, method=method)
+                        else:
+                            files[dir] = cache.run("lat_long_meters", lambda: _projected(d.copy(), method), d,
+                                                   {"method": method})
+
+                    if verbose:
+                        print("Added Lat/Long meters to", csvf + " " + dir)
     return ddict
 
 
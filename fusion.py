@@ -0,0 +1,161 @@
+import heapq
+
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+
+
+
+def dataframe_events(df, name, columns, time_col="timestamp"):
+    """
+    Turn a dataframe of sensor readings into a sorted stream of measurement events
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The sensor data, e.g. a t_gps or gps_mpu_left dataframe
+    name : str
+        The sensor name attached to every event (a key of FusionFilter.sensors)
+    columns : list
+        The columns forming the measurement vector, in order
+    time_col : str
+        The timestamp column
+
+    Yields
+    ------
+    tuple (t, name, z)
+        The timestamp, sensor name and measurement vector of each row, in time order
+    """
+    df = df.sort_values(time_col)
+    times = df[time_col].to_numpy()
+    values = df[columns].to_numpy(dtype=float)
+    for t, z in zip(times, values):
+        yield t, name, z
+
+
+
+class FusionFilter(object):
+    def __init__(self, kf, sensors, predict_on):
+        """
+        Fuse asynchronous sensor streams with a shared state model.
+        The model is advanced one step for every event from the predict_on
+        sensor (the IMU), and every event is followed by a measurement update
+        that uses only that sensor's observation model. Slow sensors (GPS) are
+        therefore applied only when a fix arrives, with a small H and R.
+
+        Parameters
+        ----------
+        kf : KalmanFilter
+            Provides the state model F, Q, G and u. Its F should be built for
+            the period of the predict_on sensor. Its H and R are not used.
+        sensors : dict
+            Maps each sensor name to a tuple (H, R) with H of shape (m_s,n)
+            and R of shape (m_s,m_s)
+        predict_on : str
+            The sensor whose events advance the model
+        """
+        if predict_on not in sensors:
+            raise ValueError(f"Unknown predict_on sensor: {predict_on}")
+        self.kf = kf
+        self.sensors = sensors
+        self.predict_on = predict_on
+
+
+    def run(self, x0, P0, *streams):
+        """
+        Filter the merged event streams
+
+        Parameters
+        ----------
+        x0 : ndarray of shape (n,)
+            The initial state estimate
+        P0 : ndarray of shape (n,n)
+            The initial error covariance matrix
+        streams : iterables of (t, name, z)
+            Time-sorted event streams, e.g. from dataframe_events. They are
+            merged lazily, so none of them is materialized.
+
+        Yields
+        ------
+        tuple (t, name, x)
+            The timestamp and sensor of each event and the state estimate after it
+        """
+        xk = np.asarray(x0, dtype=float)
+        pk = P0
+        for t, name, z in heapq.merge(*streams, key=lambda e: e[0]):
+            xk, pk = self.step(xk, pk, name, z)
+            yield t, name, xk
+
+
+    def step(self, xk, pk, name, z):
+        """
+        Process one event, for callers that receive the events one at a time
+        (e.g. live.FusionHandler) rather than as sorted streams
+
+        Parameters
+        ----------
+        xk : ndarray of shape (n,)
+            The state estimate before the event
+        pk : ndarray of shape (n,n)
+            The error covariance matrix before the event
+        name : str
+            The sensor of the event
+        z : ndarray of shape (m_s,)
+            Its measurement vector
+
+        Returns
+        -------
+        xk : ndarray of shape (n,)
+            The state estimate after the event
+        pk : ndarray of shape (n,n)
+            The error covariance matrix after the event
+        """
+        F, Q = self.kf.F, self.kf.Q
+        H, R = self.sensors[name]
+
+        # prediction step, only at the rate of the driving sensor
+        if name == self.predict_on:
+            xk = F @ xk + self.kf._Gu
+            pk = F @ pk @ F.T + Q
+
+        # update step with this sensor's model
+        yh = z - H @ xk
+        Sk = H @ pk @ H.T + R
+        Kk = cho_solve(cho_factor(Sk, lower=True, check_finite=False), H @ pk, check_finite=False).T
+        xk = xk + Kk @ yh
+        pk = (np.eye(len(xk)) - Kk @ H) @ pk
+        pk = (pk + pk.T) / 2
+        return xk, pk
+
+
+    def estimate(self, x0, P0, *streams):
+        """
+        Filter the merged event streams and collect the estimates at the rate
+        of the predict_on sensor
+
+        Parameters
+        ----------
+        x0 : ndarray of shape (n,)
+            The initial state estimate
+        P0 : ndarray of shape (n,n)
+            The initial error covariance matrix
+        streams : iterables of (t, name, z)
+            Time-sorted event streams
+
+        Returns
+        -------
+        times : ndarray of shape (N,)
+            The timestamp of each predict_on event
+        out : ndarray of shape (n,N)
+            The state estimate for each predict_on period, including any
+            updates from other sensors that arrive before the next period
+        """
+        times = []
+        out = []
+        for t, name, xk in self.run(x0, P0, *streams):
+            if name == self.predict_on:
+                times.append(t)
+                out.append(xk)
+            elif out:
+                # fold slower updates into the estimate of the current period
+                out[-1] = xk
+        return np.array(times), np.array(out).T
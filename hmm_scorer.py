@@ -0,0 +1,280 @@
+import numpy as np
+from scipy.linalg import solve_triangular
+from scipy.special import logsumexp
+
+import instrument
+
+
+
+class HMMParams(object):
+    def __init__(self,startprob,transmat,weights,means,covars,covariance_type="diag"):
+        """
+        The parameters of a hidden Markov model with Gaussian mixture emissions,
+        in the layout of hmmlearn's GMMHMM (a GaussianHMM is a GMMHMM with one
+        mixture component).
+
+        Parameters
+        ----------
+        startprob : ndarray of shape (K,)
+            The initial state distribution
+        transmat : ndarray of shape (K,K)
+            The transition matrix
+        weights : ndarray of shape (K,M)
+            The mixture weights of each state
+        means : ndarray of shape (K,M,D)
+            The component means
+        covars : ndarray
+            The component covariances: (K,M,D) for "diag", (K,M) for
+            "spherical", (K,M,D,D) for "full" or (K,D,D) for "tied"
+        covariance_type : str
+            One of "diag", "spherical", "full" or "tied"
+        """
+        K,M,D = np.shape(means)
+        with np.errstate(divide="ignore"):
+            self.log_startprob = np.log(startprob)
+            self.log_transmat = np.log(transmat)
+            self.log_weights = np.log(weights)
+        self.means = np.asarray(means,dtype=float)
+        self.n_components, self.n_mix, self.n_features = K, M, D
+
+        covars = np.asarray(covars,dtype=float)
+        if covariance_type == "spherical":
+            covariance_type, covars = "diag", np.repeat(covars[:,:,None],D,axis=2)
+        elif covariance_type == "tied":
+            covariance_type, covars = "full", np.repeat(covars[:,None],M,axis=1)
+        if covariance_type == "diag":
+            self.precisions = 1 / covars
+            self.log_norm = -0.5 * (D*np.log(2*np.pi) + np.log(covars).sum(axis=2))
+        elif covariance_type == "full":
+            chol = np.linalg.cholesky(covars)
+            self.log_norm = -0.5*D*np.log(2*np.pi) - np.log(np.diagonal(chol,axis1=2,axis2=3)).sum(axis=2)
+
+            # invert each triangular factor once: L^-1 (x - mu) = L^-1 x - L^-1 mu, so
+            # scoring whitens every sample for every component with one matrix product
+            self.chol_inv = np.empty_like(chol)
+            for k in range(K):
+                for m in range(M):
+                    self.chol_inv[k,m] = solve_triangular(chol[k,m],np.eye(D),lower=True,check_finite=False)
+            self.whiten = self.chol_inv.transpose(3,0,1,2).reshape(D,K*M*D)
+            self.whitened_means = np.einsum("kmij,kmj->kmi",self.chol_inv,self.means).reshape(K*M*D)
+        else:
+            raise ValueError(f"Unknown covariance type: {covariance_type}")
+        self.covariance_type = covariance_type
+
+
+    @classmethod
+    def from_hmmlearn(cls,model):
+        """
+        Copy the fitted parameters of an hmmlearn GMMHMM or GaussianHMM
+
+        Parameters
+        ----------
+        model : hmmlearn.hmm.GMMHMM or hmmlearn.hmm.GaussianHMM
+            The fitted model
+
+        Returns
+        -------
+        HMMParams
+        """
+        if hasattr(model,"weights_"):
+            return cls(model.startprob_,model.transmat_,model.weights_,model.means_,
+                       model.covars_,model.covariance_type)
+
+        # a GaussianHMM exposes full covariance matrices whatever its covariance type
+        covars = model.covars_
+        if model.covariance_type in ("diag","spherical"):
+            covars = np.diagonal(covars,axis1=1,axis2=2)[:,None]
+            return cls(model.startprob_,model.transmat_,np.ones((len(covars),1)),model.means_[:,None],covars,"diag")
+        return cls(model.startprob_,model.transmat_,np.ones((len(covars),1)),model.means_[:,None],covars[:,None],"full")
+
+
+    def log_emission(self,X):
+        """
+        The log density of every observation under every state, summing the
+        mixture components in log space (all components at once)
+
+        Parameters
+        ----------
+        X : ndarray of shape (T,D)
+            The observations
+
+        Returns
+        -------
+        ndarray of shape (T,K)
+        """
+        K,M,D = self.n_components, self.n_mix, self.n_features
+        if self.covariance_type == "diag":
+            diff = X[:,None,None,:] - self.means[None]                   # (T,K,M,D)
+            maha = np.einsum("tkmd,kmd->tkm",diff**2,self.precisions)
+        else:
+            sol = X @ self.whiten - self.whitened_means                  # (T,K*M*D)
+            maha = (sol**2).reshape(len(X),K,M,D).sum(axis=3)
+        return logsumexp(self.log_weights + self.log_norm - 0.5*maha,axis=2)
+
+
+    def forward_increments(self,X,log_alpha=None):
+        """
+        Run the forward algorithm and return the per sample log-likelihood
+        increments log p(x_t | x_1 ... x_{t-1}). Emissions stay in log space
+        and every step is rescaled, so long sequences never underflow.
+
+        Parameters
+        ----------
+        X : ndarray of shape (T,D)
+            The observations
+        log_alpha : ndarray of shape (K,), optional
+            The normalized log forward variable after the previous sample, to
+            continue a sequence. None starts a new sequence from startprob.
+
+        Returns
+        -------
+        increments : ndarray of shape (T,)
+            The log-likelihood increments (their sum is the log-likelihood of X)
+        log_alpha : ndarray of shape (K,)
+            The normalized log forward variable after the last sample
+        """
+        log_b = self.log_emission(X)
+        if len(X) == 0:
+            return np.zeros(0), log_alpha
+
+        # log-sum-exp with the shift taken out of every sample up front: the
+        # loop only multiplies normalized probabilities, O(K^2) per sample
+        shift = log_b.max(axis=1)
+        # a sample impossible under every state has no finite shift (-inf - -inf is nan)
+        shift = np.where(np.isfinite(shift),shift,0)
+        b = np.exp(log_b - shift[:,None])
+        transmat = np.exp(self.log_transmat)
+        increments = np.zeros(len(X))
+        if log_alpha is None:
+            prior = np.exp(self.log_startprob)
+        else:
+            prior = np.exp(log_alpha) @ transmat
+        for t in range(len(X)):
+            if t > 0:
+                prior = alpha @ transmat
+            alpha = prior * b[t]
+            total = alpha.sum()
+            if total > 0:
+                alpha = alpha / total
+                increments[t] = np.log(total)
+            else:
+                # the sample is impossible: its increment is -inf and the
+                # recursion carries on from the prediction
+                alpha = prior / prior.sum()
+                increments[t] = -np.inf
+        increments += shift
+        with np.errstate(divide="ignore"):
+            return increments, np.log(alpha)
+
+
+    def score(self,X):
+        """
+        The log-likelihood of a whole sequence, like hmmlearn's model.score
+
+        Parameters
+        ----------
+        X : ndarray of shape (T,D) or (T,)
+            The observations
+
+        Returns
+        -------
+        float
+        """
+        X = np.asarray(X,dtype=float).reshape(len(X),-1)
+        with instrument.span("HMMParams.score",rows=len(X)):
+            return self.forward_increments(X)[0].sum()
+
+
+
+class SlidingHMMScorer(object):
+    def __init__(self,models,window=30000,scales=None):
+        """
+        Score a stream against several HMMs over a sliding window, one sample at a time.
+        Each model runs one continuous forward recursion, and the window score
+        is the sum of its last `window` log-likelihood increments (the last
+        window-1 increments are carried between chunks). A new sample therefore
+        costs O(K^2) per model instead of rescoring the whole window.
+
+        The window score conditions on the data before the window, so it is
+        log p(window | past) rather than model.score(window) on its own; the
+        two differ only through the state distribution at the window start.
+
+        Parameters
+        ----------
+        models : dict
+            Maps each class name to an HMMParams (or a fitted hmmlearn model)
+        window : int
+            The number of samples in the window
+        scales : dict, optional
+            Divides the window score of a class before comparing, like the
+            rescale of best_predict in hmm.ipynb
+        """
+        self.names = list(models)
+        self.models = [m if isinstance(m,HMMParams) else HMMParams.from_hmmlearn(m) for m in models.values()]
+        self.window = window
+        self.scales = np.array([(scales or {}).get(name,1.0) for name in self.names])
+        self.log_alpha = [None] * len(self.models)
+        self.tail = np.zeros((0,len(self.models)))
+        self.seen = 0
+
+
+    @instrument.timed("SlidingHMMScorer.update",rows=len)
+    def update(self,chunk):
+        """
+        Score the next chunk of the stream
+
+        Parameters
+        ----------
+        chunk : ndarray of shape (T,D) or (T,)
+            The next samples
+
+        Returns
+        -------
+        ndarray of shape (T,n_models)
+            The window log-likelihood of each model after each sample
+            (over fewer samples until the window has filled)
+        """
+        if len(chunk) == 0:
+            return np.zeros((0,len(self.models)))
+        X = np.asarray(chunk,dtype=float).reshape(len(chunk),-1)
+
+        increments = np.zeros((len(X),len(self.models)))
+        for j, model in enumerate(self.models):
+            increments[:,j], self.log_alpha[j] = model.forward_increments(X,self.log_alpha[j])
+
+        # window sums from the carried increments and the new ones. Impossible
+        # samples (-inf) are counted apart, since a cumulative sum through them
+        # would give -inf - -inf = nan for every later window
+        inc = np.concatenate([self.tail,increments])
+        impossible = np.isneginf(inc)
+        csum = np.zeros((len(inc)+1,len(self.models)))
+        np.cumsum(np.where(impossible,0,inc),axis=0,out=csum[1:])
+        count = np.zeros((len(inc)+1,len(self.models)),dtype=np.int64)
+        np.cumsum(impossible,axis=0,out=count[1:])
+        hi = np.arange(len(self.tail),len(inc)) + 1
+        lo = np.maximum(hi - self.window,0)
+        out = csum[hi] - csum[lo]
+        out[count[hi] - count[lo] > 0] = -np.inf
+
+        # carry the last window-1 increments
+        self.tail = inc[max(len(inc)-(self.window-1),0):] if self.window > 1 else inc[:0]
+        self.seen += len(X)
+        return out
+
+
+    def predict(self,chunk):
+        """
+        Classify every sample of the next chunk by its best scaled window score
+
+        Parameters
+        ----------
+        chunk : ndarray of shape (T,D) or (T,)
+            The next samples
+
+        Returns
+        -------
+        ndarray of shape (T,)
+            The name of the best model after each sample
+        """
+        scores = self.update(chunk) / self.scales
+        return np.asarray(self.names)[scores.argmax(axis=1)]
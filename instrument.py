@@ -0,0 +1,319 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+
+class _State(object):
+    """
+    The recorder shared by every instrumented function. Nothing is recorded
+    unless enabled is True, and the disabled checks are a single attribute read.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.sample_every = 0
+        self.events = []
+        self.counters = {}
+        self.origin = time.perf_counter()
+
+
+STATE = _State()
+
+
+
+def enable(sample_every=0):
+    """
+    Start recording spans and counters
+
+    Parameters
+    ----------
+    sample_every : int
+        Also time every sample_every-th step of the KalmanFilter loops (0 turns step sampling off)
+    """
+    STATE.enabled = True
+    STATE.sample_every = sample_every
+
+
+def disable():
+    """
+    Stop recording (what was recorded so far is kept)
+    """
+    STATE.enabled = False
+    STATE.sample_every = 0
+
+
+def reset():
+    """
+    Forget every recorded span and counter
+    """
+    STATE.events = []
+    STATE.counters = {}
+    STATE.origin = time.perf_counter()
+
+
+@contextmanager
+def recording(sample_every=0, reset_first=True):
+    """
+    Record everything run inside the with block
+
+    Parameters
+    ----------
+    sample_every : int
+        See enable
+    reset_first : bool
+        Whether or not to forget earlier recordings first
+
+    Yields
+    ------
+    _State
+        The recorder, to pass to summary or the exporters
+    """
+    was = (STATE.enabled, STATE.sample_every)
+    if reset_first:
+        reset()
+    enable(sample_every)
+    try:
+        yield STATE
+    finally:
+        STATE.enabled, STATE.sample_every = was
+
+
+
+class _NullSpan(object):
+    """
+    The span returned while recording is off
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        STATE.events.append({"name": self.name, "cat": self.cat, "start": self.start - STATE.origin,
+                             "dur": end - self.start, "tid": threading.get_ident(), "args": self.args})
+        return False
+
+    def set(self, **args):
+        """
+        Attach more arguments (e.g. the number of rows once it is known)
+        """
+        self.args.update(args)
+
+
+def span(name, cat="span", **args):
+    """
+    Time a block of code
+
+    Parameters
+    ----------
+    name : str
+        The span name
+    cat : str
+        A category, shown in the Chrome trace viewer
+    args : dict
+        Extra fields, e.g. folder="PVS 1" or rows=1000. "rows" feeds the
+        rows/sec of summary and "folder" the per folder breakdown.
+
+    Returns
+    -------
+    context manager
+        Use as `with span("load_data.read", folder=dir) as s: ...; s.set(rows=len(df))`
+    """
+    if not STATE.enabled:
+        return _NULL
+    return _Span(name, cat, args)
+
+
+def count(name, n=1):
+    """
+    Add n to a counter (only while recording)
+    """
+    if STATE.enabled:
+        STATE.counters[name] = STATE.counters.get(name, 0) + n
+
+
+def timed(name=None, rows=None):
+    """
+    Decorator recording a span for every call of a function
+
+    Parameters
+    ----------
+    name : str, optional
+        The span name. Defaults to the qualified function name.
+    rows : callable, optional
+        Computes the number of rows processed from the call result, for rows/sec
+
+    Returns
+    -------
+    callable
+        The decorator
+    """
+    def decorator(fn):
+        label = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not STATE.enabled:
+                return fn(*args, **kwargs)
+            with _Span(label, "call", {}) as s:
+                out = fn(*args, **kwargs)
+                if rows is not None:
+                    s.set(rows=rows(out))
+            return out
+        return wrapper
+    return decorator
+
+
+def frame_rows(ddict):
+    """
+    The total number of rows in a data dictionary (every split and file type), for timed(rows=...)
+    """
+    total = 0
+    for t_type in ddict:
+        for csvf in ddict[t_type]:
+            if isinstance(ddict[t_type][csvf], dict):
+                total += sum(len(df) for df in ddict[t_type][csvf].values())
+    return total
+
+
+
+class StepSampler(object):
+    def __init__(self, name, every):
+        """
+        Time every `every`-th iteration of a loop, to profile per step costs
+        without timing (and slowing down) every step
+
+        Parameters
+        ----------
+        name : str
+            The name the sampled steps are recorded under
+        every : int
+            The sampling period in steps
+        """
+        self.name = name
+        self.every = every
+        self.samples = []
+
+    def run(self, step, i, *args):
+        """
+        Call step(*args) as iteration i, timing it if i is a sampled step
+        """
+        if i % self.every:
+            return step(*args)
+        start = time.perf_counter()
+        out = step(*args)
+        self.samples.append((i, time.perf_counter() - start))
+        return out
+
+    def close(self):
+        """
+        Record the sampled step times (summary reports their mean and max)
+        """
+        if not self.samples:
+            return
+        durations = [d for _, d in self.samples]
+        STATE.events.append({"name": self.name, "cat": "steps", "start": None, "dur": sum(durations),
+                             "tid": threading.get_ident(),
+                             "args": {"samples": len(durations), "every": self.every,
+                                      "mean_us": 1e6 * sum(durations) / len(durations),
+                                      "max_us": 1e6 * max(durations),
+                                      "steps": [[i, d * 1e6] for i, d in self.samples]}})
+
+
+def sampler(name):
+    """
+    A StepSampler if step sampling is on, else None
+    """
+    if STATE.enabled and STATE.sample_every:
+        return StepSampler(name, STATE.sample_every)
+    return None
+
+
+
+def summary(state=STATE):
+    """
+    Aggregate the recorded spans
+
+    Returns
+    -------
+    dict
+        For each span name: "calls", "sec" (total), "rows", "rows_per_sec" and,
+        when spans carried a folder, "folders" with the same fields per folder.
+        Step samples report "mean_us" and "max_us" per step instead.
+    """
+    out = {}
+    for e in state.events:
+        if e["cat"] == "steps":
+            entry = out.setdefault(e["name"], {"calls": 0, "sec": 0., "samples": 0, "mean_us": 0., "max_us": 0.})
+            total = entry["mean_us"] * entry["samples"] + e["args"]["mean_us"] * e["args"]["samples"]
+            entry["samples"] += e["args"]["samples"]
+            entry["mean_us"] = total / entry["samples"]
+            entry["max_us"] = max(entry["max_us"], e["args"]["max_us"])
+            entry["calls"] += 1
+            entry["sec"] += e["dur"]
+            continue
+        entries = [out.setdefault(e["name"], {"calls": 0, "sec": 0., "rows": 0})]
+        if "folder" in e["args"]:
+            folders = entries[0].setdefault("folders", {})
+            entries.append(folders.setdefault(e["args"]["folder"], {"calls": 0, "sec": 0., "rows": 0}))
+        for entry in entries:
+            entry["calls"] += 1
+            entry["sec"] += e["dur"]
+            entry["rows"] += int(e["args"].get("rows", 0))
+
+    # throughput wherever rows were reported
+    for entry in out.values():
+        for item in [entry] + list(entry.get("folders", {}).values()):
+            if item.get("rows"):
+                item["rows_per_sec"] = item["rows"] / item["sec"] if item["sec"] else float("inf")
+    return out
+
+
+
+def export_json(path, state=STATE):
+    """
+    Write the summary, the counters and the raw spans to a JSON file
+    """
+    with open(path, "w") as f:
+        json.dump({"summary": summary(state), "counters": state.counters, "events": state.events}, f,
+                  indent=1, default=str)
+
+
+def export_chrome_trace(path, state=STATE):
+    """
+    Write the spans in the Chrome trace event format (open with chrome://tracing or Perfetto)
+    """
+    pid = os.getpid()
+    events = []
+    for e in state.events:
+        if e["start"] is None:
+            continue
+        args = {k: v for k, v in e["args"].items() if k != "steps"}
+        events.append({"name": e["name"], "cat": e["cat"], "ph": "X", "pid": pid, "tid": e["tid"],
+                       "ts": e["start"] * 1e6, "dur": e["dur"] * 1e6, "args": args})
+    for name, value in state.counters.items():
+        events.append({"name": name, "ph": "C", "pid": pid, "tid": 0, "ts": 0, "args": {name: value}})
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
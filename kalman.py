@@ -1,4 +1,11 @@
 import numpy as np
+from scipy.linalg import cho_factor, cho_solve, qr, solve_discrete_are, solve_triangular
+
+import instrument
+
+
+# update strategies accepted by KalmanFilter.estimate
+UPDATE_METHODS = ("inverse", "cholesky", "joseph", "sqrt")
 
 
 class KalmanFilter(object):
@@ -20,6 +27,9 @@ class KalmanFilter(object):
             The control model
         u : ndarray of shape (n,)
             The control vector
+
+        G @ u and the inverse of F are cached here, so F, G and u should not be
+        reassigned after the filter is built.
         """
         # set attributes
         self.F = F
@@ -28,9 +38,16 @@ class KalmanFilter(object):
         self.R = R
         self.G = G
         self.u = u
+
+        # cache the control term and the inverse transition used by rewind
+        self._Gu = G @ u
+        try:
+            self._Finv = np.linalg.inv(F)
+        except np.linalg.LinAlgError:
+            self._Finv = None
     
     
-    def evolve(self,x0,N):
+    def evolve(self,x0,N,rng=None):
         """
         Compute the first N states and observations generated by the Kalman system
 
@@ -40,33 +57,63 @@ class KalmanFilter(object):
             The initial state
         N : integer
             The number of time steps to evolve
+        rng : np.random.Generator or int, optional
+            The random generator (or a seed for one) used for the noise
 
         Returns
         -------
         states : ndarray of shape (n,N)
             The i-th column gives the i-th state
         obs : ndarray of shape (m,N)
-            The i-th column gives the i-th observation
+            The i-th column gives the i-th observation (the first one is noiseless)
         """
+        rng = np.random.default_rng(rng)
+
         # initialize the sizes
         n = x0.shape[0]
-        m = (self.H @ x0).shape[0]
+        m = self.H.shape[0]
+
+        # draw all of the noise at once from cached factors of Q and R
+        W = self._noise_factor("Q") @ rng.standard_normal((n,N))
+        V = self._noise_factor("R") @ rng.standard_normal((m,N))
 
         # initialize the output
         states = np.zeros((n,N))
-        obs = np.zeros((m,N))
         states[:,0] = x0
-        obs[:,0] = x0[:2]
+        W += self._Gu[:,None]
 
-        # iterate to compute the states and observations
+        # iterate to compute the states
         for i in range(1,N):
-            states[:,i] = self.F @ states[:,i-1] + self.G @ self.u + np.random.multivariate_normal(np.zeros(n),self.Q)
-            obs[:,i] = self.H @ states[:,i] + np.random.multivariate_normal(np.zeros(m),self.R)
+            states[:,i] = self.F @ states[:,i-1] + W[:,i]
+
+        # the observations need no recursion
+        obs = self.H @ states
+        obs[:,1:] += V[:,1:]
 
         return states, obs
 
 
-    def estimate(self,x0,P0,z, return_norms = False):
+    def _noise_factor(self,name):
+        """
+        Return a matrix L with L L^T equal to the covariance attribute name ("Q" or "R").
+        The factor is cached until the attribute is reassigned. Covariances that are
+        only positive semi-definite fall back to a symmetric eigen-decomposition.
+        """
+        M = getattr(self,name)
+        cache = self.__dict__.setdefault("_factors",{})
+        if name in cache and cache[name][0] is M:
+            return cache[name][1]
+        try:
+            L = np.linalg.cholesky(M)
+        except np.linalg.LinAlgError:
+            vals, vecs = np.linalg.eigh(M)
+            L = vecs * np.sqrt(np.clip(vals,0,None))
+        cache[name] = (M,L)
+        return L
+
+
+    @instrument.timed("KalmanFilter.estimate",rows=lambda out: out.shape[1])
+    def estimate(self,x0,P0,z, return_norms = False, method="inverse"):
         """
         Compute the state estimates using the kalman filter
 
@@ -78,6 +125,13 @@ class KalmanFilter(object):
             The initial error covariance matrix
         z : ndarray of shape(m,N)
             Sequence of N observations (each column is an observation)
+        method : str
+            The update strategy, one of UPDATE_METHODS:
+            "inverse" forms inv(Sk) and updates with (I - KH)P (the original filter),
+            "cholesky" solves with a Cholesky factor of Sk and symmetrizes P,
+            "joseph" solves with a Cholesky factor and uses the Joseph form
+            (I - KH)P(I - KH)^T + KRK^T, and
+            "sqrt" propagates a Cholesky factor of P with QR array updates
 
         Returns
         -------
@@ -86,88 +140,861 @@ class KalmanFilter(object):
         """
         n = x0.shape[0]
         N = z.shape[1]
+        consts = self._step_constants(method)
 
         # initialize the output
         output = np.zeros((n,N))
         output[:,0] = x0
         xk1 = x0
-        pk1 = P0
+        pk1 = np.linalg.cholesky(P0) if method == "sqrt" else P0
 
         # iterate to compute the state estimates
+        sampler = instrument.sampler("KalmanFilter.estimate.step")
+        if sampler is not None:
+            # profiling run: time every k-th step (see instrument.enable)
+            for i in range(1,N):
+                xk1, pk1 = sampler.run(self._filter_step,i,xk1,pk1,z[:,i],method,consts)
+                output[:,i] = xk1
+            sampler.close()
+            return output
+
+        for i in range(1,N):
+            xk1, pk1 = self._filter_step(xk1,pk1,z[:,i],method,consts)
+
+            # save the estimate
+            output[:,i] = xk1
+
+        return output
+
+
+    def smooth(self,x0,P0,z,cov="full",checkpoint=None,method="inverse"):
+        """
+        Compute the fixed-interval (Rauch-Tung-Striebel) smoothed state estimates.
+        The forward filter is the same as estimate(); its posterior states and
+        covariances are kept in preallocated arrays and a backward RTS pass
+        combines them with the later observations.
+
+        With checkpoint=c only the filter state at every c-th step is kept during
+        the forward pass, and each block of c steps is refiltered from its
+        checkpoint during the backward pass. This costs one extra forward pass
+        but bounds the working memory to O((N/c + c) n^2) instead of O(N n^2).
+
+        Parameters
+        ----------
+        x0 : ndarray of shape (n,)
+            The initial state estimate
+        P0 : ndarray of shape (n,n)
+            The initial error covariance matrix
+        z : ndarray of shape(m,N)
+            Sequence of N observations (each column is an observation)
+        cov : str
+            "full" returns every smoothed covariance, "diag" only their diagonals
+        checkpoint : integer, optional
+            The number of steps between forward-pass checkpoints (at least 1).
+            None keeps every step with cov="full", and uses about sqrt(N) with
+            cov="diag" so that the working memory is bounded like the output.
+        method : str
+            The update strategy for the forward filter (see estimate)
+
+        Returns
+        -------
+        xs : ndarray of shape (n,N)
+            Sequence of smoothed state estimates (each column is an estimate)
+        Ps : ndarray of shape (N,n,n) or (n,N)
+            The smoothed covariances, or their diagonals (as columns) if cov="diag"
+        """
+        if cov not in ("full","diag"):
+            raise ValueError(f"Unknown covariance storage: {cov}")
+        if checkpoint is not None and checkpoint < 1:
+            raise ValueError(f"checkpoint must be at least 1, not {checkpoint}")
+        n = x0.shape[0]
+        N = z.shape[1]
+        if checkpoint is None and cov == "diag":
+            # N/c + c buffered covariances is smallest at c = sqrt(N)
+            checkpoint = max(int(np.ceil(np.sqrt(N))),1)
+        F, Q = self.F, self.Q
+        consts = self._step_constants(method)
+        Gu = consts["Gu"]
+        sqrt = method == "sqrt"
+        seg = N if checkpoint is None else min(checkpoint,N)
+        n_seg = -(-N // seg)
+
+        # initialize the output
+        xs = np.zeros((n,N))
+        Ps = np.zeros((N,n,n)) if cov == "full" else np.zeros((n,N))
+
+        # forward pass, keeping the filter state at the start of every segment
+        x_ck = np.zeros((n_seg,n))
+        P_ck = np.zeros((n_seg,n,n))
+        xk = x0
+        pk = np.linalg.cholesky(P0) if sqrt else P0
+        x_ck[0] = xk
+        P_ck[0] = pk
+        if n_seg > 1:
+            for i in range(1,(n_seg-1)*seg+1):
+                xk, pk = self._filter_step(xk,pk,z[:,i],method,consts)
+                if i % seg == 0:
+                    x_ck[i//seg] = xk
+                    P_ck[i//seg] = pk
+
+        # buffers holding the filtered states of one segment
+        x_buf = np.zeros((seg,n))
+        P_buf = np.zeros((seg,n,n))
+
+        # backward pass, one segment at a time
+        xs_next = Ps_next = None
+        for s in range(n_seg-1,-1,-1):
+            a = s*seg
+            b = min(a+seg,N)
+
+            # refilter the segment from its checkpoint
+            xk = x_ck[s]
+            pk = P_ck[s]
+            x_buf[0] = xk
+            P_buf[0] = pk @ pk.T if sqrt else pk
+            for i in range(a+1,b):
+                xk, pk = self._filter_step(xk,pk,z[:,i],method,consts)
+                x_buf[i-a] = xk
+                P_buf[i-a] = pk @ pk.T if sqrt else pk
+
+            # RTS recursion over the segment
+            for i in range(b-1,a-1,-1):
+                xf = x_buf[i-a]
+                Pf = P_buf[i-a]
+                if xs_next is None:
+                    # the last smoothed estimate is the last filtered estimate
+                    xs_i, Ps_i = xf.copy(), Pf.copy()
+                else:
+                    xp = F @ xf + Gu
+                    Pp = F @ Pf @ F.T + Q
+                    J = np.linalg.solve(Pp,F @ Pf).T
+                    xs_i = xf + J @ (xs_next - xp)
+                    Ps_i = Pf + J @ (Ps_next - Pp) @ J.T
+
+                # save the smoothed estimate
+                xs[:,i] = xs_i
+                if cov == "full":
+                    Ps[i] = Ps_i
+                else:
+                    Ps[:,i] = np.diag(Ps_i)
+                xs_next, Ps_next = xs_i, Ps_i
+
+        return xs, Ps
+
+
+    def log_likelihood(self,x0,P0,z):
+        """
+        Compute the log-likelihood of the observations under the model from
+        the innovations of the filter (the prediction error decomposition).
+        Useful for scoring choices of Q and R: the larger the better.
+
+        Parameters
+        ----------
+        x0 : ndarray of shape (n,)
+            The initial state estimate
+        P0 : ndarray of shape (n,n)
+            The initial error covariance matrix
+        z : ndarray of shape(m,N)
+            Sequence of N observations (each column is an observation). As in
+            estimate(), the first observation is not used.
+
+        Returns
+        -------
+        float
+            The sum over steps of log N(y_k; 0, S_k), with innovation y_k and
+            innovation covariance S_k
+        """
+        F, H = self.F, self.H
+        m, N = z.shape
+        xk, pk = x0, P0
+        ll = -0.5*m*np.log(2*np.pi)*(N-1)
+
         for i in range(1,N):
             # prediction step
-            xk = self.F @ xk1 + self.G @ self.u
-            pk = self.F @ pk1 @ self.F.T + self.Q
+            xk = F @ xk + self._Gu
+            pk = F @ pk @ F.T + self.Q
+
+            # innovation and its likelihood
+            yh = z[:,i] - H @ xk
+            c = cho_factor(H @ pk @ H.T + self.R,lower=True,check_finite=False)
+            ll -= np.log(np.diag(c[0])).sum() + 0.5*yh @ cho_solve(c,yh,check_finite=False)
 
             # update step
-            yh = z[:,i] - self.H @ xk
-            testing = self.H @ pk @ self.H.T
-            # print(testing.shape)
+            Kk = cho_solve(c,H @ pk,check_finite=False).T
+            xk = xk + Kk @ yh
+            pk = pk - Kk @ H @ pk
+            pk = (pk + pk.T) / 2
+
+        return ll
+
+
+    def fit_em(self,z,x0,P0,max_iter=100,tol=1e-6,fit=("Q","R"),structure="full",verbose=False):
+        """
+        Estimate Q and R (and optionally x0 and P0) by expectation maximization.
+        The E-step is a Kalman filter plus RTS smoother pass giving the
+        smoothed states, covariances and lag-one cross covariances
+        Ps[k] J[k-1]^T; the M-step is the closed form (Shumway and Stoffer)
+        update. F, H, G and u are kept fixed. Each iteration cannot lower the
+        log-likelihood, so the fit stops once its relative gain falls below tol.
+
+        Several drives are fitted jointly. The covariances, gains and smoother
+        gains do not depend on the data, so they are computed once per
+        iteration and shared by every drive, and the means of all drives are
+        propagated together as (n,B) matrices.
+
+        Q and R are updated in place on the filter.
+
+        Parameters
+        ----------
+        z : ndarray of shape (m,N), or list of them
+            The observations of one or several drives. As in estimate(), the
+            first observation of each drive is not used.
+        x0 : ndarray of shape (n,)
+            The initial state estimate
+        P0 : ndarray of shape (n,n)
+            The initial error covariance matrix
+        max_iter : int
+            The maximum number of EM iterations
+        tol : float
+            The relative log-likelihood gain below which the fit has converged
+        fit : tuple of str
+            The parameters to estimate, any of "Q", "R", "x0" and "P0"
+        structure : str
+            "full" estimates full covariance matrices, "diag" only their diagonals
+        verbose : bool
+            Whether or not to print the log-likelihood of each iteration
+
+        Returns
+        -------
+        dict
+            "Q", "R", "x0" and "P0" (the fitted values), "log_likelihood"
+            (the log-likelihood before each M-step, summed over drives),
+            "n_iter" and "converged"
+        """
+        if structure not in ("full","diag"):
+            raise ValueError(f"Unknown covariance structure: {structure}")
+        zs = [z] if isinstance(z,np.ndarray) else list(z)
+        x0 = np.asarray(x0,dtype=float)
+        P0 = np.asarray(P0,dtype=float)
+
+        def project(C):
+            C = (C + C.T) / 2
+            return np.diag(np.diag(C)) if structure == "diag" else C
+
+        trace = []
+        converged = False
+        for it in range(max_iter):
+            stats = self._em_statistics(zs,x0,P0)
+            trace.append(stats["ll"])
+            if verbose:
+                print(f"iteration {it}: log-likelihood {stats['ll']}")
+            if it > 0 and trace[-1] - trace[-2] <= tol * abs(trace[-2]):
+                converged = True
+                break
+
+            # M-step
+            T = stats["steps"]
+            F, Gu = self.F, self._Gu
+            if "Q" in fit:
+                FS = F @ stats["S10"].T
+                dx = stats["sx1"] - F @ stats["sx0"]
+                Q = (stats["S11"] - FS - FS.T + F @ stats["S00"] @ F.T
+                     - np.outer(dx,Gu) - np.outer(Gu,dx) + T*np.outer(Gu,Gu)) / T
+                self.Q = project(Q)
+            if "R" in fit:
+                self.R = project(stats["Syy"] / T)
+            if "x0" in fit:
+                x0 = stats["xs0"].mean(axis=1)
+            if "P0" in fit:
+                d = stats["xs0"] - x0[:,None]
+                P0 = project(stats["Ps0"] + d @ d.T / d.shape[1])
+
+        return {"Q": self.Q, "R": self.R, "x0": x0, "P0": P0, "log_likelihood": np.array(trace),
+                "n_iter": len(trace), "converged": converged}
+
+
+    def _em_statistics(self,zs,x0,P0,rtol=1e-12):
+        """
+        The E-step of fit_em: filter and smooth every drive and accumulate the
+        expected sufficient statistics (sums over steps k >= 1 and drives of
+        E[x_k x_k^T], E[x_k x_{k-1}^T], E[x_{k-1} x_{k-1}^T], E[x_k], E[x_{k-1}]
+        and E[(z_k - H x_k)(z_k - H x_k)^T]) along with the log-likelihood.
+
+        The covariance recursions do not depend on the data and settle quickly,
+        so once a covariance stops changing (relative change below rtol) it is
+        reused instead of recomputed; only the means are propagated every step.
+        """
+        F, H, Q, R, Gu = self.F, self.H, self.Q, self.R, self._Gu
+        n = F.shape[0]
+        m = H.shape[0]
+        lengths = np.array([z.shape[1] for z in zs])
+        order = np.argsort(-lengths,kind="stable")
+        B = len(zs)
+        N = lengths.max()
+
+        # observations stacked as (N,m,B), longest drive first so the drives
+        # still running at step k are always a prefix
+        Z = np.zeros((N,m,B))
+        for j, d in enumerate(order):
+            Z[:lengths[d],:,j] = zs[d].T
+        active = (lengths[:,None] > np.arange(N)).sum(axis=0)
+
+        def settled(A,B):
+            return np.abs(A - B).max() <= rtol * np.abs(B).max()
+
+        # forward covariance recursion, up to the step ks after which it is constant
+        Pf = [P0]
+        Pp = [None]
+        J = []
+        K = [None]
+        Linv = [None]
+        logdet = [0.]
+        ks = N
+        for k in range(1,N):
+            FP = F @ Pf[k-1]
+            Pp.append(FP @ F.T + Q)
+            J.append(cho_solve(cho_factor(Pp[k],lower=True,check_finite=False),FP,check_finite=False).T)
+            L = np.linalg.cholesky(H @ Pp[k] @ H.T + R)
+            Linv.append(solve_triangular(L,np.eye(m),lower=True,check_finite=False))
+            logdet.append(np.log(np.diag(L)).sum())
+            K.append((Linv[k].T @ (Linv[k] @ H @ Pp[k])).T)
+            P = Pp[k] - K[k] @ H @ Pp[k]
+            Pf.append((P + P.T) / 2)
+            if k > 1 and settled(Pf[k],Pf[k-1]):
+                ks = k
+                FP = F @ Pf[k]
+                J.append(cho_solve(cho_factor(FP @ F.T + Q,lower=True,check_finite=False),FP,check_finite=False).T)
+                break
+        cov = np.minimum(np.arange(N),ks)                # step k uses the covariances of step cov[k]
+
+        # forward means of every drive
+        Xf = np.zeros((N,n,B))
+        Xp = np.zeros((N,n,B))
+        Xf[0] = x0[:,None]
+        ll = 0.
+        for k in range(1,N):
+            b = active[k]
+            c = cov[k]
+            Xp[k,:,:b] = F @ Xf[k-1,:,:b] + Gu[:,None]
+            Y = Z[k,:,:b] - H @ Xp[k,:,:b]
+            Xf[k,:,:b] = Xp[k,:,:b] + K[c] @ Y
+            w = Linv[c] @ Y
+            ll -= b * (0.5*m*np.log(2*np.pi) + logdet[c]) + 0.5*(w*w).sum()
+
+        # backward pass, once per distinct drive length (the smoothed
+        # covariances depend on where the drive ends)
+        S11 = np.zeros((n,n))
+        S10 = np.zeros((n,n))
+        S00 = np.zeros((n,n))
+        Syy = np.zeros((m,m))
+        sx1 = np.zeros(n)
+        sx0 = np.zeros(n)
+        xs0 = np.zeros((n,B))
+        Ps0 = np.zeros((n,n))
+        for L in np.unique(lengths):
+            cols = np.flatnonzero(lengths[order] == L)
+            b = len(cols)
+            Xs = np.zeros((L,n,b))
+            Xs[L-1] = Xf[L-1][:,cols]
+            Ps = Pf[cov[L-1]]
+            sumPs = np.zeros((n,n))                       # sum of Ps_k over k >= 1
+            sumPsJ = np.zeros((n,n))                      # sum of Ps_k J_{k-1}^T
+            steady = False
+            for k in range(L-1,0,-1):
+                # RTS step from k back to k-1
+                Jk = J[cov[k-1]]
+                Xs[k-1] = Xf[k-1][:,cols] + Jk @ (Xs[k] - Xp[k][:,cols])
+                sumPs += Ps
+                sumPsJ += Ps @ Jk.T
+                if steady and k-1 >= ks:
+                    continue
+                Ps_prev = Pf[cov[k-1]] + Jk @ (Ps - Pp[cov[k]]) @ Jk.T
+                steady = k-1 >= ks and settled(Ps_prev,Ps)
+                Ps = Ps_prev
+
+            # statistics of steps 1 .. L-1 for this group
+            X1, X0 = Xs[1:], Xs[:-1]
+            E = Z[1:L][:,:,cols] - np.einsum("ij,kjb->kib",H,X1)
+            S11 += b*sumPs + np.einsum("kib,kjb->ij",X1,X1)
+            S10 += b*sumPsJ + np.einsum("kib,kjb->ij",X1,X0)
+            S00 += b*(sumPs - Pf[cov[L-1]] + Ps) + np.einsum("kib,kjb->ij",X0,X0)
+            Syy += b*H @ sumPs @ H.T + np.einsum("kib,kjb->ij",E,E)
+            sx1 += X1.sum(axis=(0,2))
+            sx0 += X0.sum(axis=(0,2))
+            xs0[:,order[cols]] = Xs[0]
+            Ps0 += b*Ps
 
+        return {"S11": S11, "S10": S10, "S00": S00, "Syy": Syy, "sx1": sx1, "sx0": sx0,
+                "xs0": xs0, "Ps0": Ps0 / B, "steps": (lengths - 1).sum(), "ll": ll}
+
+
+    def _step_constants(self,method):
+        """
+        Precompute the time-invariant pieces used by _filter_step for a given method
+        """
+        if method not in UPDATE_METHODS:
+            raise ValueError(f"Unknown update method: {method}")
+        consts = {"Gu": self._Gu, "I": np.eye(self.F.shape[0])}
+        if method == "sqrt":
+            consts["sqrtQ"] = np.linalg.cholesky(self.Q)
+            consts["sqrtR"] = np.linalg.cholesky(self.R)
+        return consts
+
+
+    def _filter_step(self,xk1,pk1,zk,method,consts):
+        """
+        Advance the filter by one predict/update step.
+        For the "sqrt" method pk1 and the returned covariance are lower triangular
+        Cholesky factors of P rather than P itself.
+        """
+        F, H = self.F, self.H
+
+        if method == "sqrt":
+            n = F.shape[0]
+            m = H.shape[0]
+
+            # prediction step: triangularize [F S, sqrt(Q)]
+            pre = np.hstack((F @ pk1, consts["sqrtQ"]))
+            sk = qr(pre.T,mode="r",check_finite=False)[0][:n].T
+            xk = F @ xk1 + consts["Gu"]
+
+            # update step: triangularize [[sqrt(R), H S], [0, S]]
+            pre = np.zeros((m+n,m+n))
+            pre[:m,:m] = consts["sqrtR"]
+            pre[:m,m:] = H @ sk
+            pre[m:,m:] = sk
+            post = qr(pre.T,mode="r",check_finite=False)[0].T
+            yh = zk - H @ xk
+            xk = xk + post[m:,:m] @ solve_triangular(post[:m,:m],yh,lower=True,check_finite=False)
+            return xk, post[m:,m:]
+
+        # prediction step
+        xk = F @ xk1 + consts["Gu"]
+        pk = F @ pk1 @ F.T + self.Q
+
+        # update step
+        yh = zk - H @ xk
+        Sk = H @ pk @ H.T + self.R
+        if method == "inverse":
+            Kk = pk @ H.T @ np.linalg.inv(Sk)
+            return xk + Kk @ yh, (consts["I"] - Kk @ H) @ pk
+
+        Kk = cho_solve(cho_factor(Sk,lower=True,check_finite=False),H @ pk,check_finite=False).T
+        xk = xk + Kk @ yh
+        if method == "joseph":
+            IKH = consts["I"] - Kk @ H
+            pk = IKH @ pk @ IKH.T + Kk @ self.R @ Kk.T
+        else:
+            pk = pk - Kk @ H @ pk
+            pk = (pk + pk.T) / 2
+        return xk, pk
+
+
+    def estimate_batch(self,x0,P0,z,mask=None):
+        """
+        Compute the state estimates for a stack of B independent trajectories at once.
+        All B filters share the same model and are advanced together with stacked
+        matrix products, so there is only one Python loop over time.
+
+        Parameters
+        ----------
+        x0 : ndarray of shape (B,n) or (n,)
+            The initial state estimate for each trajectory (broadcast if 1-D)
+        P0 : ndarray of shape (B,n,n) or (n,n)
+            The initial error covariance matrix for each trajectory (broadcast if 2-D)
+        z : ndarray of shape (B,m,N)
+            Stack of B observation sequences padded to a common length N
+        mask : ndarray of shape (B,N), optional
+            Boolean mask, True where z[b,:,i] is a real observation. Steps where the
+            mask is False leave that trajectory's estimate unchanged, so ragged
+            sequences can be padded at the end. Defaults to all True.
+
+        Returns
+        -------
+        out : ndarray of shape (B,n,N)
+            out[b] is the sequence of state estimates for trajectory b, matching
+            estimate(x0[b], P0[b], z[b,:,:length_b]) on its unpadded steps
+        """
+        B, m, N = z.shape
+        n = self.F.shape[0]
+
+        # broadcast the initial conditions across the batch
+        xk1 = np.array(np.broadcast_to(x0,(B,n)),dtype=float)
+        pk1 = np.array(np.broadcast_to(P0,(B,n,n)),dtype=float)
+        if mask is None:
+            mask = np.ones((B,N),dtype=bool)
+
+        # precompute the time-invariant pieces
+        Gu = self._Gu
+        I = np.eye(n)
+
+        # initialize the output
+        output = np.zeros((B,n,N))
+        output[:,:,0] = xk1
+
+        # iterate to compute the state estimates for every trajectory
+        for i in range(1,N):
+            # prediction step
+            xk = xk1 @ self.F.T + Gu
+            pk = self.F @ pk1 @ self.F.T + self.Q
+
+            # update step
+            yh = z[:,:,i] - xk @ self.H.T
             Sk = self.H @ pk @ self.H.T + self.R
             Kk = pk @ self.H.T @ np.linalg.inv(Sk)
-            xk = xk + Kk @ yh
-            pk = (np.eye(n) - Kk @ self.H) @ pk
+            xk = xk + (Kk @ yh[:,:,None])[:,:,0]
+            pk = (I - Kk @ self.H) @ pk
 
-            # save the estimate
-            output[:,i] = xk
+            # only advance the trajectories that have an observation at this step
+            active = mask[:,i]
+            xk1 = np.where(active[:,None],xk,xk1)
+            pk1 = np.where(active[:,None,None],pk,pk1)
 
-            # update the state
-            xk1 = xk
-            pk1 = pk
+            # save the estimate
+            output[:,:,i] = xk1
 
         return output
-    
-    
+
+
+    def steady_state_gain(self,P0,tol=1e-9,max_iter=100000,method="iterate"):
+        """
+        Find the step at which the Kalman gain stops changing for a time-invariant model
+
+        Parameters
+        ----------
+        P0 : ndarray of shape (n,n)
+            The initial error covariance matrix
+        tol : float
+            Largest absolute change in any entry of the gain that counts as converged
+        max_iter : integer
+            The maximum number of Riccati iterations before giving up
+        method : str
+            "iterate" runs the covariance recursion until the gain stops changing.
+            "dare" solves the discrete algebraic Riccati equation with scipy and
+            iterates only until the gain is within tol of that solution.
+
+        Returns
+        -------
+        K : ndarray of shape (n,m)
+            The steady-state gain
+        step : integer
+            The filter step at which the gain converged (the first step that can
+            use K), or max_iter if it did not converge
+        gain_change : float
+            The largest entry of |K_step - K_target| at the converged step
+        """
+        n = self.F.shape[0]
+        I = np.eye(n)
+
+        # the target gain is either the exact DARE solution or the previous iterate
+        K_target = None
+        if method == "dare":
+            P_inf = solve_discrete_are(self.F.T,self.H.T,self.Q,self.R)
+            S_inf = self.H @ P_inf @ self.H.T + self.R
+            K_target = np.linalg.solve(S_inf,self.H @ P_inf).T
+        elif method != "iterate":
+            raise ValueError(f"Unknown steady state method: {method}")
+
+        # iterate the covariance recursion of estimate()
+        pk1 = P0
+        K_prev = None
+        gain_change = np.inf
+        for i in range(1,max_iter+1):
+            pk = self.F @ pk1 @ self.F.T + self.Q
+            Sk = self.H @ pk @ self.H.T + self.R
+            Kk = np.linalg.solve(Sk,self.H @ pk).T
+            pk1 = (I - Kk @ self.H) @ pk
+
+            # check for convergence
+            ref = K_target if K_target is not None else K_prev
+            if ref is not None:
+                gain_change = np.abs(Kk - ref).max()
+                if gain_change < tol:
+                    return Kk, i, gain_change
+            K_prev = Kk
+
+        return Kk, max_iter, gain_change
+
+
+    def estimate_steady(self,x0,P0,z,tol=1e-9,max_iter=100000,method="iterate",check=False):
+        """
+        Compute the state estimates by running the exact filter until the gain
+        converges and then freezing it. After convergence each step is the fixed
+        linear recursion x <- A x + K z + b with A = (I - KH)F and b = (I - KH)Gu,
+        so no covariance or inverse is computed.
+
+        Parameters
+        ----------
+        x0 : ndarray of shape (n,)
+            The initial state estimate
+        P0 : ndarray of shape (n,n)
+            The initial error covariance matrix
+        z : ndarray of shape(m,N)
+            Sequence of N observations (each column is an observation)
+        tol, max_iter, method :
+            Passed to steady_state_gain
+        check : bool
+            Whether or not to also run the exact filter and report the largest
+            deviation of the steady-state estimates from it
+
+        Returns
+        -------
+        out : ndarray of shape (n,N)
+            Sequence of state estimates (each column is an estimate)
+        info : dict
+            "converged_step" : the step where the gain was frozen
+            "gain_change" : the gain change reported by steady_state_gain
+            "max_deviation" : the largest absolute state deviation from estimate(),
+            or None if check is False
+        """
+        n = x0.shape[0]
+        N = z.shape[1]
+        K, step, gain_change = self.steady_state_gain(P0,tol=tol,max_iter=max_iter,method=method)
+        step = min(step,N)
+
+        # run the exact filter over the transient
+        output = np.zeros((n,N))
+        output[:,:step] = self.estimate(x0,P0,z[:,:step])
+
+        # fixed linear recursion over the rest of the sequence
+        if step < N:
+            IKH = np.eye(n) - K @ self.H
+            A = IKH @ self.F
+            b = IKH @ self._Gu
+            inputs = K @ z[:,step:] + b[:,None]
+            xk = output[:,step-1]
+            for i in range(inputs.shape[1]):
+                xk = A @ xk + inputs[:,i]
+                output[:,step+i] = xk
+
+        info = {"converged_step": step, "gain_change": gain_change, "max_deviation": None}
+        if check:
+            info["max_deviation"] = np.abs(output - self.estimate(x0,P0,z)).max()
+
+        return output, info
+
+
     def predict(self,x,k):
         """
         Predict the next k states in the absence of observations
 
         Parameters
         ----------
-        x : ndarray of shape (n,)
-            The current state estimate
+        x : ndarray of shape (n,) or (n,B)
+            The current state estimate, or B start states as columns
         k : integer
             The number of states to predict
 
         Returns
         -------
-        out : ndarray of shape (n,k)
+        out : ndarray of shape (n,k) or (n,k,B)
             The next k predicted states
         """
-        out = np.empty((x.shape[0],k))
+        return self._affine_horizon(self.F,self._Gu,x,k)
 
-        # iterate to compute the state estimates
-        for i in range(k):
-            out_i = self.F @ x + self.G @ self.u
-            out[:,i] = out_i
-            x = out_i
-        
-        return out
-    
 
     def rewind(self,x,k):
         """
         Predict the states from time 0 through k-1 in the absence of observations
-    
+
         Parameters
         ----------
-        x : ndarray of shape (n,)
-            The state estimate at time k
+        x : ndarray of shape (n,) or (n,B)
+            The state estimate at time k, or B such states as columns
         k : integer
             The current time step
-    
+
         Returns
         -------
-        out : ndarray of shape (n,k)
-            The predicted states from time 0 up through k-1 (in that order)
+        out : ndarray of shape (n,k) or (n,k,B)
+            The predicted states from time k-1 back through 0 (column i is
+            i+1 steps before time k)
         """
-        out = np.empty((x.shape[0],k))
+        if self._Finv is None:
+            raise np.linalg.LinAlgError("F is singular, so the model cannot be rewound")
+        return self._affine_horizon(self._Finv,-self._Finv @ self._Gu,x,k)
 
-        # iterate to compute the state estimates
-        for i in range(k):
-            out_i = np.linalg.inv(self.F) @ (x - self.G @ self.u)
-            out[:,i] = out_i
-            x = out_i
 
+    def propagate(self,x,horizons):
+        """
+        Evaluate the state at many horizons in the absence of observations.
+        Each horizon is computed independently by repeated squaring, so the
+        cost is O(log|h|) matrix products regardless of how far apart they are.
+
+        Parameters
+        ----------
+        x : ndarray of shape (n,) or (n,B)
+            The current state estimate, or B start states as columns
+        horizons : array_like of integers
+            The number of steps to move; negative horizons rewind
+
+        Returns
+        -------
+        out : ndarray of shape (len(horizons),n) or (len(horizons),n,B)
+            out[j] is the state horizons[j] steps from x
+        """
+        horizons = np.atleast_1d(horizons)
+        out = np.empty((len(horizons),) + x.shape)
+        for j, h in enumerate(horizons):
+            if h >= 0:
+                A, b = self._affine_power(self.F,self._Gu,h)
+            else:
+                if self._Finv is None:
+                    raise np.linalg.LinAlgError("F is singular, so the model cannot be rewound")
+                A, b = self._affine_power(self._Finv,-self._Finv @ self._Gu,-h)
+            out[j] = A @ x + (b if x.ndim == 1 else b[:,None])
+        return out
+
+
+    @staticmethod
+    def _affine_power(A,b,k):
+        """
+        Compute (A^k, sum_{j<k} A^j b), the k-fold composition of x -> A x + b,
+        by repeated squaring
+        """
+        n = A.shape[0]
+        result_A, result_b = np.eye(n), np.zeros(n)
+        base_A, base_b = A, b
+        while k > 0:
+            if k & 1:
+                result_A, result_b = base_A @ result_A, base_A @ result_b + base_b
+            base_A, base_b = base_A @ base_A, base_A @ base_b + base_b
+            k >>= 1
+        return result_A, result_b
+
+
+    @staticmethod
+    def _affine_horizon(A,b,x,k,block=4096):
+        """
+        Apply x -> A x + b k times and return every intermediate state.
+        The powers A^1..A^L and offsets for one block of L steps are built by
+        doubling (log L stacked matmuls), then each block is a single matmul
+        from the last state of the previous block.
+        """
+        n = A.shape[0]
+        L = max(min(k,block),1)
+
+        # powers[i] = A^(i+1) and offsets[i] = sum_{j<=i} A^j b
+        powers = np.empty((L,n,n))
+        offsets = np.empty((L,n))
+        powers[0] = A
+        offsets[0] = b
+        s = 1
+        while s < L:
+            t = min(s,L-s)
+            powers[s:s+t] = powers[:t] @ powers[s-1]
+            offsets[s:s+t] = powers[:t] @ offsets[s-1] + offsets[:t]
+            s += t
+
+        # apply the block maps from the running state
+        out = np.empty((n,k) + x.shape[1:])
+        start = 0
+        while start < k:
+            t = min(L,k-start)
+            block_out = np.tensordot(powers[:t],x,axes=(2,0))
+            block_out += offsets[:t].reshape((t,n) + (1,)*(x.ndim-1))
+            out[:,start:start+t] = np.moveaxis(block_out,0,1)
+            x = block_out[-1]
+            start += t
+        return out
+
+
+
+class KalmanStream(object):
+    def __init__(self,kf,x0,P0,method="inverse"):
+        """
+        Run a KalmanFilter incrementally, one observation (or chunk) at a time.
+        Only the current state and covariance are kept between calls, so memory
+        does not grow with the length of the drive. Feeding the columns of z in
+        order produces exactly the columns of kf.estimate(x0,P0,z,method=method).
+
+        Parameters
+        ----------
+        kf : KalmanFilter
+            The dynamical system models
+        x0 : ndarray of shape (n,)
+            The initial state estimate
+        P0 : ndarray of shape (n,n)
+            The initial error covariance matrix
+        method : str
+            The update strategy (see KalmanFilter.estimate)
+        """
+        self.kf = kf
+        self.method = method
+        self.consts = kf._step_constants(method)
+        self.x = np.asarray(x0,dtype=float)
+        self.P = np.linalg.cholesky(P0) if method == "sqrt" else P0
+        self.k = 0
+
+
+    @property
+    def covariance(self):
+        """
+        The current error covariance matrix
+        """
+        return self.P @ self.P.T if self.method == "sqrt" else self.P
+
+
+    def step(self,z_k):
+        """
+        Consume one observation and return the new state estimate.
+        Like estimate(), the very first observation is not used and the
+        initial state is returned for it.
+
+        Parameters
+        ----------
+        z_k : ndarray of shape (m,)
+            The next observation
+
+        Returns
+        -------
+        x : ndarray of shape (n,)
+            The state estimate after this observation
+        """
+        if self.k > 0:
+            self.x, self.P = self.kf._filter_step(self.x,self.P,z_k,self.method,self.consts)
+        self.k += 1
+        return self.x
+
+
+    def step_many(self,chunk):
+        """
+        Consume a chunk of consecutive observations
+
+        Parameters
+        ----------
+        chunk : ndarray of shape (m,c)
+            The next c observations (each column is an observation)
+
+        Returns
+        -------
+        out : ndarray of shape (n,c)
+            The state estimates after each observation in the chunk
+        """
+        out = np.zeros((self.x.shape[0],chunk.shape[1]))
+        for i in range(chunk.shape[1]):
+            out[:,i] = self.step(chunk[:,i])
         return out
+
+
+    def run(self,source):
+        """
+        Filter every observation produced by an iterable without materializing it
+
+        Parameters
+        ----------
+        source : iterable
+            Yields observations of shape (m,) or chunks of shape (m,c),
+            e.g. a generator or cleaner.iter_csv_observations
+
+        Yields
+        ------
+        ndarray of shape (n,) or (n,c)
+            The state estimates for each item of source
+        """
+        for item in source:
+            item = np.asarray(item)
+            if item.ndim == 1:
+                yield self.step(item).copy()
+            else:
+                yield self.step_many(item)
@@ -0,0 +1,458 @@
+import asyncio
+import functools
+import os
+import time
+
+import numpy as np
+
+import cleaner
+import instrument
+from filter import project_lat_long
+from hmm_scorer import SlidingHMMScorer
+from kalman import KalmanStream
+from pipeline import read_chunks
+from replay import ReplayLog
+
+
+
+def _chain(first, rest):
+    """
+    Put back the item taken from a generator to peek at it
+    """
+    yield first
+    yield from rest
+
+
+
+def iter_blocks(source, file_type=None, time_col="timestamp", chunksize=10000):
+    """
+    Read a recorded sensor stream block by block
+
+    Parameters
+    ----------
+    source : str or ReplayLog
+        A PVS csv file, a replay log (.rpl, see replay.convert_csv) or an open ReplayLog
+    file_type : str, optional
+        The file type of a csv. Defaults to the one matching the file name.
+    time_col : str
+        The timestamp column of a csv, in seconds
+    chunksize : int
+        The number of rows per block
+
+    Returns
+    -------
+    channels : list of str
+        The channel names
+    blocks : generator
+        Yields (t, values): the timestamps in seconds, shape (c,), and the
+        channels in their original units, shape (c, len(channels))
+    """
+    if isinstance(source, str) and source.endswith(".rpl"):
+        source = ReplayLog(source)
+    if isinstance(source, ReplayLog):
+        log = source
+        bias = np.array([log.bias[col] for col in log.channels])
+
+        def blocks():
+            for start in range(0, len(log), chunksize):
+                records = log.records[start:start + chunksize]
+                yield records["t"] / log.time_scale, records["values"].astype(float) + bias
+        return list(log.channels), blocks()
+
+    file_type = file_type or cleaner.match_file_type(os.path.basename(source))
+    chunks = (cleaner.clean_frame(file_type, chunk) for chunk in read_chunks(source, file_type, chunksize=chunksize))
+    first = next(chunks, None)
+    if first is None:
+        return [], iter(())
+    channels = [col for col in first.select_dtypes("number").columns if col != time_col]
+
+    def blocks():
+        for chunk in _chain(first, chunks):
+            if len(chunk):
+                yield chunk[time_col].to_numpy(dtype=float), chunk[channels].to_numpy(dtype=float)
+    return channels, blocks()
+
+
+
+def _observe(columns, values, channels, origin, signed=False):
+    """
+    Gather the observed channels of a batch, projecting "lat_m" and "long_m"
+    from latitude and longitude with a fixed origin (the first message if None)
+
+    Returns
+    -------
+    z : ndarray of shape (len(columns),c)
+    origin : tuple
+        The (lat0, lon0) origin used
+    """
+    cols = {}
+    if "lat_m" in columns or "long_m" in columns:
+        lat = values[:, channels.index("latitude")]
+        lon = values[:, channels.index("longitude")]
+        if origin is None:
+            origin = (float(lat[0]), float(lon[0]))
+        cols["lat_m"], cols["long_m"] = project_lat_long(lat, lon, origin=origin, signed=signed)
+    z = np.stack([cols[col] if col in cols else values[:, channels.index(col)] for col in columns])
+    return z, origin
+
+
+
+class KalmanHandler(object):
+    def __init__(self, kf, x0, P0, columns, method="inverse", origin=None):
+        """
+        Filter the messages of one source as they arrive (see kalman.KalmanStream)
+
+        Every message, the first included, is one step of the model and one
+        update with kf.H and kf.R, so the columns must all be measured at the
+        rate of the source. The latitude and longitude of the MPU files are the
+        last GPS fix repeated at the MPU rate, not independent measurements; to
+        use the fixes with the MPU channels, fuse the t_gps source with a
+        FusionHandler.
+
+        Parameters
+        ----------
+        kf : KalmanFilter
+            The dynamical system models. Its R is the noise of the observation
+            vector formed by columns.
+        x0, P0 :
+            The initial state estimate and error covariance matrix
+        columns : list of str
+            The channels forming the observation vector. "lat_m" and "long_m"
+            are projected from latitude and longitude with a fixed origin, as
+            in pipeline.project_stage.
+        method : str
+            The update strategy (see KalmanFilter.estimate)
+        origin : tuple, optional
+            The (lat0, lon0) origin of the projection. Defaults to the first message.
+        """
+        self.stream = KalmanStream(kf, x0, P0, method=method)
+        # KalmanStream skips its first observation like estimate(), which treats
+        # it as the observation of x0; a live message always comes after x0
+        self.stream.k = 1
+        self.columns = columns
+        self.origin = origin
+
+
+    def __call__(self, t, values, channels):
+        """
+        Consume a batch of messages
+
+        Returns
+        -------
+        ndarray of shape (n,)
+            The state estimate after the last message
+        """
+        z, self.origin = _observe(self.columns, values, channels, self.origin)
+        return self.stream.step_many(z)[:, -1]
+
+
+
+class FusionHandler(object):
+    def __init__(self, fusion, x0, P0, columns, origin=None, signed=True):
+        """
+        Fuse the messages of several sources into one state estimate (see fusion.FusionFilter)
+
+        Every source is a sensor of the FusionFilter: messages of its
+        predict_on sensor advance the model, and every message is an update
+        with its own sensor's H and R. Register the handler of each source with
+        for_sensor. The messages are processed in the order the service
+        delivers them, which follows their timestamps up to one batch.
+
+        Parameters
+        ----------
+        fusion : FusionFilter
+            The shared state model and the (H, R) of every sensor
+        x0, P0 :
+            The initial state estimate and error covariance matrix
+        columns : dict
+            Maps each sensor to the channels forming its measurement vector.
+            "lat_m" and "long_m" are projected from latitude and longitude.
+        origin : tuple, optional
+            The (lat0, lon0) origin of the projection. Defaults to the first fix.
+        signed : bool
+            Whether or not to project signed offsets (see filter.project_lat_long),
+            which a position state needs
+        """
+        self.fusion = fusion
+        self.columns = columns
+        self.origin = origin
+        self.signed = signed
+        self.x = np.asarray(x0, dtype=float)
+        self.P = np.asarray(P0, dtype=float)
+
+
+    def for_sensor(self, name):
+        """
+        The handler of one source, feeding its messages to the filter as sensor name
+        """
+        if name not in self.fusion.sensors:
+            raise ValueError(f"Unknown sensor: {name}")
+        return functools.partial(self, name)
+
+
+    def __call__(self, name, t, values, channels):
+        """
+        Consume a batch of messages of one sensor
+
+        Returns
+        -------
+        ndarray of shape (n,)
+            The state estimate after the last message
+        """
+        z, self.origin = _observe(self.columns[name], values, channels, self.origin, signed=self.signed)
+        for i in range(z.shape[1]):
+            self.x, self.P = self.fusion.step(self.x, self.P, name, z[:, i])
+        return self.x
+
+
+
+class HMMHandler(object):
+    def __init__(self, models, columns, window=30000, scales=None):
+        """
+        Classify the messages of one source by their windowed HMM scores (see hmm_scorer.SlidingHMMScorer)
+
+        Parameters
+        ----------
+        models : dict
+            Maps each class name to an HMMParams or a fitted hmmlearn model
+        columns : list of str
+            The channels the models were trained on
+        window, scales :
+            See SlidingHMMScorer
+        """
+        self.scorer = SlidingHMMScorer(models, window=window, scales=scales)
+        self.columns = columns
+
+
+    def __call__(self, t, values, channels):
+        """
+        Consume a batch of messages
+
+        Returns
+        -------
+        str
+            The predicted class after the last message
+        """
+        idx = [channels.index(col) for col in self.columns]
+        return self.scorer.predict(values[:, idx])[-1]
+
+
+
+class LiveService(object):
+    def __init__(self, handlers, queue_size=1000, max_batch=256, budget=None):
+        """
+        Replay recorded sources concurrently, as they would arrive in the vehicle,
+        and process the messages as they come.
+
+        Each source runs as a producer task putting one message per record on
+        its own bounded asyncio.Queue, which stands in for the socket that sensor
+        would write to. When the consumer falls behind a queue fills up and its
+        producer waits (backpressure). The consumer visits the sources in turn
+        and takes whatever each has queued, up to max_batch messages, so bursts
+        are processed as one handler call per batch instead of per message.
+
+        Parameters
+        ----------
+        handlers : dict
+            Maps each source name to a list of handlers, callables taking
+            (t, values, channels) for a batch of that source's messages, e.g.
+            a KalmanHandler or an HMMHandler
+        queue_size : int
+            The capacity of each source's message queue
+        max_batch : int
+            The most messages processed in one batch
+        budget : float, optional
+            The latency budget in seconds; messages over it are counted
+        """
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.max_batch = max_batch
+        self.budget = budget
+        self.latest = {}
+
+
+    async def _produce(self, queue, ready, done, name, blocks, origin, speed, start):
+        """
+        Put every record of a source on its queue, paced by its timestamps
+        """
+        try:
+            for t, values in blocks:
+                for i in range(len(t)):
+                    if speed:
+                        # the message is sent when its timestamp comes due
+                        sent = start + (t[i] - origin) / speed
+                        delay = sent - time.perf_counter()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    else:
+                        sent = time.perf_counter()
+                    await queue.put((sent, t[i], values[i]))
+                    ready.set()
+        finally:
+            # the source is over even if reading it raised, so the consumer never
+            # waits on it (marked outside the queue, which may be full)
+            done.add(name)
+            ready.set()
+
+
+    def _process(self, name, batch, channels):
+        """
+        Run the handlers of a source over a batch of its messages
+        """
+        t = np.array([msg[1] for msg in batch])
+        values = np.stack([msg[2] for msg in batch])
+        with instrument.span("LiveService.batch", cat="live", source=name, rows=len(batch)):
+            self.latest[name] = [handler(t, values, channels) for handler in self.handlers.get(name, [])]
+
+
+    async def _consume(self, queues, ready, done, channels, stats):
+        """
+        Process batches until every producer is done and its queue drained
+        """
+        active = set(queues)
+        while active:
+            # wait until some source has sent something or finished
+            if all(queues[name].empty() for name in active) and not done & active:
+                ready.clear()
+                await ready.wait()
+
+            # visit every source in turn, so a fast one cannot starve the others
+            for name in list(active):
+                queue = queues[name]
+                stats["max_queue"] = max(stats["max_queue"], queue.qsize())
+                batch = []
+                while len(batch) < self.max_batch and not queue.empty():
+                    batch.append(queue.get_nowait())
+                if name in done and queue.empty():
+                    active.discard(name)
+                if not batch:
+                    continue
+
+                self._process(name, batch, channels[name])
+                now = time.perf_counter()
+                stats["latency"].append(now - np.array([msg[0] for msg in batch]))
+                stats["batches"] += 1
+
+            # let the producers run between rounds
+            await asyncio.sleep(0)
+
+
+    async def serve(self, sources, speed=1.0, chunksize=10000):
+        """
+        Replay the sources and process every message
+
+        Parameters
+        ----------
+        sources : dict
+            Maps each source name to a csv file, a replay log path or a ReplayLog
+        speed : float or None
+            The replay speed: 1 is real time, 10 is ten times faster and None
+            sends as fast as the consumer accepts messages
+        chunksize : int
+            The number of records read from a source at a time
+
+        Returns
+        -------
+        dict
+            The report (see report)
+        """
+        channels, streams, empty = {}, {}, []
+        for name, source in sources.items():
+            channels[name], blocks = iter_blocks(source, chunksize=chunksize)
+            first = next(blocks, None)
+            if first is None:
+                # nothing to replay (an empty file, or every row cleaned away)
+                empty.append(name)
+                continue
+            streams[name] = (first, blocks)
+        queues = {name: asyncio.Queue(maxsize=self.queue_size) for name in streams}
+        ready = asyncio.Event()
+        done = set()
+
+        # every source is paced from the earliest timestamp, so they stay in step
+        origin = min((first[0][0] for first, _ in streams.values() if len(first[0])), default=0.)
+        start = time.perf_counter()
+        stats = {"latency": [], "batches": 0, "max_queue": 0, "empty": empty}
+        tasks = [asyncio.create_task(self._produce(queues[name], ready, done, name, _chain(first, blocks), origin,
+                                                   speed, start))
+                 for name, (first, blocks) in streams.items()]
+        tasks.append(asyncio.create_task(self._consume(queues, ready, done, channels, stats)))
+        try:
+            # a source or a handler that raises ends the run with its exception
+            await asyncio.gather(*tasks)
+        finally:
+            # rather than leaving the other tasks blocked on a queue nobody serves
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return self.report(stats, time.perf_counter() - start)
+
+
+    def run(self, sources, speed=1.0, chunksize=10000):
+        """
+        serve() from synchronous code
+        """
+        return asyncio.run(self.serve(sources, speed=speed, chunksize=chunksize))
+
+
+    def report(self, stats, seconds):
+        """
+        Summarize a run
+
+        Returns
+        -------
+        dict
+            The number of messages, the wall time, the sustained messages/sec,
+            the p50, p99 and max end-to-end latency in milliseconds (from the
+            time a message was due to the end of its batch), the number of
+            messages over the budget, the number and mean size of the batches,
+            the deepest the queue got and the sources that had no messages
+        """
+        latency = np.concatenate(stats["latency"]) if stats["latency"] else np.zeros(0)
+        out = {"messages": len(latency), "seconds": seconds,
+               "messages_per_sec": len(latency) / seconds if seconds else float("inf"),
+               "batches": stats["batches"], "mean_batch": len(latency) / max(stats["batches"], 1),
+               "max_queue": stats["max_queue"], "empty_sources": list(stats.get("empty", []))}
+        if len(latency):
+            out["p50_ms"], out["p99_ms"] = (float(v) for v in 1e3 * np.percentile(latency, [50, 99]))
+            out["max_ms"] = float(1e3 * latency.max())
+        if self.budget is not None:
+            out["over_budget"] = int((latency > self.budget).sum())
+        return out
+
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    import benchmarks
+    from fusion import FusionFilter
+    from pipeline import iter_folders
+
+    parser = argparse.ArgumentParser(description="Replay one PVS drive through the filter as a live stream")
+    parser.add_argument("--parent", default=".data", help="the dataset folder")
+    parser.add_argument("--folder", default=None, help="the PVS folder (defaults to the first)")
+    parser.add_argument("--speed", type=float, default=10, help="replay speed, 0 for as fast as possible")
+    parser.add_argument("--budget", type=float, default=0.05, help="latency budget in seconds")
+    args = parser.parse_args()
+
+    sources = {}
+    for file_type in ("gps_mpu_left", "t_gps"):
+        for folder, path in iter_folders(args.parent, file_type):
+            if args.folder in (None, folder):
+                sources[file_type] = path
+                break
+
+    # the notebook's car model, advanced at the 100 Hz MPU rate. The dashboard
+    # accelerometer updates the accelerations with every MPU message and each
+    # t_gps fix updates the positions, projected from the first fix.
+    kf, x0, P0 = benchmarks.kinematic_model(2, dt=.01)
+    # R assumes 0.5 m/s^2 of accelerometer noise and 10 m of GPS error, about
+    # the typical accuracy column of the t_gps files
+    sensors = {"gps_mpu_left": (kf.H[2:], np.eye(2) * .5**2), "t_gps": (kf.H[:2], np.eye(2) * 10.**2)}
+    fusion = FusionHandler(FusionFilter(kf, sensors, predict_on="gps_mpu_left"), x0, P0,
+                           {"gps_mpu_left": ["acc_x_dash", "acc_y_dash"], "t_gps": ["lat_m", "long_m"]})
+    handlers = {name: [fusion.for_sensor(name)] for name in sources}
+    service = LiveService(handlers, budget=args.budget)
+    print(json.dumps(service.run(sources, speed=args.speed or None), indent=1))
@@ -0,0 +1,231 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import cleaner
+from filter import StreamingSmoother, project_lat_long
+from kalman import KalmanStream
+
+
+
+def iter_folders(parent=".data", file_type="gps_mpu_left"):
+    """
+    Find the file of one type in every PVS folder, without reading anything
+
+    Parameters
+    ----------
+    parent : str
+        The dataset folder
+    file_type : str
+        The file type key (see cleaner.FILE_TYPES)
+
+    Yields
+    ------
+    tuple (folder, path)
+        The PVS folder name and the path of its file of that type
+    """
+    for dir in sorted(os.listdir(parent)):
+        if 'PVS' not in dir:
+            continue
+        path = os.path.join(parent, dir)
+        for name in sorted(os.listdir(path)):
+            if cleaner.match_file_type(name) == file_type:
+                yield dir, os.path.join(path, name)
+                break
+
+
+
+def read_chunks(path, file_type, chunksize=10000, compact=True):
+    """
+    Read a csv file in fixed-size chunks
+
+    Parameters
+    ----------
+    path : str
+        The csv file
+    file_type : str
+        The file type key
+    chunksize : int
+        The number of rows per chunk
+    compact : bool
+        Whether or not to skip dropped columns and use compact dtypes (see cleaner.compact_read_kwargs)
+
+    Yields
+    ------
+    pd.DataFrame
+        The next chunk of rows
+    """
+    kwargs = cleaner.compact_read_kwargs(path, file_type) if compact else {}
+    yield from pd.read_csv(path, chunksize=chunksize, **kwargs)
+
+
+
+def clean_stage(chunks, file_type):
+    """
+    Clean every chunk like clean_dict does (both cleaners work row by row, so chunking does not change the result)
+    """
+    for chunk in chunks:
+        yield cleaner.clean_frame(file_type, chunk)
+
+
+
+def smooth_stage(chunks, window=100):
+    """
+    Add a <col>_smooth column for every accelerometer column.
+    Unlike add_smoothed_cols the moving average is causal (see filter.StreamingSmoother),
+    and its state is carried across chunk boundaries.
+    """
+    smoother = StreamingSmoother(window)
+    for chunk in chunks:
+        cols = [col for col in chunk.columns if "acc_" in col]
+        if cols and len(chunk):
+            chunk[[col + "_smooth" for col in cols]] = smoother.update(chunk[cols].to_numpy(dtype=float))
+        yield chunk
+
+
+
+def project_stage(chunks, origin=None, method="vincenty", signed=False):
+    """
+    Add lat_m and long_m columns with the offsets in meters from a fixed origin.
+    The origin defaults to the first row of the first chunk, as in add_lat_long_meters,
+    but the last row of the drive is kept since the stream cannot know which row is last.
+    """
+    for chunk in chunks:
+        if len(chunk):
+            lat = chunk['latitude'].to_numpy()
+            lon = chunk['longitude'].to_numpy()
+            if origin is None:
+                origin = (float(lat[0]), float(lon[0]))
+            chunk['lat_m'], chunk['long_m'] = project_lat_long(lat, lon, origin=origin, method=method, signed=signed)
+        yield chunk
+
+
+
+def mean_acc_stage(chunks):
+    """
+    Add acc_x, acc_y and acc_z columns averaging each axis over the three placements, as in kalman_filter.ipynb
+    """
+    for chunk in chunks:
+        for axis in "xyz":
+            cols = [col for col in chunk.columns if col.startswith(f"acc_{axis}_") and not col.endswith("_smooth")]
+            if cols:
+                chunk[f"acc_{axis}"] = chunk[cols].to_numpy(dtype=float).mean(axis=1)
+        yield chunk
+
+
+
+def observation_stage(chunks, columns):
+    """
+    Turn each chunk into an observation block of shape (len(columns), c), as KalmanStream expects
+    """
+    for chunk in chunks:
+        if len(chunk):
+            yield chunk[columns].to_numpy(dtype=float).T
+
+
+
+def stream_folder(path, file_type="gps_mpu_left", chunksize=10000, window=100, origin=None,
+                  method="vincenty", signed=False, compact=True):
+    """
+    Chain the read, clean, smooth, projection and mean acceleration stages for one file
+
+    Parameters
+    ----------
+    path : str
+        The csv file
+    file_type : str
+        The file type key
+    chunksize : int
+        The number of rows per chunk
+    window : int
+        The moving average window
+    origin : tuple, optional
+        The (lat0, lon0) origin of the projection. Defaults to the first row.
+    method : str
+        The projection accuracy tier (see filter.project_lat_long)
+    signed : bool
+        Whether or not to sign the offsets
+    compact : bool
+        Whether or not to read with compact dtypes
+
+    Yields
+    ------
+    pd.DataFrame
+        The processed chunks
+    """
+    chunks = read_chunks(path, file_type, chunksize=chunksize, compact=compact)
+    chunks = clean_stage(chunks, file_type)
+    if file_type != "t_gps":
+        chunks = smooth_stage(chunks, window=window)
+        chunks = mean_acc_stage(chunks)
+    chunks = project_stage(chunks, origin=origin, method=method, signed=signed)
+    yield from chunks
+
+
+
+def stream_estimates(parent, kf, x0, P0, columns, file_type="gps_mpu_left", method="inverse", **stage_kwargs):
+    """
+    Run the whole pipeline over every PVS folder and filter each drive incrementally.
+    Only one chunk per stage is alive at a time, so peak memory is bounded by the chunk
+    size rather than by the number or length of the drives.
+
+    Parameters
+    ----------
+    parent : str
+        The dataset folder
+    kf : KalmanFilter
+        The dynamical system models
+    x0 : ndarray of shape (n,)
+        The initial state estimate of every drive
+    P0 : ndarray of shape (n,n)
+        The initial error covariance matrix of every drive
+    columns : list
+        The columns forming the observation vector, e.g. ['lat_m', 'long_m', 'acc_x', 'acc_y', 'acc_z']
+    file_type : str
+        The file type to stream
+    method : str
+        The update strategy (see KalmanFilter.estimate)
+    stage_kwargs : dict
+        Passed to stream_folder (chunksize, window, origin, projection method, ...)
+
+    Yields
+    ------
+    tuple (folder, out)
+        The PVS folder and the state estimates of the next chunk, of shape (n,c)
+    """
+    for folder, path in iter_folders(parent, file_type):
+        stream = KalmanStream(kf, x0, P0, method=method)
+        observations = observation_stage(stream_folder(path, file_type=file_type, **stage_kwargs), columns)
+        for out in stream.run(observations):
+            yield folder, out
+
+
+
+def run_dataset(parent, kf, x0, P0, columns, reduce=None, **kwargs):
+    """
+    Consume stream_estimates and keep only a summary per drive
+
+    Parameters
+    ----------
+    parent : str
+        The dataset folder
+    kf, x0, P0, columns :
+        See stream_estimates
+    reduce : callable, optional
+        Maps the (n,c) estimates of one chunk to whatever should be kept.
+        Defaults to keeping the last state of the chunk.
+    kwargs : dict
+        Passed to stream_estimates
+
+    Returns
+    -------
+    dict
+        Maps each PVS folder to the list of reduced chunks
+    """
+    if reduce is None:
+        reduce = lambda out: out[:, -1].copy()
+    results = {}
+    for folder, out in stream_estimates(parent, kf, x0, P0, columns, **kwargs):
+        results.setdefault(folder, []).append(reduce(out))
+    return results
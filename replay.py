@@ -0,0 +1,311 @@
+import bisect
+import itertools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import cleaner
+from pipeline import iter_folders
+
+
+# the first bytes of every replay log, followed by the header length and the JSON header
+MAGIC = b"PVSREPL1"
+
+# records start on a multiple of this many bytes
+ALIGN = 64
+
+
+
+def record_dtype(n_channels):
+    """
+    The fixed record of a replay log: an int64 timestamp and the float32 channels
+    """
+    return np.dtype([("t", "<i8"), ("values", "<f4", (n_channels,))])
+
+
+
+def _write_header(f, header):
+    """
+    Write the magic, the header length and the JSON header, padded so the records are aligned.
+    The header records where the records start as "data_offset".
+    """
+    start = len(MAGIC) + 4
+    header["data_offset"] = 0
+    while True:
+        body = json.dumps(header).encode()
+        size = -(-(start + len(body)) // ALIGN) * ALIGN - start
+        if header["data_offset"] == start + size:
+            break
+        header["data_offset"] = start + size
+    f.write(MAGIC)
+    f.write(np.uint32(size).tobytes())
+    f.write(body.ljust(size))
+    return start + size
+
+
+
+def _first_finite(chunks, columns):
+    """
+    The first finite value of each column over a sequence of chunks, stopping
+    as soon as every column has one (None for a column that never does)
+    """
+    found = dict.fromkeys(columns)
+    for chunk in chunks:
+        for col in columns:
+            if found[col] is None:
+                values = chunk[col].to_numpy(dtype=float)
+                finite = np.flatnonzero(np.isfinite(values))
+                if len(finite):
+                    found[col] = float(values[finite[0]])
+        if all(v is not None for v in found.values()):
+            break
+    return found
+
+
+
+def convert_csv(path, out, file_type=None, time_col="timestamp", time_scale=1000000, clean=True, chunksize=100000):
+    """
+    Convert a PVS csv file to a replay log, a header followed by fixed-size records
+
+    The csv is read in chunks, so converting never holds more than one chunk.
+    Timestamps are stored as int64 ticks (time_scale ticks per second) and
+    every other numeric column as a float32 channel. Columns that need more
+    precision than float32 (cleaner.FLOAT64_COLS, e.g. latitude) are stored as
+    offsets from their first finite value, which the header records as the
+    channel bias. If the first chunk lacks one, the file is scanned ahead for
+    it (one chunk at a time) before anything is written, and a file where some
+    channel has none raises a ValueError.
+
+    Parameters
+    ----------
+    path : str
+        The csv file
+    out : str
+        The replay log to write
+    file_type : str, optional
+        The file type key. Defaults to the one matching the file name.
+    time_col : str
+        The timestamp column, in seconds
+    time_scale : int
+        Ticks per second of the stored timestamps (microseconds by default)
+    clean : bool
+        Whether or not to clean the rows like clean_dict does
+    chunksize : int
+        The number of csv rows converted at a time
+
+    Returns
+    -------
+    int
+        The number of records written
+    """
+    file_type = file_type or cleaner.match_file_type(os.path.basename(path))
+    kwargs = cleaner.compact_read_kwargs(path, file_type) if file_type is not None else {}
+
+    def chunks():
+        for chunk in pd.read_csv(path, chunksize=chunksize, **kwargs):
+            yield cleaner.clean_frame(file_type, chunk) if clean and file_type is not None else chunk
+
+    reader = chunks()
+    first = next(reader, None)
+    if first is None:
+        raise ValueError(f"{path} has no rows")
+    # the first chunk decides the channels
+    channels = [col for col in first.columns if col != time_col and pd.api.types.is_numeric_dtype(first[col])]
+    wide = [col for col in channels if col in cleaner.FLOAT64_COLS]
+    bias = {col: 0. for col in channels}
+    bias.update(_first_finite([first], wide))
+    missing = [col for col in wide if bias[col] is None]
+    if missing:
+        # rare (leading NaNs, or a first chunk emptied by cleaning): look further
+        # with a second reader, one chunk at a time, rather than holding chunks back
+        bias.update(_first_finite(itertools.islice(chunks(), 1, None), missing))
+        missing = [col for col in missing if bias[col] is None]
+    if missing:
+        # a float32 offset from a made up bias would lose the precision the bias is for
+        raise ValueError(f"{path} has no finite values of {', '.join(missing)} to use as the bias")
+
+    count, last = 0, None
+    tmp = out + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            header = {"version": 1, "source": os.path.abspath(path), "file_type": file_type,
+                      "time_col": time_col, "time_scale": time_scale, "channels": channels,
+                      "bias": bias, "dtype": record_dtype(len(channels)).descr}
+            _write_header(f, header)
+            for chunk in itertools.chain([first], reader):
+                if not len(chunk):
+                    continue
+                records = np.empty(len(chunk), dtype=record_dtype(len(channels)))
+                records["t"] = np.round(chunk[time_col].to_numpy(dtype=float) * time_scale)
+                for j, col in enumerate(channels):
+                    records["values"][:, j] = chunk[col].to_numpy(dtype=float) - bias[col]
+
+                # binary search needs sorted timestamps
+                if np.any(np.diff(records["t"]) < 0) or (last is not None and records["t"][0] < last):
+                    raise ValueError(f"{path} is not sorted by {time_col}")
+                last = records["t"][-1]
+                f.write(records.tobytes())
+                count += len(records)
+    except BaseException:
+        # never leave a partial log behind, whatever stopped the conversion
+        os.remove(tmp)
+        raise
+    os.replace(tmp, out)
+    return count
+
+
+
+def convert_dataset(parent, out_dir, file_types=("gps_mpu_left", "gps_mpu_right"), **kwargs):
+    """
+    Convert one file type (or several) of every PVS folder to replay logs
+
+    Parameters
+    ----------
+    parent : str
+        The dataset folder
+    out_dir : str
+        Where to write <folder>/<file_type>.rpl
+    file_types : list of str
+        The file types to convert
+    kwargs : dict
+        Passed to convert_csv
+
+    Returns
+    -------
+    dict
+        Maps (folder, file_type) to the path of its replay log
+    """
+    paths = {}
+    for file_type in file_types:
+        for folder, path in iter_folders(parent, file_type):
+            os.makedirs(os.path.join(out_dir, folder), exist_ok=True)
+            paths[folder, file_type] = os.path.join(out_dir, folder, file_type + ".rpl")
+            convert_csv(path, paths[folder, file_type], file_type=file_type, **kwargs)
+    return paths
+
+
+
+class ReplayLog(object):
+    def __init__(self, path):
+        """
+        A memory mapped replay log (see convert_csv). Nothing is read until it
+        is used, and time ranges are found by binary search on the timestamps,
+        so a slice touches only the pages it covers however large the log is.
+
+        Parameters
+        ----------
+        path : str
+            The replay log
+        """
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a replay log")
+            size = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+            self.header = json.loads(f.read(size))
+        self.path = path
+        self.channels = self.header["channels"]
+        self.bias = self.header["bias"]
+        self.time_scale = self.header["time_scale"]
+        self.dtype = record_dtype(len(self.channels))
+        n = (os.path.getsize(path) - self.header["data_offset"]) // self.dtype.itemsize
+        self.records = np.memmap(path, dtype=self.dtype, mode="r", offset=self.header["data_offset"], shape=(n,))
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    @property
+    def t(self):
+        """
+        The int64 timestamps (a view of the records)
+        """
+        return self.records["t"]
+
+
+    def index(self, start=None, stop=None):
+        """
+        The records with start <= time < stop, in seconds
+
+        Returns
+        -------
+        slice
+        """
+        # bisect on the strided view touches about log2(n) records, whereas
+        # np.searchsorted would first copy every timestamp out of the records
+        t = self.records["t"]
+        lo = 0 if start is None else bisect.bisect_left(t, round(start * self.time_scale))
+        hi = len(t) if stop is None else bisect.bisect_left(t, round(stop * self.time_scale))
+        return slice(lo, max(lo, hi))
+
+
+    def slice(self, start=None, stop=None):
+        """
+        The records of a time range, as a view of the memory map
+        """
+        return self.records[self.index(start, stop)]
+
+
+    def seconds(self, start=None, stop=None):
+        """
+        The timestamps of a time range in seconds
+        """
+        return self.slice(start, stop)["t"] / self.time_scale
+
+
+    def observations(self, columns=None, start=None, stop=None):
+        """
+        The channels of a time range as an (m,n) observation matrix, as
+        KalmanFilter.estimate expects
+
+        This is a view of the memory map (nothing is copied or read until the
+        filter touches it) when the columns are adjacent channels in log order.
+        Channels with a bias (see convert_csv) are offsets from it, which is
+        what a filter working in local coordinates wants anyway.
+
+        Parameters
+        ----------
+        columns : list of str, optional
+            The channels, in observation vector order. Defaults to every channel.
+        start, stop : float, optional
+            The time range in seconds
+
+        Returns
+        -------
+        ndarray of shape (m,n)
+        """
+        values = self.slice(start, stop)["values"]
+        if columns is None:
+            return values.T
+        idx = [self.channels.index(col) for col in columns]
+        if idx == list(range(idx[0], idx[0] + len(idx))):
+            return values[:, idx[0]:idx[-1] + 1].T
+        return values[:, idx].T
+
+
+    def samples(self, columns=None, start=None, stop=None):
+        """
+        The channels of a time range as an (n,m) view, as the smoothing functions expect
+        """
+        return self.observations(columns, start, stop).T
+
+
+    def channel(self, name, start=None, stop=None):
+        """
+        One channel of a time range in its original units (bias added back, as float64)
+        """
+        values = self.slice(start, stop)["values"][:, self.channels.index(name)]
+        return values.astype(float) + self.bias[name]
+
+
+    def frame(self, start=None, stop=None):
+        """
+        A time range as a DataFrame with the original columns (a copy)
+        """
+        records = self.slice(start, stop)
+        df = pd.DataFrame({self.header["time_col"]: records["t"] / self.time_scale})
+        for j, col in enumerate(self.channels):
+            df[col] = records["values"][:, j].astype(float) + self.bias[col]
+        return df
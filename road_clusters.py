@@ -0,0 +1,381 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import eigsh
+from scipy.spatial import cKDTree
+from sklearn.cluster import KMeans
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+
+import instrument
+from cleaner import LabelCodec
+
+
+
+# window statistics window_features can compute
+WINDOW_STATS = ["rms", "std", "mean"]
+
+
+
+def _window_sums(x, window, step):
+    """
+    The sums of x over every window of length `window` starting every `step` rows, from one cumulative sum
+    """
+    csum = np.zeros((len(x) + 1,) + x.shape[1:])
+    np.cumsum(x, axis=0, out=csum[1:])
+    starts = np.arange(0, len(x) - window + 1, step)
+    return csum[starts + window] - csum[starts], starts
+
+
+def window_features(df, columns=None, window=100, step=50, stats=("std",)):
+    """
+    Summarize the accelerometer of one drive over sliding windows
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The cleaned gps_mpu data of one drive
+    columns : list of str, optional
+        The channels to summarize. Defaults to every acc_z column (the vertical
+        axis of each placement), smoothed or not, e.g. acc_z_dash_smooth.
+    window : int
+        The window length in rows (100 rows is one second)
+    step : int
+        The distance between window starts in rows
+    stats : list of str
+        Which of WINDOW_STATS to compute per column: "rms" about zero, "std"
+        (the rms about the window mean, i.e. the vibration energy) and "mean"
+
+    Returns
+    -------
+    features : pd.DataFrame
+        One row per window and one <column>_<stat> column per pair
+    starts : ndarray
+        The first row (position in df) of every window
+    """
+    if columns is None:
+        columns = [col for col in df.columns if col.startswith("acc_z_")]
+    for stat in stats:
+        if stat not in WINDOW_STATS:
+            raise ValueError(f"Unknown window statistic: {stat}")
+
+    x = df[columns].to_numpy(dtype=float)
+    if len(x) < window:
+        return pd.DataFrame(columns=[f"{col}_{stat}" for stat in stats for col in columns]), np.zeros(0, dtype=int)
+    s1, starts = _window_sums(x, window, step)
+    s2, _ = _window_sums(x * x, window, step)
+    mean = s1 / window
+    values = {"mean": mean, "rms": np.sqrt(s2 / window),
+              "std": np.sqrt(np.maximum(s2 / window - mean**2, 0))}
+    features = pd.DataFrame(np.hstack([values[stat] for stat in stats]),
+                            columns=[f"{col}_{stat}" for stat in stats for col in columns])
+    return features, starts
+
+
+
+def window_labels(codes, starts, window, n_classes):
+    """
+    The majority class of every window, from per-row class codes
+
+    Parameters
+    ----------
+    codes : ndarray of shape (rows,)
+        The class code of every row (-1 where unlabeled), e.g. a column of LabelCodec.codes
+    starts : ndarray
+        The first row of every window
+    window : int
+        The window length in rows
+    n_classes : int
+        The number of classes
+
+    Returns
+    -------
+    ndarray of shape (len(starts),), dtype int8
+        The most common code in each window, or -1 if no row of the window is labeled
+    """
+    # count every class per window with one cumulative sum over the one hot codes
+    onehot = np.zeros((len(codes) + 1, n_classes + 1), dtype=np.int32)
+    onehot[np.arange(1, len(codes) + 1), np.where(codes >= 0, codes, n_classes)] = 1
+    csum = np.cumsum(onehot, axis=0)
+    counts = csum[starts + window] - csum[starts]
+    labels = counts[:, :n_classes].argmax(axis=1).astype(np.int8)
+    labels[counts[:, :n_classes].max(axis=1) == 0] = -1
+    return labels
+
+
+
+def drive_windows(ddict, file_type="gps_mpu_left", group="road", splits=("train", "val", "test"), **feature_kwargs):
+    """
+    Window every drive of a load_data dictionary and label the windows
+
+    The labels file of a drive has one row per gps_mpu row, and cleaning keeps
+    the original index, so every cleaned row is matched to its label by index.
+
+    Parameters
+    ----------
+    ddict : dict
+        The cleaned dictionary of load_data (or Dataset.to_dict)
+    file_type : str
+        The accelerometer file to window
+    group : str
+        The LABEL_GROUPS group to label the windows with, e.g. "road" or "condition"
+    splits : list of str
+        The splits to include
+    feature_kwargs : dict
+        Passed to window_features (columns, window, step, stats)
+
+    Returns
+    -------
+    features : pd.DataFrame
+        One row per window of every drive
+    windows : pd.DataFrame
+        The folder, first row and majority label code of every window
+    classes : list of str
+        The classes of the group (label code i is classes[i])
+    """
+    codec = LabelCodec()
+    g = codec.names.index(group)
+    window = feature_kwargs.get("window", 100)
+    features, windows = [], []
+    for split in splits:
+        frames = ddict[split].get(file_type) or {}
+        labels = ddict[split].get("labels") or {}
+        for folder in sorted(frames):
+            df = frames[folder]
+            with instrument.span("drive_windows.folder", folder=folder, rows=len(df)):
+                f, starts = window_features(df, **feature_kwargs)
+                if folder in labels:
+                    codes = codec.codes(labels[folder].reindex(df.index, fill_value=0))[:, g]
+                else:
+                    codes = np.full(len(df), -1, dtype=np.int8)
+                features.append(f)
+                windows.append(pd.DataFrame({"folder": folder, "start": starts,
+                                             "label": window_labels(codes, starts, window, len(codec.groups[group]))}))
+    return (pd.concat(features, ignore_index=True), pd.concat(windows, ignore_index=True),
+            list(codec.groups[group]))
+
+
+
+def knn_affinity(X, n_neighbors=10):
+    """
+    A sparse, symmetric k nearest neighbor affinity matrix
+
+    Edges get the self-tuning Gaussian weight exp(-d_ij^2 / (s_i s_j)), where s_i
+    is the distance from i to its k-th neighbor, so dense and sparse regions of
+    feature space are connected alike. The matrix holds O(N k) entries instead
+    of the N^2 of a dense affinity.
+
+    Parameters
+    ----------
+    X : ndarray of shape (N,F)
+        The (standardized) features
+    n_neighbors : int
+        The number of neighbors of every point
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix of shape (N,N)
+    """
+    k = min(n_neighbors, len(X) - 1)
+    dist, idx = cKDTree(X).query(X, k=k + 1)
+    dist, idx = dist[:, 1:], idx[:, 1:]
+    scale = np.maximum(dist[:, -1], 1e-12)
+    weights = np.exp(-dist**2 / (scale[:, None] * scale[idx]))
+    A = sparse.csr_matrix((weights.ravel(), (np.repeat(np.arange(len(X)), k), idx.ravel())), shape=(len(X), len(X)))
+    return A.maximum(A.T)
+
+
+def sparse_embedding(A, n_components, seed=0, tol=0):
+    """
+    The spectral embedding of a sparse affinity matrix: the leading eigenvectors
+    of D^-1/2 A D^-1/2 (Ng, Jordan and Weiss), found with Lanczos iterations
+
+    Parameters
+    ----------
+    A : sparse matrix of shape (N,N)
+        The symmetric affinities
+    n_components : int
+        The number of eigenvectors
+    seed : int
+        Seed for the starting vector
+    tol : float
+        The eigenvalue tolerance (0 is machine precision). A looser tolerance
+        is faster, but a graph with several connected components has a
+        repeated eigenvalue 1 and Lanczos may then return only one copy of it.
+
+    Returns
+    -------
+    ndarray of shape (N,n_components)
+    """
+    d = np.asarray(A.sum(axis=1)).ravel()
+    dinv = 1 / np.sqrt(np.maximum(d, 1e-12))
+    M = sparse.diags(dinv) @ A @ sparse.diags(dinv)
+    v0 = np.random.default_rng(seed).random(A.shape[0])
+    vals, vecs = eigsh(M, k=n_components, which="LA", v0=v0, tol=tol, ncv=max(2 * n_components + 1, 32))
+    return vecs[:, np.argsort(vals)[::-1]]
+
+
+def nystrom_embedding(X, n_components, n_landmarks=500, gamma=None, seed=0, block=65536):
+    """
+    The spectral embedding of a Gaussian affinity, approximated from a sample of
+    landmark points (Nystrom, as in Fowlkes et al. 2004). Only the (N,m)
+    affinities to the landmarks are formed, never the (N,N) matrix.
+
+    Parameters
+    ----------
+    X : ndarray of shape (N,F)
+        The (standardized) features
+    n_components : int
+        The number of eigenvectors
+    n_landmarks : int
+        The number of landmarks m
+    gamma : float, optional
+        The affinity is exp(-gamma d^2). Defaults to one over the median squared
+        distance between landmarks.
+    seed : int
+        Seed for choosing the landmarks
+    block : int
+        The number of rows of C computed at a time (bounds the temporaries)
+
+    Returns
+    -------
+    ndarray of shape (N,n_components)
+    """
+    rng = np.random.default_rng(seed)
+    L = X[rng.choice(len(X), size=min(n_landmarks, len(X)), replace=False)]
+    ll = (L**2).sum(axis=1)
+
+    def affinity(a, out):
+        # exp(-gamma |a - l|^2), written into out without (rows,m) temporaries
+        np.matmul(a, L.T, out=out)
+        out *= -2
+        out += (a**2).sum(axis=1)[:, None]
+        out += ll
+        np.maximum(out, 0, out=out)
+        out *= -gamma
+        return np.exp(out, out=out)
+
+    W = np.maximum(ll[:, None] + ll[None] - 2 * L @ L.T, 0)
+    if gamma is None:
+        gamma = 1 / max(np.median(W[np.triu_indices(len(W), 1)]), 1e-12)
+    W = np.exp(-gamma * W)
+    C = np.empty((len(X), len(L)))
+    for i in range(0, len(X), block):
+        affinity(X[i:i + block], C[i:i + block])
+
+    # approximate degrees d = C W^+ C^T 1, then normalize C like D^-1/2 A D^-1/2
+    vals, vecs = np.linalg.eigh(W)
+    keep = vals > vals.max() * 1e-10
+    W_isqrt = (vecs[:, keep] / np.sqrt(vals[keep])) @ vecs[:, keep].T
+    d = C @ (W_isqrt @ (W_isqrt @ C.sum(axis=0)))
+    C /= np.sqrt(np.maximum(d, 1e-12))[:, None]
+
+    # with R = C W^-1/2 the approximate affinity is R R^T, whose leading
+    # eigenvectors come from the small (m,m) matrix R^T R
+    vals, vecs = np.linalg.eigh(W_isqrt @ (C.T @ C) @ W_isqrt)
+    top = np.argsort(vals)[::-1][:n_components]
+    return C @ (W_isqrt @ vecs[:, top] / np.sqrt(np.maximum(vals[top], 1e-12)))
+
+
+
+@instrument.timed("cluster_windows", rows=len)
+def cluster_windows(features, n_clusters, method="knn", n_neighbors=10, n_landmarks=500, seed=0):
+    """
+    Spectral clustering of window features without a dense affinity matrix
+
+    Parameters
+    ----------
+    features : pd.DataFrame or ndarray of shape (N,F)
+        The window features (standardized here)
+    n_clusters : int
+        The number of clusters
+    method : str
+        "knn" for a sparse k nearest neighbor graph (see knn_affinity), or
+        "nystrom" for a landmark approximation of a dense Gaussian affinity
+    n_neighbors : int
+        The neighbors per point of the "knn" graph
+    n_landmarks : int
+        The landmarks of "nystrom"
+    seed : int
+        The random seed
+
+    Returns
+    -------
+    ndarray of shape (N,)
+        The cluster of every window
+    """
+    X = np.asarray(features, dtype=float)
+    X = (X - X.mean(axis=0)) / np.maximum(X.std(axis=0), 1e-12)
+    if method == "knn":
+        E = sparse_embedding(knn_affinity(X, n_neighbors=n_neighbors), n_clusters, seed=seed)
+    elif method == "nystrom":
+        E = nystrom_embedding(X, n_clusters, n_landmarks=n_landmarks, seed=seed)
+    else:
+        raise ValueError(f"Unknown method: {method}")
+
+    # k-means on the row normalized embedding
+    E = E / np.maximum(np.linalg.norm(E, axis=1, keepdims=True), 1e-12)
+    return KMeans(n_clusters=n_clusters, n_init=10, random_state=seed).fit_predict(E)
+
+
+
+def agreement(labels, clusters, classes=None):
+    """
+    Compare clusters with the labeled classes (unlabeled windows, code -1, are skipped)
+
+    Parameters
+    ----------
+    labels : ndarray of shape (N,)
+        The class code of every window
+    clusters : ndarray of shape (N,)
+        The cluster of every window
+    classes : list of str, optional
+        The class names, for the mapping and the confusion matrix
+
+    Returns
+    -------
+    dict
+        "ari" (adjusted Rand index) and "nmi" (normalized mutual information),
+        "accuracy" when every cluster is mapped to its majority class,
+        that "mapping" and the "confusion" matrix (classes by clusters)
+    """
+    labels, clusters = np.asarray(labels), np.asarray(clusters)
+    keep = labels >= 0
+    labels, clusters = labels[keep], clusters[keep]
+    names = (lambda code: classes[code]) if classes is not None else (lambda code: code)
+
+    confusion = pd.crosstab(pd.Series([names(c) for c in labels], name="class"), pd.Series(clusters, name="cluster"))
+    mapping = {int(c): confusion[c].idxmax() for c in confusion.columns}
+    correct = sum(confusion[c].max() for c in confusion.columns)
+    return {"windows": int(keep.sum()),
+            "ari": float(adjusted_rand_score(labels, clusters)),
+            "nmi": float(normalized_mutual_info_score(labels, clusters)),
+            "accuracy": correct / max(len(labels), 1),
+            "mapping": mapping, "confusion": confusion}
+
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    import cleaner
+    import filter
+
+    parser = argparse.ArgumentParser(description="Cluster every accelerometer window of the dataset by road type")
+    parser.add_argument("--parent", default=".data", help="the dataset folder")
+    parser.add_argument("--group", default="road", help="the label group to compare with")
+    parser.add_argument("--clusters", type=int, default=3)
+    parser.add_argument("--method", default="knn", choices=["knn", "nystrom"])
+    parser.add_argument("--window", type=int, default=100)
+    parser.add_argument("--step", type=int, default=50)
+    args = parser.parse_args()
+
+    data = cleaner.clean_dict(cleaner.load_data(args.parent, compact=True))
+    filter.add_smoothed_cols(data, window=200)
+    start = time.perf_counter()
+    features, windows, classes = drive_windows(data, group=args.group, window=args.window, step=args.step)
+    windows["cluster"] = cluster_windows(features, args.clusters, method=args.method)
+    result = agreement(windows["label"], windows["cluster"], classes)
+    print(f"{len(windows)} windows clustered in {time.perf_counter() - start:.1f}s")
+    print({k: v for k, v in result.items() if k != "confusion"})
+    print(result["confusion"])
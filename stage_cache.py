@@ -0,0 +1,288 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import cleaner
+import instrument
+
+
+# bump when the hashing or the entry layout changes
+STAGE_CACHE_VERSION = 1
+
+# the memory address in reprs like <object at 0x7f...>
+_ADDRESS = re.compile(r" at 0x[0-9a-fA-F]+")
+
+
+
+def fingerprint(obj, h=None):
+    """
+    Hash the content of stage inputs and parameters
+
+    Arrays and frames are hashed by dtype, shape and raw bytes (frames also by
+    column names and index), dicts by their sorted items, and anything else by
+    its repr, so equal data always gives equal digests however it was produced.
+    Objects whose repr is their memory address (functions, or instances of
+    classes without a repr) would give a new key every run, so they raise a
+    TypeError instead.
+
+    Parameters
+    ----------
+    obj : ndarray, pd.DataFrame, pd.Series, dict, list, tuple or scalar
+        The value to hash
+    h : hashlib hash, optional
+        The hash to update. A new blake2b hash is used if not given.
+
+    Returns
+    -------
+    hashlib hash
+        The updated hash (call .hexdigest() for the key)
+    """
+    if h is None:
+        h = hashlib.blake2b(digest_size=20)
+    if isinstance(obj, pd.DataFrame):
+        h.update(b"frame")
+        fingerprint([str(c) for c in obj.columns], h)
+        fingerprint(obj.index, h)
+        for col in obj.columns:
+            fingerprint(obj[col], h)
+    elif isinstance(obj, (pd.Series, pd.Index)):
+        values = obj.to_numpy()
+        if values.dtype == object:
+            # strings and mixed values have no stable raw bytes
+            values = pd.util.hash_array(values)
+        fingerprint(values, h)
+    elif isinstance(obj, np.ndarray):
+        if obj.dtype == object:
+            obj = pd.util.hash_array(obj.ravel())
+        h.update(f"array{obj.dtype.str}{obj.shape}".encode())
+        h.update(np.ascontiguousarray(obj).data)
+    elif isinstance(obj, dict):
+        h.update(b"dict")
+        for k in sorted(obj, key=str):
+            fingerprint(str(k), h)
+            fingerprint(obj[k], h)
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"seq{len(obj)}".encode())
+        for item in obj:
+            fingerprint(item, h)
+    else:
+        text = repr(obj)
+        if _ADDRESS.search(text):
+            raise TypeError(f"Cannot fingerprint a {type(obj).__name__}: its repr {text} does not depend on its content")
+        h.update(text.encode())
+    return h
+
+
+
+class StageCache(object):
+    def __init__(self, cache_dir=".cache/stages", max_bytes=2 * 1024**3, mmap=True):
+        """
+        A content-addressed, size capped disk cache for the results of pipeline stages.
+
+        A result is keyed by the stage name, a hash of its input data and its
+        parameters, so only stages whose inputs or parameters changed are
+        recomputed. DataFrames are stored column by column like the load_data
+        cache (see cleaner.read_csv_cached) and arrays as .npy files. Every hit
+        refreshes the entry, and once the cache grows past max_bytes the least
+        recently used entries are deleted.
+
+        Parameters
+        ----------
+        cache_dir : str
+            The cache directory
+        max_bytes : int
+            The size cap of the cache
+        mmap : bool
+            Whether or not to memory map cached results. The maps are
+            copy-on-write, so results can be modified like computed ones and
+            writes never change the cache entry.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.mmap = mmap
+        self.hits = 0
+        self.misses = 0
+
+
+    def key(self, name, inputs, params):
+        """
+        The digest of a stage run
+
+        Parameters
+        ----------
+        name : str
+            The stage name
+        inputs :
+            The input data (anything fingerprint accepts)
+        params : dict
+            The stage parameters
+
+        Returns
+        -------
+        str
+        """
+        h = fingerprint([STAGE_CACHE_VERSION, name, params])
+        return fingerprint(inputs, h).hexdigest()
+
+
+    def _entry(self, name, digest):
+        return os.path.join(self.cache_dir, name, digest)
+
+
+    def get(self, name, digest):
+        """
+        Read a cached result, or return None if there is none
+        """
+        entry = self._entry(name, digest)
+        if os.path.exists(os.path.join(entry, "array.npy")):
+            # a copy-on-write map, as a plain ndarray like the columns of cleaner.read_columnar
+            value = np.asarray(np.load(os.path.join(entry, "array.npy"), mmap_mode="c" if self.mmap else None))
+        else:
+            value = cleaner.read_columnar(entry, digest, mmap=self.mmap)
+            if value is None:
+                return None
+
+        # refresh the entry for the LRU eviction
+        os.utime(entry)
+        return value
+
+
+    def put(self, name, digest, value):
+        """
+        Store a result (a DataFrame or an ndarray) and evict old entries if the cache is over its cap
+        """
+        entry = self._entry(name, digest)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        if isinstance(value, pd.DataFrame):
+            cleaner.write_columnar(entry, digest, value)
+        elif isinstance(value, np.ndarray):
+            tmp = entry + ".tmp"
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+            os.makedirs(tmp)
+            np.save(os.path.join(tmp, "array.npy"), value)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.replace(tmp, entry)
+        else:
+            raise TypeError(f"Cannot cache a {type(value).__name__}, only DataFrames and ndarrays")
+        self.evict()
+
+
+    def run(self, name, fn, inputs, params=None):
+        """
+        Return the cached result of a stage, computing and storing it on a miss
+
+        Parameters
+        ----------
+        name : str
+            The stage name
+        fn : callable
+            Computes the result with no arguments (it must not modify inputs)
+        inputs :
+            The data fn depends on, hashed into the key
+        params : dict, optional
+            The parameters fn depends on, hashed into the key
+
+        Returns
+        -------
+        pd.DataFrame or ndarray
+            The result of fn, read back from the cache
+        """
+        digest = self.key(name, inputs, params or {})
+        value = self.get(name, digest)
+        if value is not None:
+            self.hits += 1
+            instrument.count("stage_cache.hit")
+            return value
+
+        self.misses += 1
+        instrument.count("stage_cache.miss")
+        value = fn()
+        self.put(name, digest, value)
+        # read back so hits and misses return the same kind of frame
+        cached = self.get(name, digest)
+        return value if cached is None else cached
+
+
+    def entries(self):
+        """
+        List the cache entries
+
+        Returns
+        -------
+        list of tuple (path, bytes, last_used)
+            Oldest first
+        """
+        out = []
+        if not os.path.isdir(self.cache_dir):
+            return out
+        for name in os.listdir(self.cache_dir):
+            stage = os.path.join(self.cache_dir, name)
+            if not os.path.isdir(stage):
+                continue
+            for digest in os.listdir(stage):
+                entry = os.path.join(stage, digest)
+                if digest.endswith(".tmp") or not os.path.isdir(entry):
+                    continue
+                size = sum(f.stat().st_size for f in os.scandir(entry) if f.is_file())
+                out.append((entry, size, os.stat(entry).st_mtime))
+        return sorted(out, key=lambda e: e[2])
+
+
+    def size(self):
+        """
+        The total size of the cache in bytes
+        """
+        return sum(size for _, size, _ in self.entries())
+
+
+    def evict(self, max_bytes=None):
+        """
+        Delete least recently used entries until the cache fits in max_bytes (defaults to the cap)
+        """
+        limit = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for entry, size, _ in entries:
+            if total <= limit:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+    def clear(self):
+        """
+        Delete every entry
+        """
+        self.evict(0)
+
+
+
+def cached_estimate(cache, kf, x0, P0, z, method="inverse"):
+    """
+    KalmanFilter.estimate through a StageCache, keyed by the models, the initial state and the observations
+
+    Parameters
+    ----------
+    cache : StageCache
+        The cache
+    kf : KalmanFilter
+        The dynamical system models
+    x0, P0, z, method :
+        See KalmanFilter.estimate
+
+    Returns
+    -------
+    ndarray of shape (n,N)
+        The state estimates
+    """
+    inputs = {"F": kf.F, "Q": kf.Q, "H": kf.H, "R": kf.R, "G": kf.G, "u": kf.u,
+              "x0": np.asarray(x0), "P0": np.asarray(P0), "z": np.asarray(z)}
+    return cache.run("KalmanFilter.estimate", lambda: kf.estimate(x0, P0, z, method=method), inputs,
+                     {"method": method})
@@ -0,0 +1,372 @@
+import itertools
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from kalman import KalmanFilter
+
+
+
+def param_grid(grid):
+    """
+    Expand a grid of parameter values into every combination
+
+    Parameters
+    ----------
+    grid : dict
+        Maps each parameter name to a list of values
+
+    Returns
+    -------
+    list of dict
+        One dictionary of parameters per combination
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+
+def share_arrays(arrays, folder):
+    """
+    Write arrays as .npy files that worker processes can memory map instead of
+    receiving a pickled copy with every task
+
+    Parameters
+    ----------
+    arrays : dict
+        Maps a name to an ndarray
+    folder : str
+        Where to write the files
+
+    Returns
+    -------
+    dict
+        Maps each name to its .npy path
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = {}
+    for name, array in arrays.items():
+        paths[name] = os.path.join(folder, name + ".npy")
+        np.save(paths[name], np.ascontiguousarray(array))
+    return paths
+
+
+
+# the memory mapped arrays of a worker process, opened once by _open_arrays
+_ARRAYS = {}
+
+
+def _open_arrays(paths):
+    """
+    Pool initializer: memory map the shared arrays read only
+    """
+    _ARRAYS.clear()
+    for name, path in paths.items():
+        _ARRAYS[name] = np.load(path, mmap_mode="r")
+
+
+def _run_task(score_fn, params):
+    """
+    Score one parameter combination inside a worker
+    """
+    start = time.perf_counter()
+    record = {"params": params}
+    try:
+        result = score_fn(_ARRAYS, **params)
+        if isinstance(result, dict):
+            record.update(result)
+        else:
+            record["score"] = float(result)
+    except Exception as e:
+        record["score"] = None
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+
+def _task_key(params):
+    """
+    A stable identifier for a parameter combination
+    """
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+
+def _ends_with_newline(path):
+    """
+    Whether a file is empty or ends with a complete line (checked in binary
+    mode, since text mode offsets cannot be used for arithmetic)
+    """
+    if not os.path.getsize(path):
+        return True
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+
+def load_checkpoint(path):
+    """
+    Read the records of a (possibly interrupted) sweep
+
+    Parameters
+    ----------
+    path : str
+        The JSON lines checkpoint file
+
+    Returns
+    -------
+    list of dict
+        The finished records, the latest one per parameter combination
+        (a partially written line is ignored)
+    """
+    records = {}
+    if path is None or not os.path.exists(path):
+        return []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[_task_key(record["params"])] = record
+    return list(records.values())
+
+
+
+def run_sweep(score_fn, grid, arrays, checkpoint=None, workers=None, retry_failed=False, maximize=True, verbose=False):
+    """
+    Score every parameter combination across a process pool
+
+    The arrays are written once to memory mapped .npy files and every worker
+    maps them read only, so tasks only carry their parameters. Each finished
+    task is appended to the checkpoint file right away; running the same sweep
+    again skips the combinations already recorded there.
+
+    Parameters
+    ----------
+    score_fn : callable
+        score_fn(arrays, **params) returns a score (larger is better unless
+        maximize=False) or a dict with a "score" key and any extra fields.
+        It must be a module level function so it can be sent to the workers.
+    grid : dict or list of dict
+        The parameter grid (see param_grid), or the combinations themselves
+    arrays : dict
+        Maps a name to an ndarray, or to the path of a .npy file already on disk
+    checkpoint : str, optional
+        The JSON lines file recording finished tasks
+    workers : int, optional
+        The number of processes. Defaults to every core.
+    retry_failed : bool
+        Whether or not to rerun combinations whose recorded run raised
+    maximize : bool
+        Whether larger scores are better
+    verbose : bool
+        Whether or not to print each result as it finishes
+
+    Returns
+    -------
+    pd.DataFrame
+        The leaderboard (see leaderboard)
+    """
+    tasks = param_grid(grid) if isinstance(grid, dict) else list(grid)
+
+    # skip what an earlier run already finished
+    records = load_checkpoint(checkpoint)
+    if retry_failed:
+        records = [r for r in records if r.get("error") is None]
+    done = {_task_key(r["params"]) for r in records}
+    todo = [params for params in tasks if _task_key(params) not in done]
+
+    if todo:
+        with tempfile.TemporaryDirectory() as tmp:
+            # arrays that are already .npy files are mapped in place
+            paths = {name: a for name, a in arrays.items() if isinstance(a, str)}
+            paths.update(share_arrays({name: a for name, a in arrays.items() if not isinstance(a, str)}, tmp))
+
+            with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_open_arrays,
+                                     initargs=(paths,)) as pool:
+                futures = [pool.submit(_run_task, score_fn, params) for params in todo]
+                out = open(checkpoint, "a") if checkpoint is not None else None
+                if out is not None and not _ends_with_newline(checkpoint):
+                    # an interrupted write can leave a torn last line; start a fresh one
+                    out.write("\n")
+                try:
+                    for future in as_completed(futures):
+                        record = future.result()
+                        records.append(record)
+                        if out is not None:
+                            out.write(json.dumps(record, default=str) + "\n")
+                            out.flush()
+                        if verbose:
+                            print(record)
+                finally:
+                    if out is not None:
+                        out.close()
+
+    return leaderboard(records, maximize=maximize)
+
+
+
+def leaderboard(records, maximize=True):
+    """
+    Rank sweep records by score
+
+    Parameters
+    ----------
+    records : list of dict
+        The records of run_sweep or load_checkpoint
+    maximize : bool
+        Whether larger scores are better
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per record with a column per parameter, best first (failed runs last)
+    """
+    rows = [{**r["params"], **{k: v for k, v in r.items() if k != "params"}} for r in records]
+    board = pd.DataFrame(rows)
+    if board.empty:
+        return board
+    return board.sort_values("score", ascending=not maximize, na_position="last").reset_index(drop=True)
+
+
+
+def kalman_qr_score(arrays, q, r, x0="x0", P0="P0", z="z", F="F", H="H", G="G", u="u"):
+    """
+    Score Q = q*I and R = r*I for a KalmanFilter by the log-likelihood of the observations
+
+    Parameters
+    ----------
+    arrays : dict
+        The shared arrays; the names below pick out the model and the data
+    q, r : float
+        The state and observation noise scales
+    x0, P0, z, F, H, G, u : str
+        The names of the initial state, initial covariance, observations
+        (m,N), transition model, observation model, control model and
+        control vector in arrays
+
+    Returns
+    -------
+    float
+        KalmanFilter.log_likelihood for this Q and R
+    """
+    F, H = np.asarray(arrays[F]), np.asarray(arrays[H])
+    n, m = F.shape[0], H.shape[0]
+    kf = KalmanFilter(F, np.eye(n) * q, H, np.eye(m) * r, np.asarray(arrays[G]), np.asarray(arrays[u]))
+    return kf.log_likelihood(np.asarray(arrays[x0]), np.asarray(arrays[P0]), np.asarray(arrays[z]))
+
+
+
+def hmm_n_parameters(n_components, n_features, n_mix=1, covariance_type="diag"):
+    """
+    The number of free parameters of a GMMHMM, for the information criteria
+
+    Parameters
+    ----------
+    n_components : int
+        The number of hidden states
+    n_features : int
+        The dimension of the observations
+    n_mix : int
+        The number of mixture components per state
+    covariance_type : str
+        One of "diag", "spherical", "full" or "tied"
+
+    Returns
+    -------
+    int
+    """
+    K, M, D = n_components, n_mix, n_features
+    covars = {"diag": K * M * D, "spherical": K * M, "full": K * M * D * (D + 1) // 2,
+              "tied": K * D * (D + 1) // 2}
+    if covariance_type not in covars:
+        raise ValueError(f"Unknown covariance type: {covariance_type}")
+    # start probabilities, transitions and weights each sum to one
+    return (K - 1) + K * (K - 1) + K * (M - 1) + K * M * D + covars[covariance_type]
+
+
+
+def hmm_fit_score(arrays, n_components, restart, data="data", lengths="lengths", val_data=None, val_lengths=None,
+                  criterion=None, covariance_type="diag", n_mix=1, n_iter=10):
+    """
+    Fit an hmmlearn GMMHMM like hmm.ipynb and score it on data it was not fitted to,
+    or by an information criterion
+
+    The training log-likelihood grows with the number of states, so ranking by
+    it always favors the largest model. The score is instead the log-likelihood
+    per sample of a held-out split, or minus the BIC or AIC of the fit (so
+    larger is better either way, as run_sweep expects by default).
+
+    Parameters
+    ----------
+    arrays : dict
+        The shared arrays
+    n_components : int
+        The number of hidden states
+    restart : int
+        The restart number, used as the random state
+    data, lengths : str
+        The names of the (T,D) training data and the sequence lengths in arrays
+    val_data, val_lengths : str, optional
+        The names of held-out data and its sequence lengths in arrays
+    criterion : str, optional
+        "val" (the held-out log-likelihood per sample), "bic" or "aic".
+        Defaults to "val" if val_data is given and "bic" otherwise.
+    covariance_type : str
+        Passed to GMMHMM
+    n_mix : int
+        The number of mixture components per state, passed to GMMHMM
+    n_iter : int
+        The number of EM iterations
+
+    Returns
+    -------
+    dict
+        The score, the training log-likelihood, the BIC and AIC, the held-out
+        log-likelihood per sample (if val_data is given) and whether the fit converged
+    """
+    # hmmlearn is only needed by the workers that fit hmms
+    from hmmlearn import hmm
+
+    criterion = criterion or ("val" if val_data is not None else "bic")
+    if criterion not in ("val", "bic", "aic"):
+        raise ValueError(f"Unknown criterion: {criterion}")
+    if criterion == "val" and val_data is None:
+        raise ValueError("The val criterion needs val_data")
+
+    X = np.asarray(arrays[data])
+    X = X.reshape(len(X), -1)
+    model = hmm.GMMHMM(n_components=n_components, n_mix=n_mix, covariance_type=covariance_type, n_iter=n_iter,
+                       random_state=restart)
+    model.fit(X, lengths=np.asarray(arrays[lengths]))
+
+    ll = float(model.score(X, lengths=np.asarray(arrays[lengths])))
+    p = hmm_n_parameters(n_components, X.shape[1], n_mix, covariance_type)
+    record = {"train_log_likelihood": ll, "bic": p * np.log(len(X)) - 2 * ll, "aic": 2 * p - 2 * ll,
+              "converged": bool(model.monitor_.converged)}
+    if val_data is not None:
+        V = np.asarray(arrays[val_data])
+        V = V.reshape(len(V), -1)
+        V_lengths = None if val_lengths is None else np.asarray(arrays[val_lengths])
+        record["val_log_likelihood"] = float(model.score(V, lengths=V_lengths)) / len(V)
+    record["score"] = record["val_log_likelihood"] if criterion == "val" else -record[criterion]
+    return record
+
+
+
+if __name__ == "__main__":
+    import benchmarks
+
+    # tune the notebook's Q and R on a simulated drive
+    kf, x0, P0 = benchmarks.car_model()
+    _, z = kf.evolve(x0, 2000, rng=np.random.default_rng(0))
+    arrays = {"x0": x0, "P0": P0, "z": z, "F": kf.F, "H": kf.H, "G": kf.G, "u": kf.u}
+    board = run_sweep(kalman_qr_score, {"q": [0.01, 0.1, 1], "r": [100, 1000, 10000]}, arrays)
+    print(board)
@@ -0,0 +1,234 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+
+
+# column layouts of the PVS csv files
+GPS_COLUMNS = ["timestamp", "latitude", "longitude", "elevation", "accuracy", "bearing",
+               "speed_meters_per_second", "satellites", "provider", "hdop", "vdop", "pdop",
+               "geoidheight", "ageofdgpsdata", "dgpsid", "activity", "battery", "annotation",
+               "distance_meters", "elapsed_time_seconds"]
+PLACEMENTS = ["dashboard", "above_suspension", "below_suspension"]
+MPU_COLUMNS = (["timestamp"]
+               + [f"acc_{a}_{p}" for p in PLACEMENTS for a in "xyz"]
+               + [f"gyro_{a}_{p}" for p in PLACEMENTS for a in "xyz"]
+               + [f"mag_{a}_{p}" for p in PLACEMENTS[:2] for a in "xyz"]
+               + [f"temp_{p}" for p in PLACEMENTS]
+               + ["timestamp_gps", "latitude", "longitude", "speed"])
+LABEL_GROUPS = [["paved_road", "unpaved_road"],
+                ["dirt_road", "cobblestone_road", "asphalt_road"],
+                ["no_speed_bump", "speed_bump_asphalt", "speed_bump_cobblestone"],
+                ["good_road_left", "regular_road_left", "bad_road_left"],
+                ["good_road_right", "regular_road_right", "bad_road_right"]]
+LABEL_COLUMNS = [c for group in LABEL_GROUPS for c in group]
+
+EARTH_RADIUS = 6371000
+
+
+
+def generate_drive(path, duration=1440, imu_rate=100, gps_rate=1, chunk=600, seed=None,
+                   t0=1577218696.999, origin=(-27.7178, -51.0989)):
+    """
+    Write one synthetic drive in the PVS folder layout:
+    path
+    ├── dataset_gps.csv
+    ├── dataset_gps_mpu_left.csv
+    ├── dataset_gps_mpu_right.csv
+    └── dataset_labels.csv
+
+    The car follows a random smooth acceleration profile. The MPU files hold
+    noisy accelerometer, gyroscope, magnetometer and temperature channels at
+    imu_rate, the GPS file holds fixes at gps_rate, and the labels are
+    piecewise constant one-hot rows aligned with the MPU rows. The files are
+    written in chunks of `chunk` seconds, so drives of any length can be
+    generated in bounded memory.
+
+    Parameters
+    ----------
+    path : str
+        The folder to write the drive into (created if needed)
+    duration : float
+        The length of the drive in seconds (a real PVS run is about 1440)
+    imu_rate : int
+        The MPU sample rate in Hz
+    gps_rate : float
+        The GPS fix rate in Hz
+    chunk : float
+        The number of seconds generated per write
+    seed : int or np.random.Generator, optional
+        The random generator (or a seed for one)
+    t0 : float
+        The timestamp of the first sample
+    origin : tuple
+        The (latitude, longitude) of the start of the drive
+
+    Returns
+    -------
+    dict
+        The number of rows written to each file
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+    files = {"gps": os.path.join(path, "dataset_gps.csv"),
+             "left": os.path.join(path, "dataset_gps_mpu_left.csv"),
+             "right": os.path.join(path, "dataset_gps_mpu_right.csv"),
+             "labels": os.path.join(path, "dataset_labels.csv")}
+    rows = {key: 0 for key in files}
+
+    # state carried across chunks
+    dt = 1 / imu_rate
+    pos = np.zeros(2)
+    vel = np.zeros(2)
+    acc = np.zeros(2)
+    distance = 0.
+    last_fix_pos = np.zeros(2)
+    labels = [0] * len(LABEL_GROUPS)
+    next_change = 0
+    gps_period = int(round(imu_rate / gps_rate))
+    total = int(duration * imu_rate)
+    lat_scale = np.degrees(1 / EARTH_RADIUS)
+    lon_scale = lat_scale / np.cos(np.radians(origin[0]))
+
+    for start in range(0, total, int(chunk * imu_rate)):
+        N = min(int(chunk * imu_rate), total - start)
+        t = t0 + (start + np.arange(N)) * dt
+
+        # smooth random acceleration (first order low pass of white noise)
+        kicks = rng.normal(scale=0.05, size=(N, 2))
+        a, _ = lfilter([1], [1, -0.995], kicks, axis=0, zi=0.995 * acc[None])
+        acc = a[-1]
+        v = vel + np.cumsum(a, axis=0) * dt
+        p = pos + np.cumsum(v, axis=0) * dt
+        vel, pos = v[-1], p[-1]
+        speed = np.hypot(v[:, 0], v[:, 1])
+        lat = origin[0] + p[:, 1] * lat_scale
+        lon = origin[1] + p[:, 0] * lon_scale
+
+        # piecewise constant labels
+        codes = np.empty((N, len(LABEL_GROUPS)), dtype=int)
+        i = 0
+        while i < N:
+            if start + i >= next_change:
+                labels = [rng.integers(len(g)) for g in LABEL_GROUPS]
+                next_change = start + i + rng.integers(10, 120) * imu_rate
+            end = min(N, next_change - start)
+            codes[i:end] = labels
+            i = end
+        onehot = np.zeros((N, len(LABEL_COLUMNS)), dtype=np.uint8)
+        offset = 0
+        for g, group in enumerate(LABEL_GROUPS):
+            onehot[np.arange(N), offset + codes[:, g]] = 1
+            offset += len(group)
+        bumpiness = 0.2 + 0.8 * codes[:, 3]
+
+        # gps fixes on the gps period
+        fix = np.arange(N)[(start + np.arange(N)) % gps_period == 0]
+        fix_t = t[fix]
+        steps = np.hypot(*np.diff(p[fix], axis=0, prepend=last_fix_pos[None]).T)
+        fix_dist = distance + np.cumsum(steps)
+        if len(fix):
+            distance = fix_dist[-1]
+            last_fix_pos = p[fix][-1]
+        gps = pd.DataFrame({"timestamp": fix_t,
+                            "latitude": lat[fix] + rng.normal(scale=2e-5, size=len(fix)),
+                            "longitude": lon[fix] + rng.normal(scale=2e-5, size=len(fix)),
+                            "elevation": 950 + rng.normal(scale=5, size=len(fix)),
+                            "accuracy": rng.choice([4., 8., 12., 24.], size=len(fix)),
+                            "bearing": np.degrees(np.arctan2(v[fix, 0], v[fix, 1])) % 360,
+                            "speed_meters_per_second": speed[fix],
+                            "satellites": rng.integers(6, 14, size=len(fix)),
+                            "provider": "gps",
+                            "hdop": 0.8, "vdop": 1.5, "pdop": 1.7, "geoidheight": 3.6,
+                            "ageofdgpsdata": np.nan, "dgpsid": np.nan, "activity": np.nan,
+                            "battery": 87, "annotation": np.nan,
+                            "distance_meters": fix_dist,
+                            "elapsed_time_seconds": fix_t - t0}, columns=GPS_COLUMNS)
+        last_fix = t0 + (((start + np.arange(N)) // gps_period) * gps_period) * dt
+
+        # noisy mpu channels for both sides
+        for side in ("left", "right"):
+            cols = {"timestamp": t}
+            for j, place in enumerate(PLACEMENTS):
+                gain = 1 + j
+                cols[f"acc_x_{place}"] = a[:, 0] + rng.normal(scale=0.1 * gain, size=N)
+                cols[f"acc_y_{place}"] = a[:, 1] + rng.normal(scale=0.1 * gain, size=N)
+                cols[f"acc_z_{place}"] = 9.8 + rng.normal(size=N) * bumpiness * gain
+            for place in PLACEMENTS:
+                for axis in "xyz":
+                    cols[f"gyro_{axis}_{place}"] = rng.normal(scale=0.5, size=N)
+            for place in PLACEMENTS[:2]:
+                for axis in "xyz":
+                    cols[f"mag_{axis}_{place}"] = rng.normal(scale=20, size=N)
+            for place in PLACEMENTS:
+                cols[f"temp_{place}"] = 30 + rng.normal(scale=0.5, size=N)
+            cols["timestamp_gps"] = last_fix
+            cols["latitude"] = lat
+            cols["longitude"] = lon
+            cols["speed"] = speed
+            pd.DataFrame(cols, columns=MPU_COLUMNS).to_csv(files[side], mode="a" if rows[side] else "w", header=rows[side] == 0, index=False)
+            rows[side] += N
+
+        gps.to_csv(files["gps"], mode="a" if rows["gps"] else "w", header=rows["gps"] == 0, index=False)
+        rows["gps"] += len(gps)
+        pd.DataFrame(onehot, columns=LABEL_COLUMNS).to_csv(files["labels"], mode="a" if rows["labels"] else "w", header=rows["labels"] == 0, index=False)
+        rows["labels"] += N
+
+    return rows
+
+
+
+def generate_dataset(parent, n_drives=9, duration=1440, imu_rate=100, gps_rate=1, seed=0):
+    """
+    Write a synthetic PVS dataset that cleaner.load_data can read:
+    parent
+    ├── PVS 1
+    ├── PVS 2
+    etc.
+
+    Use duration and n_drives to scale the dataset, e.g. duration=14400 for
+    drives ten times longer than the real ones.
+
+    Parameters
+    ----------
+    parent : str
+        The folder to write the drives into
+    n_drives : int
+        The number of PVS folders to create
+    duration : float
+        The length of each drive in seconds
+    imu_rate : int
+        The MPU sample rate in Hz
+    gps_rate : float
+        The GPS fix rate in Hz
+    seed : int
+        Seed for the whole dataset; every drive gets its own child generator
+
+    Returns
+    -------
+    dict
+        The rows written to each file, keyed by folder name
+    """
+    children = np.random.SeedSequence(seed).spawn(n_drives)
+    written = {}
+    for i in range(n_drives):
+        folder = f"PVS {i + 1}"
+        written[folder] = generate_drive(os.path.join(parent, folder), duration=duration,
+                                         imu_rate=imu_rate, gps_rate=gps_rate,
+                                         seed=np.random.default_rng(children[i]))
+    return written
+
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic PVS dataset")
+    parser.add_argument("parent")
+    parser.add_argument("--drives", type=int, default=9)
+    parser.add_argument("--duration", type=float, default=1440)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(generate_dataset(args.parent, n_drives=args.drives, duration=args.duration, seed=args.seed))
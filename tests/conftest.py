@@ -0,0 +1,55 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kalman import KalmanFilter
+
+
+
+@pytest.fixture
+def model():
+    """
+    A small constant-acceleration model (as in benchmarks.kinematic_model) with a nonzero control term
+    """
+    dims, dt = 2, .1
+    n = 3 * dims
+    F = np.eye(n)
+    for i in range(2 * dims):
+        F[i, i + dims] = dt
+    H = np.zeros((2 * dims, n))
+    for i in range(dims):
+        H[i, i] = 1
+        H[i + dims, i + 2 * dims] = 1
+    Q = np.eye(n) * .1
+    R = np.eye(2 * dims) * 10
+    G = np.eye(n) * dt
+    u = np.linspace(-.2, .3, n)
+    return KalmanFilter(F, Q, H, R, G, u), np.zeros(n), np.eye(n) * 100
+
+
+
+@pytest.fixture
+def observations(model):
+    """
+    200 observations generated by the model
+    """
+    kf, x0, _ = model
+    return kf.evolve(x0, 200, rng=0)[1]
+
+
+
+@pytest.fixture(scope="session")
+def parent(tmp_path_factory):
+    """
+    A small synthetic PVS dataset: three 20 second drives
+    """
+    import synthetic
+
+    path = str(tmp_path_factory.mktemp("pvs"))
+    synthetic.generate_dataset(path, n_drives=3, duration=20, seed=0)
+    return path
@@ -0,0 +1,36 @@
+import os
+
+import benchmarks
+
+
+
+def test_suite_only_sets_up_its_group(tmp_path):
+    names = [name for name, _ in benchmarks.suite_cases(str(tmp_path), dims=(1,), lengths=(50,), only="kalman")]
+    assert names == ["kalman.estimate[n=3,N=50]", "kalman.predict[n=3,N=50]", "kalman.rewind[n=3,N=50]",
+                     "kalman.evolve[n=3,N=50]"]
+    # neither the scaled dataset nor the synthetic drive was built
+    assert os.listdir(tmp_path) == []
+
+    cases = list(benchmarks.suite_cases(str(tmp_path), dims=(1,), lengths=(50,), only="filter.add_lat_long"))
+    assert [name.split("[")[0] for name, _ in cases] == ["filter.add_lat_long_meters"]
+    assert os.listdir(tmp_path) == ["data-1"]
+
+
+def test_kalman_cases_bind_their_model(tmp_path):
+    # every case keeps its own model and length even when run after the generator moved on
+    cases = dict(benchmarks.suite_cases(str(tmp_path), dims=(1, 2), lengths=(20, 30), only="kalman.estimate"))
+    for name, case in cases.items():
+        assert case["fn"]().shape == (int(name[name.index("n=") + 2:name.index(",")]), case["items"])
+
+
+def test_run_suite_and_compare(tmp_path):
+    results = benchmarks.run_suite(repeat=1, only="kalman.estimate", dims=(1,), lengths=(100,))
+    assert list(results) == ["kalman.estimate[n=3,N=100]"]
+    res = results["kalman.estimate[n=3,N=100]"]
+    assert res["items"] == 100 and res["throughput"] > 0
+
+    path = str(tmp_path / "baseline.json")
+    benchmarks.save_baseline(results, path)
+    assert benchmarks.compare(results, path) == []
+    slower = {name: dict(r, throughput=r["throughput"] / 2, peak_mb=r["peak_mb"] + 10) for name, r in results.items()}
+    assert sorted(r["metric"] for r in benchmarks.compare(slower, path)) == ["peak_mb", "throughput"]
@@ -0,0 +1,181 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cleaner
+
+
+
+@pytest.fixture
+def gps_csv(tmp_path):
+    df = pd.DataFrame({"timestamp": 1577218697. + np.arange(50), "latitude": np.linspace(-27.7, -27.8, 50),
+                       "longitude": np.linspace(-51.1, -51.0, 50), "speed_meters_per_second": np.arange(50.),
+                       "provider": "gps"})
+    path = tmp_path / "dataset_gps.csv"
+    df.to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_cache_hit_is_writable(gps_csv, tmp_path, mmap):
+    cache_dir = str(tmp_path / "cache")
+    first = cleaner.read_csv_cached(gps_csv, "t_gps", "PVS 1", cache_dir=cache_dir, mmap=mmap)
+    hit = cleaner.read_csv_cached(gps_csv, "t_gps", "PVS 1", cache_dir=cache_dir, mmap=mmap)
+    pd.testing.assert_frame_equal(hit, pd.read_csv(gps_csv))
+    pd.testing.assert_frame_equal(first, hit)
+
+    hit.loc[0, "latitude"] = 0.
+    hit["speed_meters_per_second"] *= 2
+    assert hit.loc[0, "latitude"] == 0
+
+    # writes never reach the cache entry
+    again = cleaner.read_csv_cached(gps_csv, "t_gps", "PVS 1", cache_dir=cache_dir, mmap=mmap)
+    pd.testing.assert_frame_equal(again, pd.read_csv(gps_csv))
+
+
+def test_cache_invalidation(gps_csv, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    cleaner.read_csv_cached(gps_csv, "t_gps", "PVS 1", cache_dir=cache_dir)
+
+    # a changed source file is parsed again
+    df = pd.read_csv(gps_csv)
+    df["speed_meters_per_second"] += 1
+    df.to_csv(gps_csv, index=False)
+    os.utime(gps_csv, ns=(1, 1))
+    pd.testing.assert_frame_equal(cleaner.read_csv_cached(gps_csv, "t_gps", "PVS 1", cache_dir=cache_dir), df)
+
+    # and so are different loading parameters
+    cleaned = cleaner.read_csv_cached(gps_csv, "t_gps", "PVS 1", cache_dir=cache_dir, clean=True)
+    pd.testing.assert_frame_equal(cleaned, cleaner.clean_frame("t_gps", df.copy()))
+
+
+def test_load_data_cache(parent, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    plain = cleaner.load_data(parent)
+    cleaner.load_data(parent, cache_dir=cache_dir)
+    cached = cleaner.load_data(parent, cache_dir=cache_dir)
+    for file_type in cleaner.FILE_TYPES:
+        for folder, df in plain["train"][file_type].items():
+            pd.testing.assert_frame_equal(cached["train"][file_type][folder], df)
+    # cleaning a cache hit modifies the frames in place
+    cleaner.clean_dict(cached)
+
+
+def test_match_file_type():
+    assert cleaner.match_file_type("dataset_gps_mpu_left.csv") == "gps_mpu_left"
+    assert cleaner.match_file_type("dataset_gps_mpu_right.csv") == "gps_mpu_right"
+    assert cleaner.match_file_type("dataset_gps.csv") == "t_gps"
+    assert cleaner.match_file_type("dataset_labels.csv") == "labels"
+    assert cleaner.match_file_type("notes.txt") is None
+
+
+def test_compact_load_matches_clean(parent):
+    full = cleaner.clean_dict(cleaner.load_data(parent))
+    compact = cleaner.load_data(parent, compact=True, clean=True, workers=3)
+    for file_type in ("gps_mpu_left", "labels"):
+        for folder, df in full["train"][file_type].items():
+            small = compact["train"][file_type][folder]
+            assert list(small.columns) == list(df.columns)
+            for col in small.columns:
+                if file_type == "labels":
+                    assert small[col].dtype == np.uint8
+                elif col in cleaner.FLOAT64_COLS:
+                    assert small[col].dtype == np.float64
+                    np.testing.assert_array_equal(small[col], df[col])
+                else:
+                    assert small[col].dtype == np.float32
+                    np.testing.assert_allclose(small[col], df[col], rtol=1e-6, atol=1e-6)
+
+
+def test_concurrent_load_matches_sequential(parent):
+    sequential = cleaner.load_data(parent)
+    concurrent = cleaner.load_data(parent, workers=4)
+    for file_type in cleaner.FILE_TYPES:
+        assert sorted(concurrent["train"][file_type]) == sorted(sequential["train"][file_type])
+        for folder, df in sequential["train"][file_type].items():
+            pd.testing.assert_frame_equal(concurrent["train"][file_type][folder], df)
+
+
+@pytest.fixture
+def streams():
+    rng = np.random.default_rng(5)
+    fast = pd.DataFrame({"timestamp": np.arange(0, 30, .1).round(1), "acc": rng.normal(size=300)})
+    slow = pd.DataFrame({"timestamp": np.arange(.05, 30, 1.), "speed": rng.normal(size=30), "provider": "gps"})
+    other = pd.DataFrame({"timestamp": np.arange(0, 30, .1).round(1)[::-1], "gyro": rng.normal(size=300)})
+    return fast, slow, other
+
+
+def test_combine_exact_matches_merge(streams):
+    fast, _, other = streams
+    every_other = other.iloc[::2]
+    merged = cleaner.combine_data([fast, every_other], how="merge")
+    exact = cleaner.combine_data([fast, every_other], how="exact")
+    pd.testing.assert_frame_equal(exact, merged.sort_values("timestamp", ignore_index=True))
+
+
+@pytest.mark.parametrize("how,direction", [("asof", "backward"), ("nearest", "nearest")])
+def test_combine_asof_matches_merge_asof(streams, how, direction):
+    fast, slow, _ = streams
+    out = cleaner.combine_data([fast, slow], how=how, tolerance=.5)
+    ref = pd.merge_asof(fast, slow, on="timestamp", direction=direction, tolerance=.5)
+    pd.testing.assert_frame_equal(out[["timestamp", "acc", "speed"]], ref[["timestamp", "acc", "speed"]])
+    assert out["provider"].isna().sum() == ref["provider"].isna().sum()
+
+
+def test_combine_interpolate_and_array(streams):
+    fast, slow, other = streams
+    names, block = cleaner.combine_data([fast, slow, other], how="asof", interpolate=True, as_array=True)
+    assert names == ["timestamp", "acc", "speed", "gyro"]
+    assert block.flags.c_contiguous and block.shape == (4, 300)
+    inside = (fast["timestamp"] >= .05) & (fast["timestamp"] <= 29.05)
+    expected = np.interp(fast["timestamp"], slow["timestamp"], slow["speed"])
+    np.testing.assert_allclose(block[2, inside], expected[inside])
+    assert np.isnan(block[2, ~inside]).all()
+    ordered = other.sort_values("timestamp")
+    np.testing.assert_allclose(block[3], ordered["gyro"])
+
+
+def test_combine_suffixes(streams):
+    fast, _, _ = streams
+    out = cleaner.combine_data([fast, fast.copy()], how="exact")
+    assert list(out.columns) == ["timestamp", "acc", "acc_1"]
+    with pytest.raises(ValueError):
+        cleaner.combine_data([fast, fast], how="outer")
+
+
+@pytest.fixture
+def labels(parent):
+    frame = cleaner.load_data(parent)["train"]["labels"]["PVS 1"].astype(np.uint8)
+    # a row with no road class set
+    frame.loc[5, cleaner.LABEL_GROUPS["road"]] = 0
+    return frame
+
+
+def test_label_codec_round_trip(labels):
+    codec = cleaner.LabelCodec()
+    codes = codec.codes(labels)
+    assert codes.dtype == np.int8 and codes.shape == (len(labels), 5)
+    assert codes[5, codec.names.index("road")] == -1
+    pd.testing.assert_frame_equal(codec.decode(codes), labels[codec.columns].reset_index(drop=True))
+
+    encoded = codec.encode(labels)
+    assert encoded["road"].isna().sum() == 1
+    np.testing.assert_array_equal(encoded["road"].cat.codes, codes[:, codec.names.index("road")])
+
+
+def test_label_codec_segments(labels):
+    codec = cleaner.LabelCodec()
+    codes = codec.codes(labels)
+    segs = codec.segments(codes)
+    np.testing.assert_array_equal(codec.expand(segs), codes)
+    for label in ("asphalt_road", "bad_road_left", "speed_bump_cobblestone"):
+        np.testing.assert_array_equal(codec.indices(segs, label), np.flatnonzero(labels[label] == 1))
+
+
+def test_ohe_to_label(labels):
+    classes = cleaner.LABEL_GROUPS["road"]
+    out = cleaner.ohe_to_label(labels, classes, pd.DataFrame(index=labels.index), "road")
+    expected = np.select([labels[c] == 1 for c in classes], classes, default="0")
+    np.testing.assert_array_equal(out["road"], expected)
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import cleaner
+import filter
+from dataset import Dataset, Stream
+
+
+
+@pytest.fixture
+def ddict(parent):
+    return cleaner.clean_dict(cleaner.load_data(parent, exclude_test=["PVS 3"]))
+
+
+@pytest.fixture
+def ds(ddict):
+    return Dataset.from_dict(ddict, dtype=np.float64)
+
+
+def test_from_dict_round_trip(ddict, ds):
+    assert ds.splits == {"train": ["PVS 1", "PVS 2"], "val": [], "test": ["PVS 3"]}
+    back = ds.to_dict()
+    for name in ("train", "test"):
+        assert back[name]["folders"] == sorted(ddict[name]["folders"])
+        for file_type, files in ddict[name].items():
+            if not isinstance(files, dict):
+                continue
+            for folder, df in files.items():
+                pd.testing.assert_frame_equal(back[name][file_type][folder][list(df.columns)],
+                                              df.reset_index(drop=True), check_dtype=False)
+
+
+def test_load_matches_from_dict(parent, ddict):
+    loaded = Dataset.load(parent, exclude_test=["PVS 3"])
+    packed = Dataset.from_dict(ddict)
+    assert loaded.splits == packed.splits
+    assert set(loaded.streams) == set(packed.streams)
+    for file_type, stream in packed.streams.items():
+        other = loaded[file_type]
+        assert other.folders == stream.folders
+        np.testing.assert_array_equal(other.offsets, stream.offsets)
+        for col in stream.columns + stream.wide_columns:
+            np.testing.assert_array_equal(other.column(col), stream.column(col))
+
+
+def test_channel_dtypes(parent):
+    ds = Dataset.load(parent)
+    assert ds["gps_mpu_left"].data.dtype == np.float32
+    assert "latitude" in ds["gps_mpu_left"].wide_columns
+    assert ds["gps_mpu_left"].wide.dtype == np.float64
+    # the compact loader reads the one-hot labels as uint8 and packing keeps them
+    assert ds["labels"].data.dtype == np.uint8
+
+
+def test_observations_are_views(ds, ddict):
+    stream = ds["gps_mpu_left"]
+    cols = stream.columns[:3]
+    z = stream.observations(cols, "PVS 2")
+    assert np.shares_memory(z, stream.data)
+    df = ddict["train"]["gps_mpu_left"]["PVS 2"]
+    np.testing.assert_array_equal(z, df[cols].to_numpy().T)
+
+    # out of block order the rows are gathered
+    z = stream.observations(cols[::-1], "PVS 2")
+    np.testing.assert_array_equal(z, df[cols[::-1]].to_numpy().T)
+
+
+def test_split_is_a_view(ds):
+    train = ds.split("train")
+    stream = train["gps_mpu_left"]
+    assert stream.folders == ["PVS 1", "PVS 2"]
+    assert np.shares_memory(stream.data, ds["gps_mpu_left"].data)
+    np.testing.assert_array_equal(stream.column("timestamp", "PVS 2"), ds["gps_mpu_left"].column("timestamp", "PVS 2"))
+
+    # folders out of storage order are copied in the requested order
+    picked = ds["gps_mpu_left"].select(["PVS 3", "PVS 1"])
+    assert picked.folders == ["PVS 3", "PVS 1"]
+    np.testing.assert_array_equal(picked.column("timestamp", "PVS 1"), ds["gps_mpu_left"].column("timestamp", "PVS 1"))
+    assert len(ds["gps_mpu_left"].select([])) == 0
+
+
+def test_add_columns_rejects_duplicates(ds):
+    stream = ds["gps_mpu_left"]
+    with pytest.raises(ValueError):
+        stream.add_columns([stream.columns[0]], np.zeros(len(stream)))
+
+
+def test_add_smoothed_cols_matches_filter(ds, ddict):
+    ds.add_smoothed_cols(window=20, windows=[5])
+    ref = filter.add_smoothed_cols(ddict, window=20, windows=[5], inPlace=False)
+    for folder, df in ref["train"]["gps_mpu_left"].items():
+        for col in ("acc_x_dash_smooth", "acc_x_dash_smooth_5"):
+            np.testing.assert_allclose(ds["gps_mpu_left"].column(col, folder), df[col].to_numpy())
+
+
+def test_add_lat_long_meters(ds, ddict):
+    ds.add_lat_long_meters()
+    for folder, df in ddict["train"]["gps_mpu_left"].items():
+        lat_m, long_m = filter.project_lat_long(df["latitude"].to_numpy(), df["longitude"].to_numpy())
+        np.testing.assert_allclose(ds["gps_mpu_left"].column("lat_m", folder), lat_m)
+        np.testing.assert_allclose(ds["gps_mpu_left"].column("long_m", folder), long_m)
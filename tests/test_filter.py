@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+from geopy.distance import geodesic
+
+import filter
+
+
+
+@pytest.fixture
+def track():
+    """
+    A few kilometers of a drive around the PVS area
+    """
+    rng = np.random.default_rng(0)
+    lat = -27.7178 + np.cumsum(rng.normal(1e-4, 5e-5, 500))
+    lon = -51.0989 + np.cumsum(rng.normal(-1e-4, 5e-5, 500))
+    return lat, lon
+
+
+def test_vincenty_matches_geodesic(track):
+    lat, lon = track
+    idx = np.arange(0, 500, 25)
+    d = filter.vincenty_distance(lat[0], lon[0], lat[idx], lon[idx])
+    ref = [geodesic((lat[0], lon[0]), (lat[i], lon[i])).meters for i in idx]
+    np.testing.assert_allclose(d, ref, atol=1e-3)
+    assert filter.vincenty_distance(lat[3], lon[3], lat[3], lon[3]) == 0
+
+
+@pytest.mark.parametrize("method,tol", [("vincenty", 1e-3), ("ellipsoid", 1e-3), ("equirect", 20)])
+def test_projection_tiers(track, method, tol):
+    lat, lon = track
+    assert filter.projection_error(lat, lon, method, sample=50) < tol
+
+
+def test_project_signed(track):
+    lat, lon = track
+    lat_m, long_m = filter.project_lat_long(lat, lon)
+    s_lat, s_long = filter.project_lat_long(lat, lon, signed=True)
+    np.testing.assert_allclose(np.abs(s_lat), lat_m)
+    np.testing.assert_array_equal(np.sign(s_lat), np.sign(lat - lat[0]))
+    np.testing.assert_array_equal(np.sign(s_long), np.sign(lon - lon[0]))
+    with pytest.raises(ValueError):
+        filter.project_lat_long(lat, lon, method="mercator")
+
+
+def test_add_lat_long_meters(track):
+    lat, lon = track
+    df = pd.DataFrame({"latitude": lat, "longitude": lon})
+    filter.add_lat_long_meters(df)
+    # the last row is dropped, as the original implementation did
+    assert len(df) == 499
+    np.testing.assert_allclose(df["lat_m"], filter.project_lat_long(lat, lon)[0][:-1])
+
+
+def _convolve_smooth(data, window):
+    """
+    The original edge-padded np.convolve moving average
+    """
+    pad_width = window // 2
+    return np.convolve(np.pad(data, (pad_width, pad_width), mode="edge"), np.ones(window) / window, mode="same")
+
+
+@pytest.mark.parametrize("window", [1, 2, 5, 100, 101])
+def test_smooth_matches_convolve(window):
+    x = np.random.default_rng(1).normal(3, 1, 1000)
+    np.testing.assert_allclose(filter.smooth(x, window=window), _convolve_smooth(x, window), rtol=1e-10, atol=1e-10)
+    # with missing values the direct convolution is used
+    x[10] = np.nan
+    np.testing.assert_array_equal(np.isnan(filter.smooth(x, window=window)), np.isnan(_convolve_smooth(x, window)))
+
+
+def test_smooth_bank_columns():
+    X = np.random.default_rng(2).normal(size=(500, 3))
+    bank = filter.smooth_bank(X, [10, 50], start_index=4)
+    for w in (10, 50):
+        assert bank[w].shape == (504 + 2 * (w // 2), 3)
+        np.testing.assert_array_equal(bank[w][:4], 0)
+        for j in range(3):
+            np.testing.assert_allclose(bank[w][4:, j], _convolve_smooth(X[:, j], w), atol=1e-10)
+
+
+def test_streaming_smoother_chunks():
+    x = np.random.default_rng(3).normal(size=(1000, 2))
+    window = 40
+    causal = np.stack([x[max(i - window + 1, 0):i + 1].mean(axis=0) for i in range(len(x))])
+    smoother = filter.StreamingSmoother(window)
+    out = np.concatenate([smoother.update(x[a:b]) for a, b in [(0, 7), (7, 7), (7, 300), (300, 1000)]])
+    np.testing.assert_allclose(out, causal, atol=1e-10)
+
+
+def test_add_smoothed_cols():
+    x = np.random.default_rng(4).normal(size=(300, 2))
+    df = pd.DataFrame({"timestamp": np.arange(300.), "acc_x_dash": x[:, 0], "acc_y_dash": x[:, 1]})
+    ddict = {"train": {"gps_mpu_left": {"PVS 1": df}, "labels": None, "folders": ["PVS 1"]}}
+    filter.add_smoothed_cols(ddict, window=20, windows=[5])
+    for col in ("acc_x_dash", "acc_y_dash"):
+        np.testing.assert_allclose(df[col + "_smooth"], filter.smooth(df[col], window=20)[:300])
+        np.testing.assert_allclose(df[col + "_smooth_5"], filter.smooth(df[col], window=5)[:300])
+    assert "timestamp_smooth" not in df
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+
+from fusion import FusionFilter, dataframe_events
+
+
+
+def _events(name, z, times):
+    return [(t, name, z[:, i]) for i, t in zip(range(z.shape[1]), times)]
+
+
+def test_single_sensor_matches_estimate(model, observations):
+    kf, x0, P0 = model
+    fusion = FusionFilter(kf, {"imu": (kf.H, kf.R)}, predict_on="imu")
+    times, out = fusion.estimate(x0, P0, _events("imu", observations[:, 1:], np.arange(1, 200)))
+    np.testing.assert_array_equal(times, np.arange(1, 200))
+    np.testing.assert_allclose(out, kf.estimate(x0, P0, observations)[:, 1:], rtol=1e-9, atol=1e-9)
+
+
+def test_sequential_updates_match_joint_update(model, observations):
+    # with independent noise, updating with the position rows and then the
+    # acceleration rows is the same as one update with the whole H
+    kf, x0, P0 = model
+    m = len(kf.R)
+    gps, imu = slice(0, m // 2), slice(m // 2, m)
+    sensors = {"imu": (kf.H[imu], kf.R[imu, imu]), "gps": (kf.H[gps], kf.R[gps, gps])}
+    fusion = FusionFilter(kf, sensors, predict_on="imu")
+    times = np.arange(1, 200)
+    _, out = fusion.estimate(x0, P0, _events("imu", observations[imu, 1:], times),
+                             _events("gps", observations[gps, 1:], times))
+    np.testing.assert_allclose(out, kf.estimate(x0, P0, observations)[:, 1:], rtol=1e-8, atol=1e-8)
+
+
+def test_slow_sensor_folds_into_period(model, observations):
+    kf, x0, P0 = model
+    m = len(kf.R)
+    sensors = {"imu": (kf.H[m // 2:], kf.R[m // 2:, m // 2:]), "gps": (kf.H[:m // 2], kf.R[:m // 2, :m // 2])}
+    fusion = FusionFilter(kf, sensors, predict_on="imu")
+    gps = pd.DataFrame({"timestamp": [10.5, 50.5], "a": observations[0, [10, 50]], "b": observations[1, [10, 50]]})
+    imu = _events("imu", observations[m // 2:, 1:], np.arange(1, 200))
+    times, out = fusion.estimate(x0, P0, imu, dataframe_events(gps, "gps", ["a", "b"]))
+    assert len(times) == 199
+    run = list(fusion.run(x0, P0, _events("imu", observations[m // 2:, 1:], np.arange(1, 200)),
+                          dataframe_events(gps, "gps", ["a", "b"])))
+    assert [e[1] for e in run].count("gps") == 2
+    # the estimate of period 10 includes the fix that arrived at 10.5
+    gps_state = next(x for t, name, x in run if name == "gps")
+    np.testing.assert_array_equal(out[:, 9], gps_state)
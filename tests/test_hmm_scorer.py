@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+from scipy.special import logsumexp
+from scipy.stats import multivariate_normal
+
+from hmm_scorer import HMMParams, SlidingHMMScorer
+
+
+
+K, M, D = 3, 2, 2
+
+
+def _random_model(covariance_type, seed=0):
+    rng = np.random.default_rng(seed)
+    startprob = rng.dirichlet(np.ones(K))
+    transmat = rng.dirichlet(np.ones(K) * 5, size=K)
+    weights = rng.dirichlet(np.ones(M), size=K)
+    means = rng.normal(scale=2, size=(K, M, D))
+    A = rng.normal(size=(K, M, D, D))
+    full = A @ np.swapaxes(A, 2, 3) + np.eye(D)
+    covars = {"diag": rng.uniform(.5, 2, (K, M, D)), "spherical": rng.uniform(.5, 2, (K, M)),
+              "full": full, "tied": full[:, 0]}[covariance_type]
+    return HMMParams(startprob, transmat, weights, means, covars, covariance_type), covars
+
+
+def _full_covars(covars, covariance_type):
+    if covariance_type == "diag":
+        return np.eye(D) * covars[..., None]
+    if covariance_type == "spherical":
+        return np.eye(D) * covars[..., None, None]
+    if covariance_type == "tied":
+        return np.repeat(covars[:, None], M, axis=1)
+    return covars
+
+
+@pytest.mark.parametrize("covariance_type", ["diag", "spherical", "full", "tied"])
+def test_log_emission(covariance_type):
+    model, covars = _random_model(covariance_type)
+    X = np.random.default_rng(1).normal(scale=2, size=(50, D))
+    full = _full_covars(covars, covariance_type)
+    ref = np.zeros((50, K))
+    for k in range(K):
+        comps = [multivariate_normal(model.means[k, m], full[k, m]).logpdf(X) + model.log_weights[k, m]
+                 for m in range(M)]
+        ref[:, k] = logsumexp(comps, axis=0)
+    np.testing.assert_allclose(model.log_emission(X), ref, rtol=1e-10)
+
+
+def _forward_score(model, X):
+    """
+    The textbook forward recursion in log space
+    """
+    log_b = model.log_emission(X)
+    log_alpha = model.log_startprob + log_b[0]
+    for t in range(1, len(X)):
+        log_alpha = logsumexp(log_alpha[:, None] + model.log_transmat, axis=0) + log_b[t]
+    return logsumexp(log_alpha)
+
+
+def test_score_matches_forward():
+    model, _ = _random_model("full")
+    X = np.random.default_rng(2).normal(scale=2, size=(300, D))
+    assert np.isclose(model.score(X), _forward_score(model, X), rtol=1e-10)
+    # continuing a sequence gives the same increments as scoring it whole
+    inc, _ = model.forward_increments(X)
+    first, log_alpha = model.forward_increments(X[:120])
+    rest, _ = model.forward_increments(X[120:], log_alpha)
+    np.testing.assert_allclose(np.concatenate([first, rest]), inc, rtol=1e-10)
+
+
+def test_sliding_scorer_chunks():
+    models = {"a": _random_model("diag", 3)[0], "b": _random_model("full", 4)[0]}
+    X = np.random.default_rng(5).normal(scale=2, size=(400, D))
+    whole = SlidingHMMScorer(models, window=50).update(X)
+    scorer = SlidingHMMScorer(models, window=50)
+    chunked = np.concatenate([scorer.update(X[a:b]) for a, b in [(0, 10), (10, 10), (10, 260), (260, 400)]])
+    np.testing.assert_allclose(chunked, whole, rtol=1e-10)
+
+    # the window score is the sum of the last 50 increments of each model
+    for j, model in enumerate(models.values()):
+        inc = model.forward_increments(X)[0]
+        np.testing.assert_allclose(whole[-1, j], inc[-50:].sum(), rtol=1e-10)
+        np.testing.assert_allclose(whole[20, j], inc[:21].sum(), rtol=1e-10)
+
+    predicted = SlidingHMMScorer(models, window=50).predict(X)
+    np.testing.assert_array_equal(predicted, np.array(["a", "b"])[whole.argmax(axis=1)])
+
+
+def test_impossible_sample():
+    models = {"a": _random_model("diag", 3)[0], "b": _random_model("full", 4)[0]}
+    X = np.random.default_rng(6).normal(scale=2, size=(200, D))
+    X[100] = 1e200
+    with np.errstate(over="ignore"):
+        for model in models.values():
+            assert np.isneginf(model.log_emission(X[100:101])).all()
+            inc, log_alpha = model.forward_increments(X)
+            # only the impossible sample is -inf, and the recursion continues past it
+            assert np.isneginf(inc[100]) and np.isfinite(np.delete(inc, 100)).all()
+            assert not np.isnan(log_alpha).any()
+
+        scores = SlidingHMMScorer(models, window=50).update(X)
+    assert not np.isnan(scores).any()
+    assert np.isneginf(scores[100:150]).all()
+    assert np.isfinite(scores[:100]).all() and np.isfinite(scores[150:]).all()
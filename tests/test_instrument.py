@@ -0,0 +1,56 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+import filter
+import instrument
+
+
+
+def test_disabled_records_nothing(model, observations):
+    kf, x0, P0 = model
+    instrument.reset()
+    with instrument.span("outside", rows=10):
+        instrument.count("outside")
+    kf.estimate(x0, P0, observations)
+    assert instrument.STATE.events == [] and instrument.STATE.counters == {}
+
+
+def test_recording_summary(model, observations):
+    kf, x0, P0 = model
+    df = pd.DataFrame({"acc_x_dash": np.random.default_rng(0).normal(size=500)})
+    ddict = {"train": {"gps_mpu_left": {"PVS 1": df, "PVS 2": df.copy()}, "folders": ["PVS 1", "PVS 2"]}}
+    with instrument.recording(sample_every=10) as state:
+        out = kf.estimate(x0, P0, observations)
+        filter.add_smoothed_cols(ddict)
+        instrument.count("hits", 3)
+    assert not instrument.STATE.enabled
+    np.testing.assert_array_equal(out, kf.estimate(x0, P0, observations))
+
+    report = instrument.summary(state)
+    assert report["KalmanFilter.estimate"]["calls"] == 1
+    assert report["KalmanFilter.estimate"]["rows"] == observations.shape[1]
+    assert report["KalmanFilter.estimate.step"]["samples"] == len(range(10, observations.shape[1], 10))
+    assert report["add_smoothed_cols"]["rows"] == 1000
+    assert sorted(report["add_smoothed_cols.folder"]["folders"]) == ["PVS 1", "PVS 2"]
+    assert report["add_smoothed_cols.folder"]["folders"]["PVS 1"]["rows"] == 500
+    assert state.counters == {"hits": 3}
+
+
+def test_exports(model, observations, tmp_path):
+    kf, x0, P0 = model
+    with instrument.recording(sample_every=50) as state:
+        kf.estimate(x0, P0, observations)
+        instrument.count("hits")
+    instrument.export_json(str(tmp_path / "profile.json"), state)
+    instrument.export_chrome_trace(str(tmp_path / "trace.json"), state)
+
+    with open(tmp_path / "profile.json") as f:
+        profile = json.load(f)
+    assert profile["counters"] == {"hits": 1}
+    with open(tmp_path / "trace.json") as f:
+        trace = json.load(f)["traceEvents"]
+    # step samples have no start time, so only the call span and the counter are traced
+    assert [(e["name"], e["ph"]) for e in trace] == [("KalmanFilter.estimate", "X"), ("hits", "C")]
+    assert trace[0]["dur"] > 0
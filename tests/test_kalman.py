@@ -0,0 +1,225 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cleaner import iter_csv_observations
+from kalman import KalmanFilter, KalmanStream
+
+
+
+def test_estimate_batch_matches_estimate(model, observations):
+    kf, x0, P0 = model
+    z = np.stack([observations, observations[:, ::-1], 2 * observations])
+    out = kf.estimate_batch(x0, P0, z)
+    for b in range(len(z)):
+        np.testing.assert_allclose(out[b], kf.estimate(x0, P0, z[b]), rtol=1e-10, atol=1e-8)
+
+
+def test_estimate_batch_ragged(model, observations):
+    kf, x0, P0 = model
+    lengths = [200, 120, 50]
+    z = np.zeros((3,) + observations.shape)
+    mask = np.zeros((3, observations.shape[1]), dtype=bool)
+    for b, L in enumerate(lengths):
+        z[b, :, :L] = observations[:, :L] * (b + 1)
+        mask[b, :L] = True
+    out = kf.estimate_batch(x0, P0, z, mask=mask)
+    for b, L in enumerate(lengths):
+        np.testing.assert_allclose(out[b, :, :L], kf.estimate(x0, P0, z[b, :, :L]), rtol=1e-10, atol=1e-8)
+        # padded steps hold the last estimate
+        np.testing.assert_array_equal(out[b, :, L:], np.repeat(out[b, :, L - 1:L], 200 - L, axis=1))
+
+
+def test_steady_state_gain_matches_dare(model):
+    kf, x0, P0 = model
+    K_iter, step, _ = kf.steady_state_gain(P0, tol=1e-12)
+    K_dare, _, change = kf.steady_state_gain(P0, tol=1e-9, method="dare")
+    assert step < 100000
+    assert change < 1e-9
+    np.testing.assert_allclose(K_iter, K_dare, atol=1e-8)
+
+
+def test_estimate_steady_matches_estimate(model):
+    kf, x0, P0 = model
+    z = kf.evolve(x0, 3000, rng=1)[1]
+    out, info = kf.estimate_steady(x0, P0, z, tol=1e-12, check=True)
+    assert info["converged_step"] < z.shape[1]
+    assert info["max_deviation"] < 1e-6
+    np.testing.assert_allclose(out, kf.estimate(x0, P0, z), atol=1e-6)
+
+
+@pytest.mark.parametrize("method", ["cholesky", "joseph", "sqrt"])
+def test_update_methods_match_inverse(model, observations, method):
+    kf, x0, P0 = model
+    np.testing.assert_allclose(kf.estimate(x0, P0, observations, method=method),
+                               kf.estimate(x0, P0, observations), rtol=1e-8, atol=1e-8)
+
+
+def test_update_methods_covariance(model, observations):
+    kf, x0, P0 = model
+    consts = {method: kf._step_constants(method) for method in ("inverse", "cholesky", "joseph", "sqrt")}
+    x, P = {}, {"inverse": P0, "cholesky": P0, "joseph": P0, "sqrt": np.linalg.cholesky(P0)}
+    for method in P:
+        x[method] = x0
+    for i in range(1, 50):
+        for method in P:
+            x[method], P[method] = kf._filter_step(x[method], P[method], observations[:, i], method, consts[method])
+    # the Cholesky update symmetrizes P and the square root factor reproduces it
+    np.testing.assert_array_equal(P["cholesky"], P["cholesky"].T)
+    np.testing.assert_allclose(P["joseph"], P["joseph"].T, rtol=1e-12)
+    np.testing.assert_allclose(P["sqrt"] @ P["sqrt"].T, P["joseph"], rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(P["inverse"], P["joseph"], rtol=1e-6, atol=1e-8)
+
+
+def test_unknown_update_method(model, observations):
+    kf, x0, P0 = model
+    with pytest.raises(ValueError):
+        kf.estimate(x0, P0, observations, method="lu")
+
+
+def _rts_reference(kf, x0, P0, z):
+    """
+    A direct Rauch-Tung-Striebel smoother keeping every filtered and predicted step
+    """
+    n, N = x0.shape[0], z.shape[1]
+    xf, Pf = np.zeros((N, n)), np.zeros((N, n, n))
+    xp, Pp = np.zeros((N, n)), np.zeros((N, n, n))
+    xf[0], Pf[0] = x0, P0
+    for i in range(1, N):
+        xp[i] = kf.F @ xf[i - 1] + kf.G @ kf.u
+        Pp[i] = kf.F @ Pf[i - 1] @ kf.F.T + kf.Q
+        K = Pp[i] @ kf.H.T @ np.linalg.inv(kf.H @ Pp[i] @ kf.H.T + kf.R)
+        xf[i] = xp[i] + K @ (z[:, i] - kf.H @ xp[i])
+        Pf[i] = (np.eye(n) - K @ kf.H) @ Pp[i]
+    xs, Ps = xf.copy(), Pf.copy()
+    for i in range(N - 2, -1, -1):
+        J = Pf[i] @ kf.F.T @ np.linalg.inv(Pp[i + 1])
+        xs[i] = xf[i] + J @ (xs[i + 1] - xp[i + 1])
+        Ps[i] = Pf[i] + J @ (Ps[i + 1] - Pp[i + 1]) @ J.T
+    return xs.T, Ps
+
+
+def test_smooth_matches_reference(model, observations):
+    kf, x0, P0 = model
+    xs, Ps = kf.smooth(x0, P0, observations)
+    xs_ref, Ps_ref = _rts_reference(kf, x0, P0, observations)
+    np.testing.assert_allclose(xs, xs_ref, rtol=1e-7, atol=1e-7)
+    np.testing.assert_allclose(Ps, Ps_ref, rtol=1e-7, atol=1e-9)
+    # the last smoothed estimate is the last filtered one
+    np.testing.assert_allclose(xs[:, -1], kf.estimate(x0, P0, observations)[:, -1])
+
+
+@pytest.mark.parametrize("checkpoint", [None, 1, 7, 64, 500])
+def test_smooth_checkpoint(model, observations, checkpoint):
+    kf, x0, P0 = model
+    xs, Ps = kf.smooth(x0, P0, observations)
+    xs_c, Ps_c = kf.smooth(x0, P0, observations, cov="diag", checkpoint=checkpoint)
+    np.testing.assert_allclose(xs_c, xs, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(Ps_c, np.diagonal(Ps, axis1=1, axis2=2).T, rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize("checkpoint", [0, -3])
+def test_smooth_bad_checkpoint(model, observations, checkpoint):
+    kf, x0, P0 = model
+    with pytest.raises(ValueError, match="checkpoint"):
+        kf.smooth(x0, P0, observations, checkpoint=checkpoint)
+
+
+@pytest.mark.parametrize("method", ["inverse", "sqrt"])
+def test_stream_matches_estimate(model, observations, method):
+    kf, x0, P0 = model
+    stream = KalmanStream(kf, x0, P0, method=method)
+    chunks = [observations[:, :1], observations[:, 1:64], observations[:, 64:65], observations[:, 65:]]
+    out = np.hstack(list(stream.run(chunks)))
+    np.testing.assert_allclose(out, kf.estimate(x0, P0, observations, method=method), rtol=1e-12, atol=1e-12)
+    assert stream.k == observations.shape[1]
+
+
+def test_stream_from_csv(model, observations, tmp_path):
+    kf, x0, P0 = model
+    columns = [f"z{i}" for i in range(len(observations))]
+    path = tmp_path / "obs.csv"
+    pd.DataFrame(observations.T, columns=columns).to_csv(path, index=False)
+    stream = KalmanStream(kf, x0, P0)
+    out = np.hstack(list(stream.run(iter_csv_observations(str(path), columns, chunksize=33))))
+    np.testing.assert_allclose(out, kf.estimate(x0, P0, observations), rtol=1e-9, atol=1e-9)
+
+
+def _iterate(F, b, x, k):
+    out = []
+    for _ in range(k):
+        x = F @ x + b
+        out.append(x)
+    return np.array(out).T
+
+
+def test_predict_matches_loop(model):
+    kf, _, _ = model
+    x = np.arange(1., 7.)
+    Gu = kf.G @ kf.u
+    np.testing.assert_allclose(kf.predict(x, 50), _iterate(kf.F, Gu, x, 50), rtol=1e-12)
+    # several start states at once, across the block boundary
+    X = np.stack([x, -x], axis=1)
+    out = kf._affine_horizon(kf.F, Gu, X, 50, block=16)
+    np.testing.assert_allclose(out[:, :, 1], _iterate(kf.F, Gu, -x, 50), rtol=1e-12)
+
+
+def test_rewind_inverts_predict(model):
+    kf, _, _ = model
+    x = np.arange(1., 7.)
+    ahead = kf.predict(x, 30)
+    back = kf.rewind(ahead[:, -1], 30)
+    np.testing.assert_allclose(back[:, :29], ahead[:, -2::-1], rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(back[:, -1], x, rtol=1e-9)
+
+
+def test_propagate_affine_powers(model):
+    kf, _, _ = model
+    x = np.arange(1., 7.)
+    ahead = kf.predict(x, 100)
+    out = kf.propagate(x, [0, 1, 37, 100, -5])
+    np.testing.assert_array_equal(out[0], x)
+    np.testing.assert_allclose(out[1:4], ahead[:, [0, 36, 99]].T, rtol=1e-10)
+    np.testing.assert_allclose(kf.propagate(out[4], [5])[0], x, rtol=1e-10)
+
+
+def test_evolve_noise(model):
+    kf, x0, _ = model
+    states, obs = kf.evolve(x0, 20000, rng=3)
+    again = kf.evolve(x0, 20000, rng=3)
+    np.testing.assert_array_equal(states, again[0])
+    np.testing.assert_array_equal(obs, again[1])
+
+    # the first observation is noiseless, and the noise has the covariances Q and R
+    np.testing.assert_array_equal(obs[:, 0], kf.H @ x0)
+    W = states[:, 1:] - kf.F @ states[:, :-1] - (kf.G @ kf.u)[:, None]
+    V = obs - kf.H @ states
+    np.testing.assert_allclose(np.cov(W), kf.Q, atol=.01)
+    np.testing.assert_allclose(np.cov(V[:, 1:]), kf.R, atol=.5)
+
+
+def test_fit_em(model):
+    kf, x0, P0 = model
+    zs = [kf.evolve(x0, 1500, rng=seed)[1] for seed in (10, 11)] + [kf.evolve(x0, 500, rng=12)[1]]
+    fitted = KalmanFilter(kf.F, np.eye(6), kf.H, np.eye(4), kf.G, kf.u)
+    start = sum(fitted.log_likelihood(x0, P0, z) for z in zs)
+    result = fitted.fit_em(zs, x0, P0, max_iter=20, structure="diag")
+
+    # the E-step log-likelihood is the filter's, and EM never lowers it
+    assert np.isclose(result["log_likelihood"][0], start)
+    assert np.all(np.diff(result["log_likelihood"]) > -1e-6 * abs(start))
+    assert fitted.R is result["R"]
+    np.testing.assert_allclose(np.diag(result["R"]), np.diag(kf.R), rtol=.15)
+    assert np.count_nonzero(result["Q"] - np.diag(np.diag(result["Q"]))) == 0
+
+
+def test_em_statistics_single_drive(model, observations):
+    # the joint statistics of identical drives are the single drive ones, times the number of drives
+    kf, x0, P0 = model
+    one = kf._em_statistics([observations], x0, P0)
+    three = kf._em_statistics([observations] * 3, x0, P0)
+    for key in ("S11", "S10", "S00", "Syy", "sx1", "sx0"):
+        np.testing.assert_allclose(three[key], 3 * one[key], rtol=1e-9)
+    assert np.isclose(one["ll"], kf.log_likelihood(x0, P0, observations))
+    xs, _ = kf.smooth(x0, P0, observations)
+    np.testing.assert_allclose(one["sx1"], xs[:, 1:].sum(axis=1), rtol=1e-8)
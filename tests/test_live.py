@@ -0,0 +1,115 @@
+import asyncio
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmarks
+import cleaner
+import live
+from fusion import FusionFilter
+from live import FusionHandler, KalmanHandler, LiveService
+
+
+
+@pytest.fixture
+def left(parent):
+    return os.path.join(parent, "PVS 1", "dataset_gps_mpu_left.csv")
+
+
+def _serve(service, sources, timeout=10, **kwargs):
+    # a hang fails the test instead of the whole run
+    return asyncio.run(asyncio.wait_for(service.serve(sources, **kwargs), timeout))
+
+
+def test_kalman_handler_matches_estimate(left):
+    kf, x0, P0 = benchmarks.kinematic_model(1, dt=.01)
+    columns = ["acc_x_dash", "acc_y_dash"]
+    handler = KalmanHandler(kf, x0, P0, columns)
+    states = []
+
+    def record(t, values, channels):
+        states.append(handler(t, values, channels))
+
+    # one message per batch, so every state of the trajectory is recorded
+    service = LiveService({"left": [record]}, max_batch=1)
+    report = _serve(service, {"left": left}, speed=None, chunksize=300)
+
+    channels, blocks = live.iter_blocks(left)
+    z = np.hstack([values[:, [channels.index(col) for col in columns]].T for _, values in blocks])
+    assert report["messages"] == len(states) == z.shape[1]
+    # every message is an update, the first included: estimate() skips its
+    # first column as the observation of x0, so it gets a placeholder
+    ref = kf.estimate(x0, P0, np.hstack([np.zeros((2, 1)), z]))[:, 1:]
+    np.testing.assert_allclose(np.array(states).T, ref, rtol=1e-9, atol=1e-9)
+    assert not np.allclose(states[0], x0)
+
+
+def test_empty_source(left, tmp_path):
+    empty = str(tmp_path / "dataset_gps_mpu_left.csv")
+    pd.read_csv(left, nrows=0).to_csv(empty, index=False)
+    kf, x0, P0 = benchmarks.kinematic_model(1, dt=.01)
+    handler = KalmanHandler(kf, x0, P0, ["acc_x_dash", "acc_y_dash"])
+    service = LiveService({"left": [handler], "empty": [handler]})
+    report = _serve(service, {"left": left, "empty": empty}, speed=None)
+    assert report["empty_sources"] == ["empty"] and report["messages"] > 0
+
+    report = _serve(LiveService({}), {"empty": empty}, speed=None)
+    assert report["messages"] == 0 and report["empty_sources"] == ["empty"]
+
+
+def test_fusion_handler(left, parent):
+    kf, x0, P0 = benchmarks.kinematic_model(2, dt=.01)
+    sensors = {"imu": (kf.H[2:], np.eye(2) * .25), "gps": (kf.H[:2], np.eye(2) * 100.)}
+    fusion = FusionFilter(kf, sensors, predict_on="imu")
+    handler = FusionHandler(fusion, x0, P0, {"imu": ["acc_x_dash", "acc_y_dash"], "gps": ["lat_m", "long_m"]})
+    with pytest.raises(ValueError):
+        handler.for_sensor("t_gps")
+
+    gps = os.path.join(parent, "PVS 1", "dataset_gps.csv")
+    service = LiveService({"imu": [handler.for_sensor("imu")], "gps": [handler.for_sensor("gps")]})
+    report = _serve(service, {"imu": left, "gps": gps}, speed=None)
+    n_gps = len(cleaner.clean_frame("t_gps", pd.read_csv(gps)))
+    n_imu = len(cleaner.clean_frame("gps_mpu_left", pd.read_csv(left)))
+    assert report["messages"] == n_imu + n_gps
+    assert np.all(np.isfinite(handler.x))
+
+    # one sensor at a time, the handler is FusionFilter.run
+    only = FusionHandler(fusion, x0, P0, {"imu": ["acc_x_dash", "acc_y_dash"]})
+    service = LiveService({"imu": [only.for_sensor("imu")]})
+    _serve(service, {"imu": left}, speed=None)
+    # the same (compactly read) values the service replayed
+    channels, blocks = live.iter_blocks(left)
+    idx = [channels.index("acc_x_dash"), channels.index("acc_y_dash")]
+    events = [(t[i], "imu", values[i, idx]) for t, values in blocks for i in range(len(t))]
+    _, _, x = list(fusion.run(x0, P0, events))[-1]
+    np.testing.assert_allclose(only.x, x, rtol=1e-9, atol=1e-9)
+
+
+def test_failing_source_raises(left, monkeypatch):
+    iter_blocks = live.iter_blocks
+
+    def failing(source, **kwargs):
+        if source != "broken":
+            return iter_blocks(source, **kwargs)
+
+        def blocks():
+            yield np.arange(3.), np.zeros((3, 1))
+            raise RuntimeError("the sensor went away")
+        return ["x"], blocks()
+
+    monkeypatch.setattr(live, "iter_blocks", failing)
+    service = LiveService({}, queue_size=10)
+    with pytest.raises(RuntimeError, match="the sensor went away"):
+        _serve(service, {"left": left, "broken": "broken"}, speed=None, chunksize=100)
+
+
+def test_failing_handler_raises(left):
+    def handler(t, values, channels):
+        raise ValueError("bad batch")
+
+    # the producer fills its small queue and would wait forever on the dead consumer
+    service = LiveService({"left": [handler]}, queue_size=4, max_batch=2)
+    with pytest.raises(ValueError, match="bad batch"):
+        _serve(service, {"left": left}, speed=None, chunksize=100)
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+import pipeline
+
+
+
+COLUMNS = ["lat_m", "long_m", "acc_x", "acc_y"]
+
+
+def test_iter_folders(parent):
+    found = list(pipeline.iter_folders(parent, "labels"))
+    assert [folder for folder, _ in found] == ["PVS 1", "PVS 2", "PVS 3"]
+    assert all(path.endswith("dataset_labels.csv") for _, path in found)
+
+
+def test_stream_folder_is_chunk_independent(parent):
+    path = dict(pipeline.iter_folders(parent))["PVS 1"]
+    whole = pd.concat(list(pipeline.stream_folder(path, chunksize=10 ** 6)))
+    chunked = pd.concat(list(pipeline.stream_folder(path, chunksize=333)))
+    pd.testing.assert_frame_equal(chunked, whole)
+    assert {"acc_x_dash_smooth", "acc_x", "lat_m", "long_m"} <= set(whole.columns)
+    assert whole["lat_m"].iloc[0] == 0
+
+
+def test_stream_estimates_match_estimate(parent, model):
+    kf, x0, P0 = model
+    results = {}
+    for folder, out in pipeline.stream_estimates(parent, kf, x0, P0, COLUMNS, chunksize=500):
+        results.setdefault(folder, []).append(out)
+    assert sorted(results) == ["PVS 1", "PVS 2", "PVS 3"]
+
+    for folder, path in pipeline.iter_folders(parent):
+        frame = pd.concat(list(pipeline.stream_folder(path)))
+        expected = kf.estimate(x0, P0, frame[COLUMNS].to_numpy(dtype=float).T)
+        np.testing.assert_allclose(np.hstack(results[folder]), expected, rtol=1e-9, atol=1e-9)
+
+    last = pipeline.run_dataset(parent, kf, x0, P0, COLUMNS, chunksize=500)
+    np.testing.assert_array_equal(last["PVS 1"][-1], results["PVS 1"][-1][:, -1])
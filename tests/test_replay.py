@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cleaner
+from replay import ReplayLog, convert_csv
+
+
+
+@pytest.fixture
+def gps(parent):
+    return pd.read_csv(os.path.join(parent, "PVS 1", "dataset_gps.csv"))
+
+
+def test_round_trip_skips_leading_nans(gps, tmp_path):
+    gps.loc[:4, "latitude"] = np.nan
+    path, out = str(tmp_path / "dataset_gps.csv"), str(tmp_path / "gps.rpl")
+    gps.to_csv(path, index=False)
+    # the first chunk has no finite latitude, so the bias comes from the second
+    assert convert_csv(path, out, clean=False, chunksize=3) == len(gps)
+
+    log = ReplayLog(out)
+    assert log.bias["latitude"] == gps["latitude"].iloc[5]
+    np.testing.assert_allclose(log.channel("latitude"), gps["latitude"], rtol=0, atol=1e-9)
+    np.testing.assert_allclose(log.channel("longitude"), gps["longitude"], rtol=0, atol=1e-9)
+    np.testing.assert_allclose(log.seconds(), gps["timestamp"], rtol=0, atol=1e-6)
+
+
+def test_empty_first_cleaned_chunk(gps, tmp_path):
+    gps.loc[:4, "speed_meters_per_second"] = np.nan
+    path, out = str(tmp_path / "dataset_gps.csv"), str(tmp_path / "gps.rpl")
+    gps.to_csv(path, index=False)
+    clean = cleaner.clean_frame("t_gps", gps)
+    assert convert_csv(path, out, chunksize=3) == len(clean)
+
+    log = ReplayLog(out)
+    assert log.bias["latitude"] == clean["latitude"].iloc[0]
+    np.testing.assert_allclose(log.channel("latitude"), clean["latitude"], rtol=0, atol=1e-9)
+
+
+def test_no_finite_bias_raises(gps, tmp_path, monkeypatch):
+    gps["latitude"] = np.nan
+    path, out = str(tmp_path / "dataset_gps.csv"), str(tmp_path / "gps.rpl")
+    gps.to_csv(path, index=False)
+    chunked = []
+    read_csv = pd.read_csv
+
+    def counting(*args, **kwargs):
+        if "chunksize" in kwargs:
+            chunked.append(kwargs["chunksize"])
+        return read_csv(*args, **kwargs)
+
+    monkeypatch.setattr(pd, "read_csv", counting)
+    with pytest.raises(ValueError, match="latitude"):
+        convert_csv(path, out, clean=False, chunksize=7)
+    # the scan ahead reads chunk by chunk too, rather than holding the file
+    assert chunked == [7, 7]
+    assert not os.path.exists(out) and not os.path.exists(out + ".tmp")
+
+
+def test_unsorted_raises(gps, tmp_path):
+    path = str(tmp_path / "dataset_gps.csv")
+    gps.iloc[::-1].to_csv(path, index=False)
+    out = str(tmp_path / "gps.rpl")
+    with pytest.raises(ValueError, match="not sorted"):
+        convert_csv(path, out, clean=False, chunksize=500)
+    # the partial log is removed
+    assert not os.path.exists(out) and not os.path.exists(out + ".tmp")
+
+
+def test_views(parent, tmp_path):
+    path = os.path.join(parent, "PVS 1", "dataset_gps_mpu_left.csv")
+    out = str(tmp_path / "left.rpl")
+    convert_csv(path, out, chunksize=500)
+    df = cleaner.clean_frame("gps_mpu_left", pd.read_csv(path))
+    log = ReplayLog(out)
+    assert len(log) == len(df)
+
+    t = df["timestamp"].to_numpy()
+    start, stop = t[100], t[300]
+    rows = log.index(start, stop)
+    assert (rows.start, rows.stop) == (100, 300)
+    np.testing.assert_allclose(log.seconds(start, stop), t[100:300], rtol=0, atol=1e-6)
+
+    cols = log.channels[:3]
+    z = log.observations(cols, start, stop)
+    assert z.shape == (3, 200) and np.shares_memory(z, log.records)
+    np.testing.assert_allclose(z, df[cols].to_numpy()[100:300].T - [[log.bias[c]] for c in cols], rtol=1e-6, atol=1e-6)
+    frame = log.frame(start, stop)
+    np.testing.assert_allclose(frame["latitude"], df["latitude"].to_numpy()[100:300], rtol=0, atol=1e-9)
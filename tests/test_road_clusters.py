@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import cleaner
+from road_clusters import (agreement, cluster_windows, drive_windows, knn_affinity, nystrom_embedding,
+                           window_features, window_labels)
+
+
+
+@pytest.fixture
+def blobs():
+    rng = np.random.default_rng(0)
+    centers = np.array([[0., 0., 0.], [6., 0., 0.], [0., 6., 3.]])
+    labels = np.repeat(np.arange(3), 200)
+    return centers[labels] + rng.normal(size=(600, 3)), labels
+
+
+def test_window_features_match_direct():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"acc_z_dash": rng.normal(9.8, 1, 1000), "acc_z_above_suspension": rng.normal(9.8, 2, 1000),
+                       "acc_x_dash": rng.normal(size=1000)})
+    features, starts = window_features(df, window=100, step=30, stats=("rms", "std", "mean"))
+    np.testing.assert_array_equal(starts, np.arange(0, 901, 30))
+    for col in ("acc_z_dash", "acc_z_above_suspension"):
+        windows = np.stack([df[col].to_numpy()[s:s + 100] for s in starts])
+        np.testing.assert_allclose(features[f"{col}_mean"], windows.mean(axis=1))
+        np.testing.assert_allclose(features[f"{col}_std"], windows.std(axis=1), rtol=1e-6)
+        np.testing.assert_allclose(features[f"{col}_rms"], np.sqrt((windows**2).mean(axis=1)))
+    assert not any("acc_x" in col for col in features.columns)
+
+    short, starts = window_features(df.iloc[:50], window=100)
+    assert len(short) == 0 and len(starts) == 0
+    with pytest.raises(ValueError):
+        window_features(df, stats=("max",))
+
+
+def test_window_labels_majority():
+    codes = np.array([0, 1, 1, 1, 1, -1, -1, -1, -1, 2, 2, -1], dtype=np.int8)
+    labels = window_labels(codes, np.array([0, 3, 5, 8]), 4, 3)
+    # unlabeled rows never win a window, and a window with none labeled is -1
+    np.testing.assert_array_equal(labels, [1, 1, -1, 2])
+
+
+def test_knn_affinity(blobs):
+    X, _ = blobs
+    A = knn_affinity(X, n_neighbors=8)
+    assert (A != A.T).nnz == 0
+    assert A.diagonal().sum() == 0
+    # every point keeps at least its own k neighbors
+    assert (np.diff(A.indptr) >= 8).all()
+    assert A.data.max() <= 1 and A.data.min() > 0
+
+
+@pytest.mark.parametrize("method", ["knn", "nystrom"])
+def test_cluster_windows_recovers_blobs(blobs, method):
+    X, labels = blobs
+    clusters = cluster_windows(X, 3, method=method, n_landmarks=100)
+    result = agreement(labels, clusters)
+    assert result["ari"] > .95 and result["accuracy"] > .98
+
+
+def test_nystrom_embedding_all_landmarks(blobs):
+    # with every point a landmark the approximation is the exact normalized affinity
+    X, _ = blobs
+    X = X[::10]
+    E = nystrom_embedding(X, 3, n_landmarks=len(X), gamma=.1)
+    A = np.exp(-.1 * ((X[:, None] - X[None]) ** 2).sum(axis=2))
+    d = A.sum(axis=1)
+    M = A / np.sqrt(d[:, None] * d[None])
+    vals, vecs = np.linalg.eigh(M)
+    top = vecs[:, np.argsort(vals)[::-1][:3]]
+    # the same subspace
+    np.testing.assert_allclose(np.abs(np.linalg.svd(top.T @ E, compute_uv=False)), 1, atol=1e-6)
+
+
+def test_agreement():
+    labels = np.array([0, 0, 1, 1, -1, 2])
+    result = agreement(labels, np.array([5, 5, 7, 7, 7, 7]), classes=["a", "b", "c"])
+    assert result["windows"] == 5
+    assert result["mapping"] == {5: "a", 7: "b"}
+    assert result["accuracy"] == 4 / 5
+    assert result["confusion"].loc["b", 7] == 2
+
+
+def test_drive_windows(parent):
+    data = cleaner.clean_dict(cleaner.load_data(parent))
+    features, windows, classes = drive_windows(data, window=200, step=100)
+    assert len(features) == len(windows)
+    assert set(windows["folder"]) == {"PVS 1", "PVS 2", "PVS 3"}
+    assert classes == list(cleaner.LabelCodec().groups["road"])
+    assert windows["label"].between(0, len(classes) - 1).all()
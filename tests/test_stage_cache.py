@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import cleaner
+import filter
+from kalman import KalmanFilter
+from stage_cache import StageCache, cached_estimate, fingerprint
+
+
+
+@pytest.fixture
+def data(parent):
+    return cleaner.clean_dict(cleaner.load_data(parent))
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_hit_frames_are_writable(data, tmp_path, mmap):
+    cache = StageCache(str(tmp_path), mmap=mmap)
+    filter.lat_long_meters(data, inPlace=False, cache=cache)
+    projected = filter.lat_long_meters(data, inPlace=False, cache=cache)
+    filter.add_smoothed_cols(projected, window=20, inPlace=False, cache=cache)
+    smoothed = filter.add_smoothed_cols(projected, window=20, inPlace=False, cache=cache)
+    assert cache.misses > 0 and cache.hits == cache.misses
+
+    df = smoothed["train"]["gps_mpu_left"]["PVS 1"]
+    before = df["lat_m"].to_numpy().copy()
+    df.loc[df.index[:10], "lat_m"] = -1.
+    df["acc_x_dash_smooth"] *= 2
+    assert (df["lat_m"].to_numpy()[:10] == -1).all()
+
+    # the writes never reach the cache entries
+    again = filter.lat_long_meters(data, inPlace=False, cache=cache)["train"]["gps_mpu_left"]["PVS 1"]
+    np.testing.assert_array_equal(again["lat_m"].to_numpy(), before)
+
+
+def test_matches_uncached(data, tmp_path):
+    cache = StageCache(str(tmp_path))
+    plain = filter.add_smoothed_cols(filter.lat_long_meters(data, inPlace=False), window=20, inPlace=False)
+    cached = filter.add_smoothed_cols(filter.lat_long_meters(data, inPlace=False, cache=cache), window=20,
+                                      inPlace=False, cache=cache)
+    for folder, df in plain["train"]["gps_mpu_left"].items():
+        pd.testing.assert_frame_equal(cached["train"]["gps_mpu_left"][folder], df)
+
+
+def test_changed_folder_recomputes(data, tmp_path):
+    cache = StageCache(str(tmp_path))
+    filter.lat_long_meters(data, inPlace=False, cache=cache)
+    misses = cache.misses
+    data["train"]["gps_mpu_left"]["PVS 1"].loc[0, "latitude"] += 1e-4
+    filter.lat_long_meters(data, inPlace=False, cache=cache)
+    assert cache.misses == misses + 1
+
+
+def test_stage_errors_surface(data, tmp_path):
+    def broken(df, method):
+        raise TypeError("a bug in the stage")
+
+    cache = StageCache(str(tmp_path))
+    original = filter._projected
+    filter._projected = broken
+    try:
+        with pytest.raises(TypeError, match="a bug in the stage"):
+            filter.lat_long_meters(data, inPlace=False, cache=cache)
+    finally:
+        filter._projected = original
+
+
+def test_fingerprint():
+    a = pd.DataFrame({"x": np.arange(5.), "s": list("abcde")})
+    assert fingerprint(a).hexdigest() == fingerprint(a.copy()).hexdigest()
+    assert fingerprint(a).hexdigest() != fingerprint(a.assign(x=a["x"] + 1)).hexdigest()
+    assert fingerprint({"b": 1, "a": 2}).hexdigest() == fingerprint({"a": 2, "b": 1}).hexdigest()
+    with pytest.raises(TypeError, match="Cannot fingerprint"):
+        fingerprint({"fn": lambda: 0})
+    with pytest.raises(TypeError, match="Cannot fingerprint"):
+        fingerprint([object()])
+
+
+def test_arrays_and_eviction(model, observations, tmp_path):
+    model, x0, P0 = model
+    cache = StageCache(str(tmp_path))
+    first = cached_estimate(cache, model, x0, P0, observations)
+    hit = cached_estimate(cache, model, x0, P0, observations)
+    np.testing.assert_array_equal(hit, model.estimate(x0, P0, observations))
+    assert cache.hits == 1 and cache.misses == 1
+    hit[:] = 0
+    np.testing.assert_array_equal(cached_estimate(cache, model, x0, P0, observations), first)
+
+    other = KalmanFilter(model.F, model.Q * 2, model.H, model.R, model.G, model.u)
+    cached_estimate(cache, other, x0, P0, observations)
+    assert len(cache.entries()) == 2
+    cache.evict(cache.entries()[-1][1])
+    assert len(cache.entries()) == 1
+    cache.clear()
+    assert cache.size() == 0
@@ -0,0 +1,92 @@
+import json
+
+import numpy as np
+import pytest
+
+from kalman import KalmanFilter
+import sweep
+
+
+
+@pytest.fixture
+def qr_arrays(model):
+    kf, x0, P0 = model
+    z = kf.evolve(x0, 1000, rng=7)[1]
+    return {"x0": x0, "P0": P0, "z": z, "F": kf.F, "H": kf.H, "G": kf.G, "u": kf.u}
+
+
+def test_kalman_qr_score_uses_control(model, qr_arrays):
+    kf, x0, P0 = model
+    expected = KalmanFilter(kf.F, kf.Q, kf.H, kf.R, kf.G, kf.u).log_likelihood(x0, P0, qr_arrays["z"])
+    assert np.isclose(sweep.kalman_qr_score(qr_arrays, q=.1, r=10), expected)
+    # dropping the control input is a different (worse) model
+    without = dict(qr_arrays, u=np.zeros_like(kf.u))
+    assert sweep.kalman_qr_score(without, q=.1, r=10) < expected
+
+
+def test_run_sweep_checkpoint(qr_arrays, tmp_path):
+    checkpoint = str(tmp_path / "sweep.jsonl")
+    grid = {"q": [.01, .1, 1], "r": [1, 10, 100]}
+    board = sweep.run_sweep(sweep.kalman_qr_score, grid, qr_arrays, checkpoint=checkpoint, workers=2)
+    assert len(board) == 9
+    assert (board.loc[0, "q"], board.loc[0, "r"]) == (.1, 10)
+    assert board["score"].is_monotonic_decreasing
+
+    # a rerun only scores the new combinations, and a torn last line is ignored
+    with open(checkpoint, "a", encoding="utf-8") as f:
+        # a multi-byte character, so text and byte offsets differ
+        f.write('{"params": {"q": "5é')
+    grid["q"].append(10)
+    board = sweep.run_sweep(sweep.kalman_qr_score, grid, qr_arrays, checkpoint=checkpoint, workers=2)
+    assert len(board) == 12
+    with open(checkpoint) as f:
+        lines = [json.loads(line) for line in f if line.startswith('{"params": {"q": 10')]
+    assert len(lines) == 3
+    with open(checkpoint, encoding="utf-8") as f:
+        torn = [line for line in f if not line.endswith("}\n")]
+    assert torn == ['{"params": {"q": "5é\n']
+
+
+def test_failed_tasks_are_recorded(qr_arrays):
+    board = sweep.run_sweep(sweep.kalman_qr_score, [{"q": .1, "r": 10}, {"q": .1, "r": -1}], qr_arrays, workers=1)
+    assert board.loc[1, "r"] == -1 and board.loc[1, "error"].startswith("LinAlgError")
+    assert np.isnan(board.loc[1, "score"])
+
+
+def test_hmm_n_parameters():
+    # 2 states, 3 features: 1 start, 2 transitions, 6 means and the covariances
+    assert sweep.hmm_n_parameters(2, 3, covariance_type="diag") == 1 + 2 + 6 + 6
+    assert sweep.hmm_n_parameters(2, 3, covariance_type="spherical") == 1 + 2 + 6 + 2
+    assert sweep.hmm_n_parameters(2, 3, covariance_type="full") == 1 + 2 + 6 + 12
+    assert sweep.hmm_n_parameters(2, 3, n_mix=2, covariance_type="tied") == 1 + 2 + 2 + 12 + 12
+    with pytest.raises(ValueError):
+        sweep.hmm_n_parameters(2, 3, covariance_type="banded")
+
+
+@pytest.fixture
+def hmm_arrays():
+    # a two state chain with well separated means
+    rng = np.random.default_rng(0)
+    states = np.zeros(3000, dtype=int)
+    for t in range(1, len(states)):
+        states[t] = states[t - 1] if rng.random() < .98 else 1 - states[t - 1]
+    X = rng.normal(np.array([[-3., 0.], [3., 1.]])[states], 1)
+    return {"data": X[:2000], "lengths": np.array([1000, 1000]), "val": X[2000:], "val_lengths": np.array([1000])}
+
+
+def test_hmm_bic_prefers_true_size(hmm_arrays):
+    pytest.importorskip("hmmlearn")
+    records = [sweep.hmm_fit_score(hmm_arrays, n, 0, n_iter=50) for n in (2, 8)]
+    # the larger model fits the training data about as well, but its parameters cost more
+    assert records[0]["score"] == -records[0]["bic"]
+    assert records[0]["score"] > records[1]["score"]
+
+
+def test_hmm_val_score(hmm_arrays):
+    pytest.importorskip("hmmlearn")
+    record = sweep.hmm_fit_score(hmm_arrays, 2, 0, val_data="val", val_lengths="val_lengths", n_iter=50)
+    assert record["score"] == record["val_log_likelihood"]
+    # per sample, the held-out data is about as likely as the training data
+    assert abs(record["score"] - record["train_log_likelihood"] / 2000) < .2
+    with pytest.raises(ValueError):
+        sweep.hmm_fit_score(hmm_arrays, 2, 0, criterion="val")
@@ -0,0 +1,35 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import cleaner
+import synthetic
+
+
+
+def test_generate_dataset(parent):
+    folders = sorted(os.listdir(parent))
+    assert folders == ["PVS 1", "PVS 2", "PVS 3"]
+    data = cleaner.load_data(parent)
+    for folder in folders:
+        mpu = data["train"]["gps_mpu_left"][folder]
+        labels = data["train"]["labels"][folder]
+        gps = data["train"]["t_gps"][folder]
+        assert list(mpu.columns) == synthetic.MPU_COLUMNS
+        assert len(mpu) == len(labels) == 2000
+        assert len(gps) == 20
+        assert np.all(np.diff(mpu["timestamp"]) > 0)
+        # one class per label group on every row
+        for group in synthetic.LABEL_GROUPS:
+            assert (labels[group].sum(axis=1) == 1).all()
+
+
+def test_generate_drive_chunks(tmp_path):
+    # writing in chunks gives the same rows and timeline as writing at once
+    a = synthetic.generate_drive(str(tmp_path / "a"), duration=12, chunk=12, seed=5)
+    b = synthetic.generate_drive(str(tmp_path / "b"), duration=12, chunk=5, seed=5)
+    assert a == b
+    for name in ("dataset_gps_mpu_left.csv", "dataset_gps.csv"):
+        pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "a" / name).iloc[:, :1],
+                                      pd.read_csv(tmp_path / "b" / name).iloc[:, :1])